@@ -1,26 +1,91 @@
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI
+import ast
+import asyncio
+import bisect
+import collections.abc
+import contextlib
+import contextvars
+import functools
+import httpx
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import queue
 import random
+import re
+import sqlite3
+import struct
+import tempfile
 import time
 import os
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from cryptography.fernet import Fernet
 
 import requests
 
+logger = logging.getLogger("aidm") # Warnings for whoever runs the game (e.g. LLM calls cut off by their token limit)
+
 
 class Character:
     def __init__(self, name = "N/A", classtype = "N/A", race = "N/A", attributes = {}, alignment = "neutral", skills = {}, hp = 100, golds = 100, description = "N/A", story = None):
+        self.journal = None # The autosave journal. Changes of HP, golds and skills are recorded into it (only for the player)
         self.name = name
         self.classtype = classtype
         self.race = race
-        self.attributes = attributes
+        self.attributes = dict(attributes) # Copy so that characters do not share the default dict
         self.alignment = alignment
-        self.skills = skills
+        self.skills = dict(skills)
         self.hp = hp
         self.golds = golds
         self.description = description
         self.story = story
 
+    @property
+    def hp(self):
+        return self._hp
+
+    @hp.setter
+    def hp(self, value):
+        self._hp = value
+        if self.journal:
+            self.journal.append({"type": "hp", "value": value})
+
+    @property
+    def golds(self):
+        return self._golds
+
+    @golds.setter
+    def golds(self, value):
+        self._golds = value
+        if self.journal:
+            self.journal.append({"type": "golds", "value": value})
+
+    def add_skill(self, name: str, description: str):
+        """Add (or replace) a skill"""
+        self.skills[name] = description
+        if self.journal:
+            self.journal.append({"type": "skill", "name": name, "description": description})
+
+    def to_dict(self):
+        """Return the character info as a dict (used by the saves and the server)"""
+        return {
+            "name": self.name,
+            "classtype": self.classtype,
+            "race": self.race,
+            "attributes": self.attributes,
+            "alignment": self.alignment,
+            "skills": self.skills,
+            "hp": self.hp,
+            "golds": self.golds,
+            "description": self.description
+        }
+
     def init_attributes(self):
         """Initialize attributes based on the gamerule of the story"""
         if self.story:
@@ -37,7 +102,15 @@ class Character:
     def charaInfo(self):
         """Sum up all character info into a string and return the string"""
         return ("Name: ", self.name, ", Classtype: ", self.classtype, "Race: ", self.race, "Attributes: ", self.attributes, "Alignment: ", self.alignment, "Skills: ", self.skills, "HP: ", self.hp, "Golds: ", self.golds, "Description: ", self.description)
-    
+
+    def profileInfo(self):
+        """Sum up the character info that does not change during the game (used in the cached prompt prefix)"""
+        return f"Name: {self.name}, Classtype: {self.classtype}, Race: {self.race}, Attributes: {self.attributes}, Alignment: {self.alignment}, Description: {self.description}"
+
+    def stateInfo(self):
+        """Sum up the character info that changes during the game (HP, golds and skills)"""
+        return f"HP: {self.hp}, Golds: {self.golds}, Skills: {self.skills}"
+
     def printCharaInfo(self):
         """Print all character info line by line"""
         print("Name: ", self.name)
@@ -55,11 +128,243 @@ class Character:
         print("\nDescription: ", self.description)
         print("\n")
         
+# The kinds of the history entries, with the code of each kind in the save files
+EVENT_KINDS = {"narration": b"n", "action": b"a", "roll": b"r", "reward": b"g", "battle": b"b"}
+EVENT_KIND_NAMES = {code[0]: kind for kind, code in EVENT_KINDS.items()}
+
+def event_kind(event: str):
+    """Guess the kind of an entry that was added without one (player actions start with "You do:")"""
+    return "action" if str(event).startswith("You do:") else "narration"
+
+class EventLog(collections.abc.Sequence):
+    """The history of a story: an append-only log of typed entries (see EVENT_KINDS) that can be indexed like a list of texts.
+    The latest entry of each kind is tracked, so the latest event and action are found in constant time.
+    Only the latest entries are kept as they are. Older ones are compressed into segments, which are spilled to a temporary file when they
+    take more than SPILL_BYTES, and the entries of a loaded game stay in its save file. The background (the first entry) is always kept.
+
+    Args:
+        events (list): The first entries (their kind is guessed)
+        save (SaveFile): The save file the first entries are read from
+        latest (dict): The index of the latest entry of each kind in the save file
+    """
+    HOT_EVENTS = 64 # The latest entries that are not compressed
+    SEGMENT_EVENTS = 32 # The entries compressed together
+    SPILL_BYTES = 1 << 20 # The compressed segments kept in memory
+
+    def __init__(self, events = (), save = None, latest = None):
+        self.save = save
+        self.saved = save.count if save else 0
+        self.latest = dict(latest or {})
+        self.segments = [] # [start index, compressed entries or None if spilled, offset in the spill file, size]
+        self.segment_starts = []
+        self.segment_bytes = 0
+        self.spill = None
+        self.hot = [] # [(kind, text)] after the segments
+        self.hot_start = self.saved
+        self.cached_segment = (None, None)
+        self.background_kind, self.background = None, None
+        if self.saved:
+            self.background_kind, self.background = self.entry(0)
+        for event in events:
+            self.append(event)
+
+    def __len__(self):
+        return self.hot_start + len(self.hot)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.entry(j)[1] for j in range(*i.indices(len(self)))]
+        return self.entry(i)[1]
+
+    def __eq__(self, other):
+        return isinstance(other, collections.abc.Sequence) and list(self) == list(other)
+
+    def append(self, event, kind = None):
+        """Append an entry. Without a kind, it is guessed"""
+        kind = kind or event_kind(event)
+        if len(self) == 0:
+            self.background_kind, self.background = kind, event
+        self.latest[kind] = len(self)
+        self.hot.append((kind, event))
+        if len(self.hot) >= self.HOT_EVENTS + self.SEGMENT_EVENTS:
+            self.compress(self.SEGMENT_EVENTS)
+
+    def compress(self, count: int):
+        """Move the oldest count entries that are not compressed into a compressed segment"""
+        data = zlib.compress(json.dumps(self.hot[:count], ensure_ascii=False).encode('utf-8'))
+        self.segments.append([self.hot_start, data, 0, len(data)])
+        self.segment_starts.append(self.hot_start)
+        self.segment_bytes += len(data)
+        self.hot = self.hot[count:]
+        self.hot_start += count
+        # Spill the oldest segments in memory to disk
+        for segment in self.segments:
+            if self.segment_bytes <= self.SPILL_BYTES:
+                break
+            if segment[1] is not None:
+                if self.spill is None:
+                    self.spill = tempfile.TemporaryFile()
+                self.spill.seek(0, os.SEEK_END)
+                segment[2] = self.spill.tell()
+                self.spill.write(segment[1])
+                self.segment_bytes -= segment[3]
+                segment[1] = None
+
+    def entry(self, i: int):
+        """Return (kind, text) of entry i"""
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("history index out of range")
+        if i == 0 and self.background is not None:
+            return self.background_kind, self.background
+        if i < self.saved:
+            data = self.save.raw(i)
+            if self.save.version >= 2:
+                return EVENT_KIND_NAMES.get(data[0], "narration"), data[1:].decode('utf-8')
+            text = data.decode('utf-8')
+            return event_kind(text), text
+        if i < self.hot_start:
+            index = bisect.bisect_right(self.segment_starts, i) - 1
+            if self.cached_segment[0] != index:
+                start, data, offset, size = self.segments[index]
+                if data is None:
+                    self.spill.seek(offset)
+                    data = self.spill.read(size)
+                self.cached_segment = (index, json.loads(zlib.decompress(data)))
+            kind, text = self.cached_segment[1][i - self.segment_starts[index]]
+            return kind, text
+        return self.hot[i - self.hot_start]
+
+    def raw(self, i: int):
+        """Return entry i as it is written in a save file (the kind code, then the UTF-8 text)"""
+        if i < self.saved and self.save.version >= 2:
+            # Copied without decoding it
+            return self.save.raw(i)
+        kind, text = self.entry(i)
+        return EVENT_KINDS[kind] + str(text).encode('utf-8')
+
+    def latest_index(self, *kinds):
+        """Return the index of the latest entry of one of the kinds, or None"""
+        indexes = [self.latest[kind] for kind in kinds if kind in self.latest]
+        return max(indexes) if indexes else None
+
+    def latest_text(self, *kinds):
+        """Return the text of the latest entry of one of the kinds, or "" if there is none"""
+        index = self.latest_index(*kinds)
+        return "" if index is None else self[index]
+
+    def reads_from(self, path: str):
+        """Return True if entries are read from the save file at path"""
+        return self.save is not None and os.path.exists(path) and os.path.samefile(self.save.path, path)
+
+    def close(self):
+        """Close the save file and the spill file"""
+        if self.save:
+            self.save.close()
+        if self.spill:
+            self.spill.close()
+
+RECALL_STOPWORDS = frozenset("""a an and are as at be but by can do does for from has have he her his i if in into is it its me my no not of on or
+our she so than that the their them then there they this to up was we were what when which who will with you your yours""".split())
+RECALL_TERM = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+RECALL_SENTENCE = re.compile(r"[^.!?\n]+[.!?]*")
+
+def recall_terms(text: str):
+    """Split a text into the terms of the recall index (lower case words without the stop words)"""
+    return [term for term in RECALL_TERM.findall(str(text).lower()) if term not in RECALL_STOPWORDS and len(term) > 1]
+
+class RecallIndex:
+    """Local BM25 index over the history and the key events of a story, to find the earlier passages relevant to the player's action.
+    It is updated incrementally: sync() only indexes the entries added since the last time. A narration is split into passages
+    of whole sentences of up to PASSAGE_WORDS words. Only the positions of the passages are kept, their text is read from the story
+
+    Args:
+        history (EventLog): The history of the story
+        keyevents (list): The key events of the story
+    """
+    PASSAGE_WORDS = 60
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, history, keyevents: list):
+        self.history = history
+        self.keyevents = keyevents
+        self.indexed_events = 1 # The background (entry 0) is in every prompt already
+        self.indexed_keyevents = 0
+        self.passages = [] # (source, index in the source, start, end) where source is "history" or "keyevent", and start:end are characters of the text
+        self.lengths = [] # Terms of each passage
+        self.total_length = 0
+        self.postings = {} # term -> {passage id: count}
+
+    def sync(self):
+        """Index the entries added to the history and the key events since the last sync"""
+        for i in range(self.indexed_events, len(self.history)):
+            text = self.history[i]
+            start, words = 0, 0
+            for sentence in RECALL_SENTENCE.finditer(text):
+                sentence_words = len(sentence.group().split())
+                if words and words + sentence_words > self.PASSAGE_WORDS:
+                    self.add("history", i, text, start, sentence.start())
+                    start, words = sentence.start(), 0
+                words += sentence_words
+            self.add("history", i, text, start, len(text))
+        self.indexed_events = len(self.history)
+        for i in range(self.indexed_keyevents, len(self.keyevents)):
+            self.add("keyevent", i, self.keyevents[i], 0, len(self.keyevents[i]))
+        self.indexed_keyevents = len(self.keyevents)
+
+    def add(self, source: str, index: int, text: str, start: int, end: int):
+        terms = recall_terms(text[start:end])
+        if not terms:
+            return
+        passage = len(self.passages)
+        self.passages.append((source, index, start, end))
+        self.lengths.append(len(terms))
+        self.total_length += len(terms)
+        for term in terms:
+            counts = self.postings.setdefault(term, {})
+            counts[passage] = counts.get(passage, 0) + 1
+
+    def search(self, query: str, k: int, allow = None):
+        """Return the k best passages for the query as [(score, (source, index, start, end))], the best first.
+        allow(passage) can leave passages out (e.g. the ones already in the prompt)
+        """
+        if not self.passages:
+            return []
+        count = len(self.passages)
+        average = self.total_length / count
+        scores = {}
+        for term in set(recall_terms(query)):
+            counts = self.postings.get(term)
+            if not counts:
+                continue
+            idf = math.log(1 + (count - len(counts) + 0.5) / (len(counts) + 0.5))
+            for passage, frequency in counts.items():
+                if allow is not None and not allow(self.passages[passage]):
+                    continue
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[passage] / average)
+                scores[passage] = scores.get(passage, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, self.passages[passage]) for passage, score in best]
+
+
+# The highest values of the number rules. max_attribute_point is also the most dice a roll can have, so they bound the cost of a roll (see dice_distribution)
+RULE_LIMITS = {"dice_sides": 100, "max_attribute_point": 20}
+
 class Story:
     def __init__(self):
-        self.history = []
+        self.history = EventLog() # Everything that has happened, see EventLog
         self.keyevents = []
+        self.pending_keyevents = [] # Key events (summaries still being generated in the background) in the order they were added
+        self.chapters = [] # Summaries of older key events, as [level, summary]. Level 1 summarizes key events, level 2 summarizes level 1 chapters, etc.
+        self.compacted_keyevents = 0 # Number of key events (from the start) that have been rolled into chapters
         self.characters = []
+        self.journal = None # The autosave journal (see Journal). Every change of the story is recorded into it
+        self.save_dir = None # The folder of the saves of this game only (the server gives one to each session). Then the commands can only name files in it (see game_file)
+        self.telemetry = Telemetry() # The statistics of the LLM calls of this game (see /stats)
+        self.prefetched = {} # Calls started before the game needs them, by call site (see SpeculativeCall)
+        self.recall = RecallIndex(self.history, self.keyevents) # Finds the earlier passages relevant to the player's action (see get_recall)
         self.gameruledict = {
             "dice_sides": 6, # The sides of the dice. Default is 6
             "max_attribute_point": 6, # The maximum attribute point (means the character can has attribute point from 1-6). Default is 6
@@ -71,8 +376,35 @@ class Story:
             },
             "custom_rules": ["None"] # Custom rules that can be added to the game. Default is ["None"]
         }
-        self.gamerule = f"""Let the player to roll dices based on player's {len(self.gameruledict["attributes"])} attribute ({self.gameruledict["attributes"]}). The dice is {self.gameruledict["dice_sides"]} sided, and if character's strength attribute is 4 means the player can roll 4 dices at the same time (4d{self.gameruledict["dice_sides"]}) to have a total. You should decide what kind of attribute should be rolled based on your reasoning.
-        Extra custrom rules: "{self.gameruledict["custom_rules"]}". """ # This game rule will be fed into the LLM when there is dice rolling.
+        self.settings = {
+            "memory_token_budget": 800, # The maximum (estimated) tokens of key events fed into a prompt. Default is 800
+            "memory_recent_events": 8, # The number of latest key events that are kept word for word. Default is 8
+            "memory_chapter_size": 6, # The number of key events (or chapters) rolled into one chapter summary. Default is 6
+            "event_classifier": "hybrid", # How checkEvent decides the next event type: "heuristic", "llm", or "hybrid" (heuristic first, cheap model when it is not confident). Default is "hybrid"
+            "event_classifier_confidence": 0.6, # The confidence (0 - 1) the heuristic needs in hybrid mode. Default is 0.6
+            "event_classifier_model": "gpt-4o-mini", # The model used when the heuristic is not confident. Default is "gpt-4o-mini"
+            "structured_output": True, # Ask for the game data (options, enemies, rewards, damage) as a JSON block after the story text. Default is True
+            "structured_retries": 1, # How many times the model is asked to correct an invalid JSON block before reading the text instead. Default is 1
+            "structured_model": "gpt-4o-mini", # The model that corrects an invalid JSON block. Default is "gpt-4o-mini"
+            "roll_min_success": 0.1, # The lowest chance (0 - 1) to pass an encounter roll. A requirement that is harder is lowered. Default is 0.1
+            "roll_max_success": 0.9, # The highest chance (0 - 1) to pass an encounter roll. A requirement that is easier is raised. Default is 0.9
+            "autosave": True, # Journal every change of the game into the saves folder, so it can be loaded with /read after a crash. Default is True
+            "autosave_snapshot_turns": 20, # The least turns between two snapshots of the whole game (the journal starts again after a snapshot). Default is 20
+            "autosave_snapshot_ratio": 0.5, # A snapshot is only written once the journal is this large compared to the last snapshot, so the cost of the snapshots stays in proportion to what has changed. Default is 0.5
+            "keyevent_trailer": True, # Ask every narration for its key event (a one line summary) after the story text, instead of summarizing it in a separate call. Default is True
+            "speculative_world": True, # Start generating the world background and the characters as soon as the game starts, while the player types their name. Default is True
+            "stream_early_stop": True, # Read the option and roll lines of an option while it is streamed, and stop the generation as soon as they are complete (the dice are rolled at once). Default is True
+            "battle_engine": "local", # How a battle round is resolved: "local" (the dice decide the action, damage, healing and escape, and the LLM only narrates it in one call) or "llm" (the LLM writes the option and the damage). Default is "local"
+            "battle_damage_scale": 2, # In the local battle engine, the damage (and twice the healing) is the attribute's dice total times this. Default is 2
+            "recall_passages": 4, # The number of earlier passages (of the history and the key events) relevant to the player's action that are fed into a story prompt. 0 turns it off. Default is 4
+            "recall_token_budget": 300, # The maximum (estimated) tokens of the earlier passages fed into a prompt. Default is 300
+            "recall_min_score": 3.0, # The lowest BM25 score of a recalled passage (a word shared with the action that is rare in the story scores about 3 to 8). Default is 3.0
+            "recall_skip_recent": 6, # The latest history entries that are never recalled (they are in the prompt or the memory already). Default is 6
+            "model_routes": {} # The model routes of this game, as {call site: [model, fallback model, ...]}, replacing the ones of MODEL_ROUTES (set them with /route). Default is {}
+        }
+        self.gamerule = "" # This game rule will be fed into the LLM when there is dice rolling. It is built from gameruledict by compile_gamerule
+        self.success_check = None # The compiled success condition: success_check(total, requirement) returns True if the roll passes
+        self.compile_gamerule()
 
 
     def get_all_story(self):
@@ -81,7 +413,13 @@ class Story:
     def get_background(self):
         return self.history[0]
     
-    def get_all_key_events(self):
+    def get_all_key_events(self, wait = True):
+        """Return the key events so far
+
+        Args:
+            wait (bool): Wait for the summaries still being generated. If False, only the summaries that are already done (in order) are returned.
+        """
+        self.collect_key_events(wait)
         return self.keyevents
     
     def get_all_chara_info(self):
@@ -93,36 +431,210 @@ class Story:
     def get_gamerule(self):
         return self.gamerule
     
-    def add_event(self, event):
-        """Append the event"""
-        self.history.append(event)
+    def add_event(self, event, kind = None):
+        """Append the event
+
+        Args:
+            event (str): The text of the event
+            kind (str): One of EVENT_KINDS. If None, "action" for "You do: ..." and "narration" for the others
+        """
+        kind = kind or event_kind(event)
+        self.history.append(event, kind)
+        self.sync_recall()
+        self.record({"type": "event", "text": event, "kind": kind})
+
+    def reload_history(self, history):
+        """Read the history from an EventLog with the same entries from now on (e.g. the save file it has just been written into).
+        The recall index follows it, so nothing is indexed again
+        """
+        if self.recall.history is self.history and len(history) == len(self.history):
+            self.recall.history = history
+        self.history = history
+
+    def sync_recall(self):
+        """Index the entries added since the last time (see RecallIndex), or the whole game when another one has been loaded"""
+        if self.recall.history is not self.history or self.recall.keyevents is not self.keyevents:
+            self.recall = RecallIndex(self.history, self.keyevents)
+        self.recall.sync()
+
+    def record(self, record: dict):
+        """Write a change into the autosave journal (if there is one)"""
+        if self.journal:
+            self.journal.append(record)
     
     def get_latest_event(self):
-        """Return the latest event"""
-        if(self.history[-1].startswith("You do:")):
-            return self.history[-2]
-        return self.history[-1]
+        """Return the latest event that is not a player action"""
+        return self.history.latest_text("narration", "roll", "reward", "battle")
     
-    def get_latest_player_action(self, i = -1):
-        if(not self.history[i].startswith("You do:")):
-            return self.get_latest_player_action(i-1)
-        return self.history[i]
-
-    def add_key_event(self, event:str):
-        self.keyevents.append(event)
+    def get_latest_player_action(self):
+        """Return the latest player action"""
+        return self.history.latest_text("action")
+
+    def add_key_event(self, event):
+        """Append the key event. The event can be a string or a Future of a string (summary generated in the background)"""
+        if(isinstance(event, Future) or self.pending_keyevents):
+            # Keep the order of the key events even if some are not done yet
+            self.pending_keyevents.append(event)
+        else:
+            self.keyevents.append(event)
+            self.record({"type": "keyevent", "text": event})
+
+    def collect_key_events(self, wait = True):
+        """Move the finished key events from the pending list into keyevents, keeping their order
+
+        Args:
+            wait (bool): Block until all pending key events are done
+        """
+        while self.pending_keyevents:
+            event = self.pending_keyevents[0]
+            if(isinstance(event, Future)):
+                if(not wait and not event.done()):
+                    break
+                try:
+                    event = event.result()
+                except Exception as e:
+                    print(f"\n[Error] Failed to summarize the key event: {e}")
+                    event = None
+            self.pending_keyevents.pop(0)
+            if event:
+                self.keyevents.append(event)
+                self.record({"type": "keyevent", "text": event})
+        self.compact_key_events()
+
+    def compact_key_events(self):
+        """Roll the older key events into chapter summaries, and the older chapters into higher level chapters.
+        The summaries are generated in the background.
+        """
+        recent = self.settings["memory_recent_events"]
+        size = max(2, self.settings["memory_chapter_size"])
+        while len(self.keyevents) - self.compacted_keyevents >= recent + size:
+            events = self.keyevents[self.compacted_keyevents : self.compacted_keyevents + size]
+            self.chapters.append([1, generateChapterAsync(events)])
+            self.compacted_keyevents += size
+        # When there are too many chapters of the same level, roll the oldest of them into one chapter of the next level
+        rolled = True
+        while rolled:
+            rolled = False
+            for level in sorted(set(chapter[0] for chapter in self.chapters)):
+                indexes = [i for i, chapter in enumerate(self.chapters) if chapter[0] == level]
+                if len(indexes) > size:
+                    oldest = indexes[:size]
+                    summaries = [self.chapters[i][1] for i in oldest]
+                    self.chapters[oldest[0]] = [level + 1, generateChapterAsync(summaries)]
+                    for i in reversed(oldest[1:]):
+                        self.chapters.pop(i)
+                    rolled = True
+                    break
+
+    def get_key_event_memory(self, token_budget = None):
+        """Return the key events to be fed into a prompt: chapter summaries of the older events and the latest key events word for word.
+        The oldest entries are dropped if the total exceeds the token budget.
+
+        Args:
+            token_budget (int): The maximum estimated tokens. Default is settings["memory_token_budget"]
+        Return:
+            A list of key events and chapter summaries, from the oldest to the latest
+        """
+        if token_budget is None:
+            token_budget = self.settings["memory_token_budget"]
+        self.collect_key_events()
+        memory = []
+        for chapter in self.chapters:
+            if(isinstance(chapter[1], Future)):
+                try:
+                    chapter[1] = chapter[1].result()
+                except Exception as e:
+                    print(f"\n[Error] Failed to summarize the chapter: {e}")
+                    chapter[1] = ""
+            if chapter[1]:
+                memory.append("Earlier chapter: " + chapter[1])
+        memory += self.keyevents[self.compacted_keyevents : ]
+        # Keep the latest entries within the budget
+        total = 0
+        for i in range(len(memory) - 1, -1, -1):
+            total += estimate_tokens(memory[i])
+            if total > token_budget:
+                return memory[i + 1 : ]
+        return memory
+
+    def get_recall(self, query: str, k = None, token_budget = None):
+        """Return the passages of the earlier story most relevant to the query (the player's action), the best first.
+        The background, the latest history entries and the key events fed word for word (see get_key_event_memory) are left out,
+        since they are in the prompt already.
+
+        Args:
+            k (int): The maximum number of passages. Default is settings["recall_passages"]
+            token_budget (int): The maximum estimated tokens. Default is settings["recall_token_budget"]
+        """
+        k = self.settings["recall_passages"] if k is None else k
+        token_budget = self.settings["recall_token_budget"] if token_budget is None else token_budget
+        if k <= 0 or not query.strip():
+            return []
+        self.sync_recall()
+        recent = len(self.history) - self.settings["recall_skip_recent"]
+        compacted = self.compacted_keyevents
+
+        def allow(passage):
+            source, index = passage[0], passage[1]
+            return index < recent if source == "history" else index < compacted
+
+        passages, total = [], 0
+        for score, (source, index, start, end) in self.recall.search(query, k, allow):
+            if score < self.settings["recall_min_score"]:
+                break
+            text = (self.history[index] if source == "history" else self.keyevents[index])[start:end].strip()
+            total += estimate_tokens(text)
+            if total > token_budget:
+                break
+            passages.append(text)
+        return passages
 
     def add_npc(self, npc:Character):
         self.characters.append(npc)
+        self.record({"type": "npc", "character": npc.to_dict()})
+
+    def compile_gamerule(self):
+        """Compile the success condition and rebuild the game rule prompt. Call it after gameruledict changes"""
+        self.success_check = compile_condition(self.gameruledict["success_condition"])
+        self.gamerule = f"""Let the player to roll dices based on player's {len(self.gameruledict["attributes"])} attribute ({self.gameruledict["attributes"]}). The dice is {self.gameruledict["dice_sides"]} sided, and if character's strength attribute is 4 means the player can roll 4 dices at the same time (4d{self.gameruledict["dice_sides"]}) to have a total. You should decide what kind of attribute should be rolled based on your reasoning.
+        A roll passes when: "{self.gameruledict["success_condition"]}" (total is the dice total plus the skill points).
+        Extra custrom rules: "{self.gameruledict["custom_rules"]}". """
 
     def update_gamerule(self, rule_key: str, new_value):
-        if rule_key in self.gameruledict:
-            self.gameruledict[rule_key] = new_value
-        else:
-            self.gameruledict["custom_rules"].append({rule_key: new_value})
+        """Update a game rule (or add a custom rule). Raise ValueError if the new value is invalid, the rule is then not changed"""
+        self.override_gamerule({rule_key: new_value} if rule_key in self.gameruledict else
+                               {"custom_rules": self.gameruledict["custom_rules"] + [{rule_key: new_value}]})
 
     def override_gamerule(self, new_rules: dict):
+        """Update several game rules at once. Raise ValueError if a new value is invalid, the rules are then not changed"""
+        for rule_key, highest in RULE_LIMITS.items():
+            if rule_key in new_rules and (type(new_rules[rule_key]) != int or not 1 <= new_rules[rule_key] <= highest):
+                raise ValueError(f"{rule_key} must be a whole number from 1 to {highest}")
+        if "success_condition" in new_rules:
+            compile_condition(new_rules["success_condition"])
         self.gameruledict.update(new_rules)
+        self.compile_gamerule()
+        self.record({"type": "rules", "rules": self.gameruledict})
+
+    def update_setting(self, setting_key: str, new_value):
+        """Update an engine setting. Return False if the setting does not exist"""
+        if setting_key not in self.settings:
+            return False
+        if isinstance(self.settings[setting_key], float) and type(new_value) == int:
+            new_value = float(new_value)
+        if type(new_value) != type(self.settings[setting_key]):
+            # Keep the type of the setting (e.g. a number stays a number)
+            return False
+        self.settings[setting_key] = new_value
+        self.record({"type": "setting", "key": setting_key, "value": new_value})
+        if setting_key.startswith("memory_"):
+            self.compact_key_events()
+        return True
+
 
+def estimate_tokens(text: str):
+    """Roughly estimate the number of tokens of a text (about 4 characters per token)"""
+    return len(str(text)) // 4 + 1
 
 def extract_response(response: str, wanted_str: str, start_shift = 2, end_str = "\n", end_shift = 0):
     """Extract the response from the GPT API
@@ -138,6 +650,136 @@ def extract_response(response: str, wanted_str: str, start_shift = 2, end_str =
     """
     return response[(response.find(wanted_str) + len(wanted_str) + start_shift): (response.find(end_str, (response.find(wanted_str) + len(wanted_str) + start_shift)) + end_shift)]
 
+DICE_EXACT_TOTALS = 500 # Above this many possible totals, the distribution of a roll is approximated (see dice_distribution)
+DICE_APPROXIMATE_POINTS = 200 # The totals the approximated distribution is spread over
+
+@functools.lru_cache(maxsize=256)
+def dice_distribution(count: int, sides: int):
+    """Return the distribution of the total of count dice with the given sides (count d sides), as a tuple of (total, probability).
+    It is exact when there are at most DICE_EXACT_TOTALS possible totals. Above that, it is a normal distribution spread over DICE_APPROXIMATE_POINTS totals
+    """
+    if count <= 0:
+        return ((0, 1.0),)
+    if count * (sides - 1) + 1 > DICE_EXACT_TOTALS:
+        return approximate_dice_distribution(count, sides)
+    # Add one die at a time: the ways to reach a total are the sum of the ways to reach the sides totals below it (a running sum)
+    ways = [1]
+    for die in range(count):
+        running, distribution = 0, []
+        for total in range(len(ways) + sides - 1):
+            running += ways[total] if total < len(ways) else 0
+            running -= ways[total - sides] if total >= sides else 0
+            distribution.append(running)
+        ways = distribution
+    outcomes = sides ** count
+    # ways[0] is the total of count (every die shows 1)
+    return tuple((count + i, way / outcomes) for i, way in enumerate(ways))
+
+def approximate_dice_distribution(count: int, sides: int):
+    """The normal approximation of count d sides, as a tuple of (total, probability) over DICE_APPROXIMATE_POINTS evenly spaced totals"""
+    mean = count * (sides + 1) / 2
+    deviation = math.sqrt(count * (sides ** 2 - 1) / 12)
+    lowest, highest = count, count * sides
+    totals = sorted(set(round(lowest + (highest - lowest) * i / (DICE_APPROXIMATE_POINTS - 1)) for i in range(DICE_APPROXIMATE_POINTS)))
+    cdf = lambda x: 0.5 * (1 + math.erf((x - mean) / (deviation * math.sqrt(2))))
+    # Every total gets the probability of the values closer to it than to its neighbours
+    bounds = [-math.inf] + [(a + b) / 2 for a, b in zip(totals, totals[1:])] + [math.inf]
+    return tuple((total, cdf(bounds[i + 1]) - cdf(bounds[i])) for i, total in enumerate(totals))
+
+# The grammar of a success condition: the names total and requirement, numbers, arithmetic, comparisons, and/or/not
+CONDITION_NAMES = ("total", "requirement")
+CONDITION_NODES = (ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.UAdd,
+                   ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+                   ast.Compare, ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq, ast.Name, ast.Load, ast.Constant)
+
+@functools.lru_cache(maxsize=None)
+def compile_condition(success_condition: str):
+    """Check a success condition against the grammar and compile it into a function success_check(total, requirement).
+    Raise ValueError that says what is not allowed
+    """
+    try:
+        tree = ast.parse(str(success_condition).strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f'"{success_condition}" is not a valid condition ({e.msg})')
+    for node in ast.walk(tree):
+        if not isinstance(node, CONDITION_NODES):
+            raise ValueError(f'"{success_condition}" can not use {type(node).__name__}. Only total, requirement, numbers, + - * / // %, comparisons, and, or, not are allowed')
+        if isinstance(node, ast.Name) and node.id not in CONDITION_NAMES:
+            raise ValueError(f'"{success_condition}" can not use the name {node.id}. Only total and requirement are allowed')
+        if isinstance(node, ast.Constant) and (type(node.value) not in (int, float)):
+            raise ValueError(f'"{success_condition}" can only use numbers')
+    # Wrap the checked expression into "lambda total, requirement: <condition>"
+    function = ast.Expression(ast.Lambda(
+        args=ast.arguments(posonlyargs=[], args=[ast.arg(arg=name) for name in CONDITION_NAMES], kwonlyargs=[], kw_defaults=[], defaults=[]),
+        body=tree.body))
+    ast.fix_missing_locations(function)
+    check = eval(compile(function, "<success_condition>", "eval"), {"__builtins__": {}})
+
+    def success_check(total, requirement):
+        try:
+            return bool(check(total, requirement))
+        except ArithmeticError:
+            # e.g. division by a requirement of 0
+            return False
+    return success_check
+
+def skill_bonus(character: Character, selectedAttribute: str):
+    """Return the skills that add points to the rolls of an attribute, as a list of (skill name, points)"""
+    bonuses = []
+    for skill_key, skill_val in character.skills.items():
+        if(selectedAttribute.lower() in skill_val.lower()):
+            try:
+                bonuses.append((skill_key, int(skill_val[skill_val.find("Add") + 4: skill_val.find("point")])))
+            except ValueError:
+                # The skill does not add points
+                pass
+    return bonuses
+
+def success_chance(character: Character, selectedAttribute: str, requirement: int, story: Story):
+    """Return the chance (0 - 1) that the character's roll of an attribute passes the requirement (see dice_distribution)"""
+    sides = story.gameruledict["dice_sides"]
+    count = character.attributes[selectedAttribute]
+    bonus = sum(value for _, value in skill_bonus(character, selectedAttribute))
+    return sum(chance for total, chance in dice_distribution(count, sides) if story.success_check(total + bonus, requirement))
+
+def opposed_chance(character: Character, enemy: Character, selectedAttribute: str, story: Story):
+    """Return the chance (0 - 1) that the character's roll of an attribute passes the enemy's roll of the same attribute"""
+    sides = story.gameruledict["dice_sides"]
+    count = enemy.attributes[selectedAttribute]
+    return sum(chance * success_chance(character, selectedAttribute, total, story) for total, chance in dice_distribution(count, sides))
+
+def calibrate_requirement(character: Character, selectedAttribute: str, requirement: int, story: Story):
+    """Return the requirement closest to the given one whose chance to pass is within the roll_min_success - roll_max_success settings.
+    The requirement is kept when no requirement is within them
+    """
+    low, high = story.settings["roll_min_success"], story.settings["roll_max_success"]
+    if low <= success_chance(character, selectedAttribute, requirement, story) <= high:
+        return requirement
+    bonus = sum(value for _, value in skill_bonus(character, selectedAttribute))
+    count = character.attributes[selectedAttribute]
+    # The requirements around the possible totals (at most about DICE_APPROXIMATE_POINTS of them)
+    lowest, highest = max(0, count + bonus - 1), count * story.gameruledict["dice_sides"] + bonus + 1
+    step = max(1, (highest - lowest) // DICE_APPROXIMATE_POINTS)
+    candidates = [value for value in range(lowest, highest + 1, step) if low <= success_chance(character, selectedAttribute, value, story) <= high]
+    if not candidates:
+        return requirement
+    return min(candidates, key=lambda value: abs(value - requirement))
+
+def roll_dice(count: int, sides: int):
+    """Roll count dice with the given sides at once. Return the list of the dice"""
+    return random.choices(range(1, sides + 1), k=count)
+
+def print_odds(character: Character, story: Story, selectedAttribute = None, requirement = None):
+    """Print the range and average of the character's rolls, and the chance to pass the requirement if it is given"""
+    sides = story.gameruledict["dice_sides"]
+    for attr in ([selectedAttribute] if selectedAttribute else story.gameruledict["attributes"]):
+        count = character.attributes.get(attr, 0)
+        bonus = sum(value for _, value in skill_bonus(character, attr))
+        line = f"{attr}: {count}d{sides}" + (f" + {bonus} from skills" if bonus else "") + f", total {count + bonus} - {count * sides + bonus}, average {count * (sides + 1) / 2 + bonus:g}"
+        if requirement is not None:
+            line += f", chance to pass {requirement}: {success_chance(character, attr, requirement, story):.1%}"
+        print(line)
+
 def rollDices(character: Character, selectedAttribute: str, requirement: int, story: Story):
     """Let the character roll the dice based on character's attribute. Check if dice total surpass the requirement
 
@@ -148,26 +790,19 @@ def rollDices(character: Character, selectedAttribute: str, requirement: int, st
     Return:
         Outcome of the roll
     """
-    total = 0
-    total_list = []
     dice_sides = story.gameruledict["dice_sides"]  # Get dice_sides from gamerule
-    for i in range(character.attributes[selectedAttribute]):
-        num = random.randint(1, dice_sides)
-        total += num
-        total_list.append(num)
+    total_list = roll_dice(character.attributes[selectedAttribute], dice_sides)
+    total = sum(total_list)
     print(f"\nThe dice you have rolled based on your {selectedAttribute} ability: ")
     print(*total_list, sep =', ')
     # Add skills to total
-    for skill_key, skill_val in character.skills.items():
-        if(selectedAttribute.lower() in skill_val.lower()):
-            print(f"""Your skill: "{skill_key}" has contributed to your roll! """)
-            value = int(skill_val[skill_val.find("Add") + 4: skill_val.find("point")])
-            print(f"{value} points added to your dice rolls")
-            total += value
+    for skill_key, value in skill_bonus(character, selectedAttribute):
+        print(f"""Your skill: "{skill_key}" has contributed to your roll! """)
+        print(f"{value} points added to your dice rolls")
+        total += value
     
     print(f"In total: {total}")
-    success_condition = story.gameruledict["success_condition"]
-    result = eval(f"{success_condition.replace('requirement', str(requirement))}")
+    result = story.success_check(total, requirement)
     if(result):
         print("Success!")
         return True
@@ -185,149 +820,352 @@ def rollEnemyDices(character: Character, selectedAttribute: str, story: Story):
     Return:
         Total int of the roll
     """
-    total = 0
-    total_list = []
     dice_sides = story.gameruledict["dice_sides"]  # Get dice_sides from gamerule
-    for i in range(character.attributes[selectedAttribute]):
-        num = random.randint(1, dice_sides)
-        total += num
-        total_list.append(num)
+    total_list = roll_dice(character.attributes[selectedAttribute], dice_sides)
+    total = sum(total_list)
     print(f"\nThe dice your enemy have rolled based on {selectedAttribute} ability: ")
     print(*total_list, sep =', ')
     print(f"Your enemy's dice in total: {total}")
     return total
 
+# The local battle engine: the player's words decide the action and the attribute, the dice decide the rest
+BATTLE_ACTION_KEYWORDS = {
+    "escape": ["flee", "escape", "retreat", "run away", "run off", "get away", "hide", "withdraw"],
+    "heal": ["heal", "potion", "bandage", "drink", "recover", "pray", "rest", "tend my wounds", "catch my breath"]
+}
+BATTLE_ATTRIBUTE_KEYWORDS = {
+    "Strength": ["swing", "strike", "hit", "smash", "slash", "charge", "bash", "punch", "kick", "grapple", "shove", "axe", "hammer", "sword", "club", "shield", "wrestle"],
+    "Intelligence": ["spell", "cast", "magic", "fireball", "lightning", "curse", "trick", "trap", "plan", "study", "outwit", "weakness", "potion", "pray"],
+    "Speed": ["dodge", "dart", "shoot", "arrow", "bow", "throw", "stab", "dagger", "flank", "sneak", "flee", "escape", "run", "retreat", "evade", "quick"],
+    "Charisma": ["intimidate", "persuade", "taunt", "rally", "inspire", "bluff", "distract", "shout", "roar", "sing", "charm", "threaten"]
+}
+
+def choose_battle_action(player: Character, story: Story, user_input: str):
+    """Decide what the player does in a battle round from what they typed. Return (action, attribute), where action is "attack", "heal" or "escape".
+    An attribute named in the input is used first, then the keywords, then the player's best attribute
+    """
+    action = next((name for name, keywords in BATTLE_ACTION_KEYWORDS.items() if keyword_score(user_input, keywords)), "attack")
+    attributes = story.gameruledict["attributes"]
+    named = [attr for attr in attributes if keyword_score(user_input, [attr.lower()])]
+    if named:
+        return action, named[0]
+    scores = {attr: keyword_score(user_input, BATTLE_ATTRIBUTE_KEYWORDS.get(attr, [])) for attr in attributes}
+    best = max(attributes, key=lambda attr: (scores[attr], player.attributes.get(attr, 0)))
+    return action, best
+
+def resolve_battle_round(player: Character, enemy: Character, action: str, selectedAttribute: str, story: Story):
+    """Resolve a battle round with the dice: the player's roll of the attribute against the enemy's.
+    When the player wins, an attack deals the player's attribute dice times battle_damage_scale to the enemy, a heal restores half of that
+    and an escape ends the battle. When the player loses, the enemy deals its attribute dice times battle_damage_scale to the player.
+    The HP are updated. Return the outcome: {"action", "attribute", "success", "damage", "heal", "taken"}
+    """
+    sides = story.gameruledict["dice_sides"]
+    scale = story.settings["battle_damage_scale"]
+    print(f"\nYou {action} with your {selectedAttribute}. Your chance to beat the enemy's roll: {opposed_chance(player, enemy, selectedAttribute, story):.0%}")
+    success = rollDices(player, selectedAttribute, rollEnemyDices(enemy, selectedAttribute, story), story)
+    outcome = {"action": action, "attribute": selectedAttribute, "success": success, "damage": 0, "heal": 0, "taken": 0}
+    if success:
+        points = round(sum(roll_dice(player.attributes[selectedAttribute], sides)) * scale)
+        if action == "attack":
+            outcome["damage"] = points
+            enemy.hp -= points
+        elif action == "heal":
+            outcome["heal"] = max(1, points // 2)
+            player.hp += outcome["heal"]
+    else:
+        outcome["taken"] = round(sum(roll_dice(enemy.attributes[selectedAttribute], sides)) * scale)
+        player.hp -= outcome["taken"]
+    return outcome
+
+# Commands of the game by name: {"/name": {"handler": handler, "usage": ..., "description": ...}}.
+# A handler is called as handler(character, story, args), where args is the text after the command name, and prints its output.
+commands = {}
+
+def command(name: str, usage: str, description: str):
+    """Register a command handler (decorator)"""
+    def register(handler):
+        commands[name] = {"handler": handler, "usage": usage, "description": description}
+        return handler
+    return register
+
+def run_command(character: Character, story: Story, uinput: str):
+    """Run a command (an input that starts with "/"). It does not wait for any input, so it can be run from the game loop or the server"""
+    name, _, args = uinput.strip().partition(" ")
+    entry = commands.get(name.lower())
+    if entry is None:
+        print("Command not found")
+        return
+    entry["handler"](character, story, args.strip())
+
 def command_input(character: Character, story: Story, uinput = ""):
-    """Determine whether the input is a command and execute it
+    """Get the player's action, running the commands entered before it.
+    This is a generator: it yields the prompt when it needs the player's input and returns the player's action (use it with "yield from")
     """
-    if(uinput==""):
-        uinput = input("\nYou do: ")
-    if(uinput.startswith("/")):
-        # Command of printing player's character info
-        if(uinput == "/me"):
-            character.printCharaInfo()
-            return command_input(character, story)
-        # Command of saving the story into a txt file
-        elif(uinput.startswith("/save")):
-            # Story saving
-            file_name = uinput[6 : ]
-            with open((file_name + ".txt"), 'w', encoding='utf-8') as file:
-                for line in story.get_all_story():
-                    file.write(str(line) + '\n')
-            # Character saving
-            file_name_chara = file_name + "_chara"
-            with open((file_name_chara + ".txt"), 'w', encoding='utf-8') as file:
-                file.write(f"Name: {character.name}\n")
-                file.write(f"Classtype: {character.classtype}\n")
-                file.write(f"Race: {character.race}\n")
-                file.write(f"Attributes: \n")
-                for key, value in character.attributes.items():
-                    file.write(f"{key}: {value}\n")
-                file.write(f"Alignment: {character.alignment}\n")
-                file.write(f"HP: {character.hp}\n")
-                file.write(f"Golds: {character.golds}\n")
-                file.write(f"Skills: \n")
-                for key, value in character.skills.items():
-                    file.write(f"{key}:\n {value}\n")
-                file.write("\n")
-            print(f"Your story has been saved to {file_name}.txt. Your character information has been saved to {file_name_chara}.txt")
-            return command_input(character, story)
-        elif(uinput.startswith("/read")):
-            file_name = uinput[6:].strip()
-            success = load_saved_game(character, story, file_name)
-            if success:
-                print(f"Game loaded from {file_name}! Continuing the story...")
-                # Re-print all story for context
-                print("\n" + story.get_latest_event())
-            return command_input(character, story)
-        elif(uinput == ("/events")):
-            print("Events so far:")
-            for item in story.keyevents:
-                print(f"- {item}")
-            return command_input(character, story)
-        elif uinput.startswith("/rule"):
-            parts = uinput.split()
-            if len(parts) >= 3:
-                rule_key = parts[1]
-                new_value = " ".join(parts[2:])
-                try:
-                    # Try to convert the new value to int
-                    new_value = int(new_value)
-                except:
-                    pass
-                story.update_gamerule(rule_key, new_value)
-                print(f"Rules updated: {rule_key} = {new_value}")
-            else:
-                print("Invalid rule command. Please use the format: /rule [rule_type] [new_value]")
-            return command_input(character, story)
-        # Command of listing all commands
-        elif(uinput == "/help"):
-            print("""
-                  Help commands:
-                  /me -> Shows the character information of the player
-                  /save [file_name] -> Save the story so far into 2 txt file (story and character info).
-                  /read [file_name] -> (Might not work perfectly) Load a saved game from 2 txt files (story and character info). 
-                  /events -> Shows key events happened
-                  /rule [rule_type] [new_value] -> Update the game rule
-                  """)
-            return command_input(character, story)
+    while True:
+        if(uinput==""):
+            autosave(character, story)
+            uinput = yield "\nYou do: "
+        if(not uinput.startswith("/")):
+            return uinput
+        run_command(character, story, uinput)
+        uinput = ""
+
+@command("/me", "/me", "Shows the character information of the player")
+def command_me(character: Character, story: Story, args: str):
+    character.printCharaInfo()
+
+def game_file(story: Story, file_name: str):
+    """Return the path of a file named in a command (e.g. /save). A game with its own save_dir can only name a file in its "files" folder
+    (apart from the autosaves), by its base name
+    """
+    if story.save_dir is None:
+        return file_name
+    folder = os.path.join(story.save_dir, "files")
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, re.sub(r"[^\w.-]", "_", os.path.basename(file_name)).lstrip(".") or "save")
+
+@command("/save", "/save [file_name]", "Save the game now (it is also autosaved every turn). With a file name, save it into [file_name].aidm.")
+def command_save(character: Character, story: Story, args: str):
+    file_name = args
+    if(file_name == ""):
+        if story.journal:
+            snapshot_game(character, story)
+            print(f"Your game has been saved as {story.journal.name}. Use /read {story.journal.name} to load it.")
         else:
-            # Command not found
-            print("Command not found")
-            return command_input(character, story)
+            print("Autosave is off. Use /save [file_name] to save the game into a file.")
+        return
+    path = game_file(story, file_name) + ".aidm"
+    reload = story.history.reads_from(path)
+    save = write_save_file(path, save_state(character, story))
+    if reload:
+        # The history was read from the file it has replaced
+        story.reload_history(save.state()["history"])
+    else:
+        save.close()
+    print(f"Your game has been saved to {path if story.save_dir is None else os.path.basename(path)}")
+
+@command("/read", "/read [file_name]", "Load an autosaved game, a [file_name].aidm file, or an old save of 2 txt files (story and character info). Without a name, lists the autosaved games.")
+def command_read(character: Character, story: Story, args: str):
+    file_name = args
+    if(file_name == ""):
+        print("Saved games: " + (", ".join(list_autosaves(story.save_dir or SAVE_DIR)[:10]) or "None"))
+        print("Use /read [name] to load one.")
+        return
+    success = load_saved_game(character, story, file_name)
+    if success:
+        print(f"Game loaded from {file_name}! Continuing the story...")
+        # Re-print all story for context
+        print("\n" + story.get_latest_event())
+
+@command("/events", "/events", "Shows key events happened")
+def command_events(character: Character, story: Story, args: str):
+    print("Events so far:")
+    for item in story.get_all_key_events():
+        print(f"- {item}")
+
+@command("/rule", "/rule [rule_type] [new_value]", "Update the game rule")
+def command_rule(character: Character, story: Story, args: str):
+    parts = args.split()
+    if len(parts) >= 2:
+        rule_key = parts[0]
+        new_value = " ".join(parts[1:])
+        try:
+            # Try to convert the new value to int
+            new_value = int(new_value)
+        except:
+            pass
+        try:
+            story.update_gamerule(rule_key, new_value)
+            print(f"Rules updated: {rule_key} = {new_value}")
+        except ValueError as e:
+            print(f"Invalid rule: {e}")
+    else:
+        print("Invalid rule command. Please use the format: /rule [rule_type] [new_value]")
+
+@command("/set", "/set [setting] [new_value]", "Show or update the engine settings (e.g. memory_token_budget)")
+def command_set(character: Character, story: Story, args: str):
+    parts = args.split()
+    if len(parts) >= 2:
+        setting_key = parts[0]
+        new_value = " ".join(parts[1:])
+        try:
+            new_value = int(new_value)
+        except:
+            try:
+                new_value = float(new_value)
+            except:
+                if new_value.lower() in ("true", "on"):
+                    new_value = True
+                elif new_value.lower() in ("false", "off"):
+                    new_value = False
+        if story.update_setting(setting_key, new_value):
+            print(f"Settings updated: {setting_key} = {new_value}")
+        else:
+            print(f"Invalid setting: {setting_key} = {new_value}")
+    else:
+        print("Settings:")
+        for key, value in story.settings.items():
+            print(f"{key}: {value}")
+        print("Use the format: /set [setting] [new_value] to update a setting")
+
+@command("/cache", "/cache [clear]", "Shows how often the prompt prefix is cached by the API, and the hits of the response cache (if it is on). /cache clear empties the response cache")
+def command_cache(character: Character, story: Story, args: str):
+    if args == "clear":
+        if response_cache is None:
+            print("The response cache is off.")
+        else:
+            response_cache.clear()
+            print("The response cache is empty.")
+        return
+    print_prompt_cache_stats()
+    if response_cache is not None:
+        response_cache.print_stats()
+
+@command("/stats", "/stats [export file]", "Shows the time, tokens and cost of the LLM calls by call site, or exports every call to a JSON lines file")
+def command_stats(character: Character, story: Story, args: str):
+    parts = args.split(maxsplit=1)
+    if parts and parts[0] == "export":
+        if len(parts) < 2:
+            print("Please provide a file name: /stats export file.jsonl")
+            return
+        # A server session can only export into its own folder
+        path = game_file(story, parts[1])
+        try:
+            count = story.telemetry.export_jsonl(path)
+        except OSError as e:
+            print(f"Could not export the calls: {e}")
+            return
+        print(f"{count} calls are exported to {path if story.save_dir is None else os.path.basename(path)}.")
+        return
+    story.telemetry.print_stats()
+
+@command("/route", "/route [call_site] [model,model,...|default]", "Shows the models each call site is routed to and how they have done, or changes the route of a call site in this game")
+def command_route(character: Character, story: Story, args: str):
+    parts = args.split()
+    routes = {**MODEL_ROUTES, **story.settings["model_routes"]}
+    if len(parts) >= 2:
+        site = parts[0]
+        game_routes = dict(story.settings["model_routes"])
+        if parts[1].lower() == "default":
+            game_routes.pop(site, None)
+        else:
+            models = [model for model in ",".join(parts[1:]).replace(" ", "").split(",") if model]
+            unknown = [model for model in models if model not in known_models()]
+            if unknown:
+                print(f"Unknown models: {', '.join(unknown)}. The models are {', '.join(sorted(known_models()))}")
+                return
+            game_routes[site] = models
+        story.update_setting("model_routes", game_routes)
+        print(f"Route updated: {site} -> {' > '.join(site_route(site, {**MODEL_ROUTES, **game_routes})[1])}")
+        return
+    if len(parts) == 1:
+        key, models = site_route(parts[0], routes)
+        print(f"{parts[0]} -> {' > '.join(models)} (route of {key}{', set in this game' if key in story.settings['model_routes'] else ''})")
+    else:
+        print("Routes (a model is used when the ones before it fail):")
+        for site, models in routes.items():
+            print(f"{site}: {' > '.join(models)}{' (set in this game)' if site in story.settings['model_routes'] else ''}")
+    rows = story.telemetry.by_model(parts[0] if parts else None)
+    if rows:
+        print(f"\n{'Call site':<22}{'Model':<16}{'Calls':>6}{'Fallback':>9}{'Failed':>7}{'TTFT':>8}{'Mean':>8}")
+        for row in rows:
+            ttft = f"{row['mean_ttft']:.2f}s" if row["mean_ttft"] is not None else "-"
+            print(f"{row['site']:<22}{row['model']:<16}{row['calls']:>6}{row['fallbacks']:>9}{row['errors']:>7}{ttft:>8}{row['mean_duration']:>7.2f}s")
+    print("Use the format: /route [call_site] [model,model,...] to change a route in this game, or /route [call_site] default to reset it")
+
+@command("/recall", "/recall [text]", "Shows the earlier passages of the story that are fed into the next prompt (or the ones relevant to the text)")
+def command_recall(character: Character, story: Story, args: str):
+    query = args or f"{story.get_latest_player_action()} {story.get_latest_event()}"
+    passages = story.get_recall(query)
+    if not passages:
+        print("Nothing earlier in the story is relevant.")
+        return
+    print("Earlier in the story:")
+    for passage in passages:
+        print(f"- {passage}")
+
+@command("/odds", "/odds [attribute] [requirement]", "Shows the range of your rolls and the chance to pass a requirement")
+def command_odds(character: Character, story: Story, args: str):
+    selectedAttribute, requirement = None, None
+    for part in args.split():
+        if part.lstrip("-").isdigit():
+            requirement = int(part)
+        else:
+            selectedAttribute = next((attr for attr in story.gameruledict["attributes"] if attr.lower() == part.lower()), None)
+            if selectedAttribute is None:
+                print(f"Unknown attribute: {part}. The attributes are {story.gameruledict['attributes']}")
+                return
+    print_odds(character, story, selectedAttribute, requirement)
 
-    return uinput
+# Command of listing all commands
+@command("/help", "/help", "Shows all commands")
+def command_help(character: Character, story: Story, args: str):
+    print("\nHelp commands:")
+    for entry in commands.values():
+        print(f"{entry['usage']} -> {entry['description']}")
 
 def load_saved_game(player: Character, story: Story, file_name: str):
-    """Load saved game from files"""
+    """Load saved game from files (an autosave, a .aidm save file, or the txt files of older versions)"""
     try:
+        # An autosave is given by its name, a save file by its path
+        if os.path.basename(file_name) == file_name and load_autosave(player, story, file_name):
+            return True
+        file_name = game_file(story, file_name)
+        if os.path.exists(file_name + ".aidm"):
+            state = SaveFile(file_name + ".aidm").state()
+            # The game being played stops autosaving before it is replaced, so the loaded game is not written into its journal
+            detach_journal(player, story)
+            restore_state(player, story, state)
+            start_autosave(player, story)
+            return True
         # Load story
         story_file = file_name + ".txt"
         with open(story_file, 'r', encoding='utf-8') as file:
-            story.history = [line.strip() for line in file.readlines() if line.strip()]
+            events = [line.strip() for line in file.readlines() if line.strip()]
         
         # Load character
         chara_file = file_name + "_chara.txt"
         with open(chara_file, 'r', encoding='utf-8') as file:
             chara_data = file.read()
-            
-            # Extract character properties
-            player.name = extract_response(chara_data, "Name")
-            player.classtype = extract_response(chara_data, "Classtype")
-            player.race = extract_response(chara_data, "Race")
-            player.alignment = extract_response(chara_data, "Alignment")
-            player.hp = int(extract_response(chara_data, "HP"))
-            player.golds = int(extract_response(chara_data, "Golds"))
-            # Debug prints (optional)
-            # hp_str = extract_response(chara_data, "HP:")
-            # print("Debug: Extracted HP:", hp_str)
-            # player.hp = int(hp_str) if hp_str else 0
-            
-            # golds_str = extract_response(chara_data, "Golds:")
-            # print("Debug: Extracted Golds:", golds_str)
-            # player.golds = int(golds_str) if golds_str else 0
-            
-            # Extract attributes
-            player.attributes = {
-                "Strength": int(extract_response(chara_data, "Strength")),
-                "Intelligence": int(extract_response(chara_data, "Intelligence")),
-                "Speed": int(extract_response(chara_data, "Speed")),
-                "Charisma": int(extract_response(chara_data, "Charisma"))
-            }
-            
-            # Extract skills
-            skills_section = chara_data.split("Skills:")[1]
-            skills = {}
-            current_skill = None
-            for line in skills_section.split('\n'):
-                line = line.strip()
-                if line.endswith(':'):
-                    current_skill = line[:-1]
-                    skills[current_skill] = ""
-                elif current_skill:
-                    skills[current_skill] += line + '\n'
-            player.skills = {k: v.strip() for k, v in skills.items() if k}
-            
+        detach_journal(player, story)
+        story.history = EventLog(events)
+        
+        # Extract character properties
+        player.name = extract_response(chara_data, "Name")
+        player.classtype = extract_response(chara_data, "Classtype")
+        player.race = extract_response(chara_data, "Race")
+        player.alignment = extract_response(chara_data, "Alignment")
+        player.hp = int(extract_response(chara_data, "HP"))
+        player.golds = int(extract_response(chara_data, "Golds"))
+        # Debug prints (optional)
+        # hp_str = extract_response(chara_data, "HP:")
+        # print("Debug: Extracted HP:", hp_str)
+        # player.hp = int(hp_str) if hp_str else 0
+        
+        # golds_str = extract_response(chara_data, "Golds:")
+        # print("Debug: Extracted Golds:", golds_str)
+        # player.golds = int(golds_str) if golds_str else 0
+        
+        # Extract attributes
+        # Every "name: value" line between "Attributes:" and "Alignment:" (the attributes may be custom)
+        attributes_section = chara_data[chara_data.find("Attributes:") + 11 : chara_data.find("Alignment:")]
+        player.attributes = {key.strip(): int(value) for key, value in
+                             (line.split(":", 1) for line in attributes_section.split("\n") if ":" in line)}
+        
+        # Extract skills
+        skills_section = chara_data.split("Skills:")[1]
+        skills = {}
+        current_skill = None
+        for line in skills_section.split('\n'):
+            line = line.strip()
+            if line.endswith(':'):
+                current_skill = line[:-1]
+                skills[current_skill] = ""
+            elif current_skill:
+                skills[current_skill] += line + '\n'
+        player.skills = {k: v.strip() for k, v in skills.items() if k}
+        
+        start_autosave(player, story)
         return True
     except FileNotFoundError:
         print(f"Error: Save files '{file_name}' not found!")
@@ -336,19 +1174,668 @@ def load_saved_game(player: Character, story: Story, file_name: str):
         print(f"Error loading game: {str(e)}")
         return False
 
+# Save files (.aidm) are indexed so a game can be resumed without reading its whole history:
+#   "AIDMSAVE", format version, header size | header (JSON: character, attributes, key events, game rule, ...)
+#   | history entries (each: size, kind code (EVENT_KINDS), UTF-8 text) | index (offset of each entry) | index offset, entry count, "AIDMEND"
+# The file is memory-mapped and the header read at once. A history entry is only read when something asks for it.
+SAVE_MAGIC = b"AIDMSAVE"
+SAVE_END = b"AIDMEND\0"
+SAVE_VERSION = 2 # Version 1 has no kind code in the entries
+SAVE_HEADER = struct.Struct("<8sII")
+SAVE_ENTRY = struct.Struct("<I")
+SAVE_OFFSET = struct.Struct("<Q")
+SAVE_TRAILER = struct.Struct("<QQ8s")
+
+class SaveFile:
+    """A memory-mapped save file. Raise ValueError if the file is not a complete save"""
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < SAVE_HEADER.size + SAVE_TRAILER.size:
+            self.map.close()
+            raise ValueError(f"{path} is not a save file")
+        magic, version, header_size = SAVE_HEADER.unpack_from(self.map, 0)
+        self.index_offset, self.count, end = SAVE_TRAILER.unpack_from(self.map, len(self.map) - SAVE_TRAILER.size)
+        if magic != SAVE_MAGIC or end != SAVE_END:
+            self.map.close()
+            raise ValueError(f"{path} is not a complete save file")
+        if version > SAVE_VERSION:
+            self.map.close()
+            raise ValueError(f"{path} was saved by a newer version of the game (format {version})")
+        self.version = version
+        self.header = json.loads(self.map[SAVE_HEADER.size : SAVE_HEADER.size + header_size])
+
+    def raw(self, i: int):
+        """Return the bytes of history entry i"""
+        offset = SAVE_OFFSET.unpack_from(self.map, self.index_offset + i * SAVE_OFFSET.size)[0]
+        size = SAVE_ENTRY.unpack_from(self.map, offset)[0]
+        return self.map[offset + SAVE_ENTRY.size : offset + SAVE_ENTRY.size + size]
+
+    def state(self):
+        """Return the saved state, with the history read lazily from the file"""
+        history = EventLog(save=self, latest=self.header.get("latest"))
+        if "latest" not in self.header:
+            # Version 1: find the latest action and narration from the end
+            for i in range(self.count - 1, -1, -1):
+                history.latest.setdefault(history.entry(i)[0], i)
+                if len(history.latest) == 2:
+                    break
+        return dict(self.header, history=history)
+
+    def close(self):
+        self.map.close()
+
+def write_save_file(path: str, state: dict, close_history = False):
+    """Write a state (as returned by save_state) into a save file and return it (SaveFile).
+    It is written into a temporary file first and replaces the file only once it is complete. The history is closed once it has been copied
+    when close_history is True or when it is read from the replaced file (read it from the returned file then)
+    """
+    history = state["history"] if isinstance(state["history"], EventLog) else EventLog(state["history"])
+    header = json.dumps(dict({key: value for key, value in state.items() if key != "history"}, latest=history.latest), ensure_ascii=False).encode('utf-8')
+    offsets = []
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        file.write(SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, len(header)))
+        file.write(header)
+        position = SAVE_HEADER.size + len(header)
+        for i in range(len(history)):
+            # The entries of a loaded history are copied without decoding them
+            data = history.raw(i)
+            offsets.append(position)
+            file.write(SAVE_ENTRY.pack(len(data)))
+            file.write(data)
+            position += SAVE_ENTRY.size + len(data)
+        file.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        file.write(SAVE_TRAILER.pack(position, len(offsets), SAVE_END))
+        file.flush()
+        os.fsync(file.fileno())
+    if close_history or history.reads_from(path):
+        # The history has been copied. The file can not be replaced while it is mapped (on Windows)
+        history.close()
+    os.replace(temp_path, path)
+    return SaveFile(path)
+
+# Autosaves: every change of a game is appended to a journal (one JSON record per line) and synced to disk once per turn.
+# Every few turns the whole state is written as a snapshot (a save file) and the journal starts again, so a save only costs what has changed.
+SAVE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "saves")
+
+class Journal:
+    """Append-only journal of a game, with periodic snapshots
+
+    Args:
+        name (str): The name of the save (the files are <name>.journal and the snapshot <name>.aidm)
+        folder (str): The folder of the saves, default is SAVE_DIR
+    """
+    def __init__(self, name: str, folder = SAVE_DIR):
+        self.name = name
+        self.journal_path = os.path.join(folder, name + ".journal")
+        self.snapshot_path = os.path.join(folder, name + ".aidm")
+        self.seq = 0 # Number of the latest record
+        self.turns = 0 # Turns since the last snapshot
+        self.size = 0 # Size of the journal since the last snapshot (characters written)
+        self.snapshot_size = 0
+        self.file = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Open the journal to append records"""
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        self.file = open(self.journal_path, 'a', encoding='utf-8')
+
+    def append(self, record: dict):
+        """Write a record. It is on disk after the next sync()"""
+        with self.lock:
+            self.seq += 1
+            line = json.dumps(dict(record, seq=self.seq), ensure_ascii=False) + "\n"
+            self.file.write(line)
+            self.size += len(line)
+
+    def sync(self):
+        """Flush the records written since the last sync to disk (one fsync for the whole turn)"""
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def snapshot(self, state: dict):
+        """Write the whole state and start the journal again. The snapshot replaces the old one only once it is complete.
+        Return the new snapshot (SaveFile)
+        """
+        with self.lock:
+            # The history (copied into the snapshot) is read from the snapshot from now on
+            save = write_save_file(self.snapshot_path, dict(state, seq=self.seq), close_history=True)
+            self.snapshot_size = os.path.getsize(self.snapshot_path)
+            self.turns, self.size = 0, 0
+            # The records are in the snapshot now. If this is interrupted, the records are skipped by their seq when loading
+            self.file.close()
+            self.file = open(self.journal_path, 'w', encoding='utf-8')
+            return save
+
+    def load(self):
+        """Read the snapshot and the records written after it. A record cut off by a crash is dropped from the journal.
+        Return (the snapshot (SaveFile) or None, the list of records)
+        """
+        save, records = None, []
+        if os.path.exists(self.snapshot_path):
+            save = SaveFile(self.snapshot_path)
+            self.seq = save.header.get("seq", 0)
+            self.snapshot_size = os.path.getsize(self.snapshot_path)
+        if os.path.exists(self.journal_path):
+            valid_size = 0
+            with open(self.journal_path, 'rb') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+                    if record["seq"] > self.seq:
+                        records.append(record)
+                        self.seq = record["seq"]
+            if valid_size < os.path.getsize(self.journal_path):
+                os.truncate(self.journal_path, valid_size)
+            self.size = valid_size
+        return save, records
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def save_state(player: Character, story: Story):
+    """Return the whole state of a game as a dict that can be written into a save file"""
+    story.collect_key_events(wait=False)
+    chapters = []
+    for level, chapter in story.chapters:
+        if isinstance(chapter, Future):
+            try:
+                chapter = chapter.result()
+            except Exception:
+                chapter = ""
+        chapters.append([level, chapter])
+    return {
+        "character": player.to_dict(),
+        "history": story.history,
+        "keyevents": story.keyevents,
+        "chapters": chapters,
+        "compacted_keyevents": story.compacted_keyevents,
+        "npcs": [npc.to_dict() for npc in story.characters],
+        "gameruledict": story.gameruledict,
+        "settings": story.settings
+    }
+
+def restore_state(player: Character, story: Story, state: dict):
+    """Set the game to a state returned by save_state"""
+    for key, value in state["character"].items():
+        setattr(player, key, value)
+    # A history loaded from a save file stays there until it is read
+    story.history = state["history"] if isinstance(state["history"], EventLog) else EventLog(state["history"])
+    story.keyevents = list(state["keyevents"])
+    story.chapters = [list(chapter) for chapter in state["chapters"]]
+    story.compacted_keyevents = state["compacted_keyevents"]
+    story.characters = [Character(**npc) for npc in state["npcs"]]
+    story.gameruledict = state["gameruledict"]
+    story.settings.update(state["settings"])
+    story.compile_gamerule()
+
+def apply_record(player: Character, story: Story, record: dict):
+    """Redo a change written in the journal"""
+    kind = record["type"]
+    if kind == "event":
+        story.history.append(record["text"], record.get("kind"))
+    elif kind == "keyevent":
+        story.keyevents.append(record["text"])
+    elif kind == "hp":
+        player.hp = record["value"]
+    elif kind == "golds":
+        player.golds = record["value"]
+    elif kind == "skill":
+        player.skills[record["name"]] = record["description"]
+    elif kind == "npc":
+        story.characters.append(Character(**record["character"]))
+    elif kind == "rules":
+        story.gameruledict = record["rules"]
+        story.compile_gamerule()
+    elif kind == "setting":
+        story.settings[record["key"]] = record["value"]
+
+def attach_journal(player: Character, story: Story, journal: Journal):
+    player.journal = journal
+    story.journal = journal
+
+def detach_journal(player: Character, story: Story):
+    """Stop autosaving the game (before another game is loaded into it)"""
+    journal = story.journal
+    player.journal = story.journal = None
+    if journal:
+        journal.close()
+
+def snapshot_game(player: Character, story: Story):
+    """Write a snapshot of the game. The history is then read from the snapshot"""
+    story.reload_history(story.journal.snapshot(save_state(player, story)).state()["history"])
+
+def start_autosave(player: Character, story: Story):
+    """Start the autosave of a new game (after the character is created)"""
+    if not story.settings["autosave"]:
+        return
+    name = re.sub(r"[^\w-]", "_", player.name) + time.strftime("_%Y%m%d-%H%M%S")
+    journal = Journal(name, story.save_dir or SAVE_DIR)
+    journal.open()
+    attach_journal(player, story, journal)
+    snapshot_game(player, story)
+
+def autosave(player: Character, story: Story):
+    """Save the changes of the turn. Called whenever the game waits for the player's input"""
+    journal = story.journal
+    if journal is None:
+        return
+    # Record the key events summarized in the background so far
+    story.collect_key_events(wait=False)
+    journal.turns += 1
+    # The whole game is only written again once the journal has grown in proportion to it: the snapshots cost about as much as the changes
+    if journal.turns >= story.settings["autosave_snapshot_turns"] and journal.size >= story.settings["autosave_snapshot_ratio"] * journal.snapshot_size:
+        snapshot_game(player, story)
+    else:
+        journal.sync()
+
+def load_autosave(player: Character, story: Story, name: str):
+    """Load an autosave: the latest snapshot and the changes journaled after it. Return False if there is no such save"""
+    journal = Journal(name, story.save_dir or SAVE_DIR)
+    save, records = journal.load()
+    if save is None and not records:
+        return False
+    # The changes are restored with no journal attached, so they are not written again
+    detach_journal(player, story)
+    if save:
+        restore_state(player, story, save.state())
+    for record in records:
+        apply_record(player, story, record)
+    story.compact_key_events()
+    journal.open()
+    attach_journal(player, story, journal)
+    # The snapshot holds the whole loaded game, so the autosave is complete from now on
+    snapshot_game(player, story)
+    return True
+
+def list_autosaves(folder = SAVE_DIR):
+    """Return the names of the autosaves in a folder, the latest first"""
+    if not os.path.isdir(folder):
+        return []
+    saves = {}
+    for file_name in os.listdir(folder):
+        for suffix in (".journal", ".aidm"):
+            if file_name.endswith(suffix):
+                name = file_name[:-len(suffix)]
+                saves[name] = max(saves.get(name, 0), os.path.getmtime(os.path.join(folder, file_name)))
+    return sorted(saves, key=saves.get, reverse=True)
+
+# The stable instructions are sent as the system message, always first and with the same wording, so that
+# the provider can cache the prompt prefix. Only the variable parts of a prompt are sent as the user message.
+DM_PERSONA = "You're a Dungeon Master of a heroic saga, creating a Dungeons and Dragons (D&D) story for the player."
+WRITING_STYLE = "Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people."
+KEYEVENT_INSTRUCTION = """You're a Dungeon Master of a heroic saga. The user gives you your latest generation. Based on this, summarize this event in 1 or 2 sentences. You should only return and summarize it in 1 or 2 sentences.
+Write in second person present tense (you are), avoiding letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people."""
+CHAPTER_INSTRUCTION = """You're a Dungeon Master of a heroic saga. The user gives you the key events of the story so far, from the oldest to the latest. Summarize them into one short chapter summary in 2 or 3 sentences. Keep the names of the important characters, places and items, and what the player has gained or lost.
+Write in second person present tense (you are). You should only return the summary."""
+
+CHECK_EVENT_RULES = """You, As the Dungeon Master, analyze the latest story context and the player's latest action provided by the user to determine the next event type.
+
+Event Type Selection Rules:
+Choose ONLY ONE of these 5 event types:
+
+1. Casual Event
+
+Trigger: Player interaction aligns with non-hostile NPC assistance/rewards.
+Examples:
+A traveling cleric offers free healing potions.
+A village elder shares critical story information.
+A friendly creature provides navigation help.
+
+2. Trade
+
+Trigger: Player demonstrates resource-seeking behavior.
+Examples:
+A merchant proposes item exchanges (e.g., “3 wolf pelts for a better sword”).
+A blacksmith offers weapon upgrades for rare materials.
+A mystic trades scrolls for completed quests.
+
+3. Encounter
+
+Trigger: Environmental/contextual hostility without direct player provocation.
+Examples:
+Bandits ambush the player on the road.
+Territorial beasts block a mountain pass.
+Cursed spirits manifest in ancient ruins.
+
+4. Battle
+
+Trigger: Player explicitly initiates combat.
+Examples:
+Player attacks a guarded enemy camp.
+Player challenges a tavern bully.
+Player attempts to steal from armed guards.
+
+5. None
+
+Trigger: No event insertion required for narrative continuity.
+Conditions:
+Story progression doesn't require interruption.
+Player action is purely transitional (e.g., “I keep walking northwest”).
+Existing plot threads need time to develop organically.
+
+Validation Checklist:
+Event type strictly matches one of the 5 defined categories
+“None” is only used when all other types are contextually inappropriate
+Player agency from the player's latest action is preserved
+Event severity escalates/de-escalates appropriately based on story progression
+
+All you need to do is just generate the event type, do not generate any content of the future event."""
+
+def session_prefix(player: Character, story: Story):
+    """Return the stable context of the session (DM persona, writing style, background, game rule and the player's character).
+    It is byte-identical for every story prompt of the session until the game rule changes.
+    """
+    return (f"{DM_PERSONA}\n{WRITING_STYLE}\n\n"
+            f"Background of the world: \"{story.get_background()}\"\n\n"
+            f"Game rule: \"{story.get_gamerule()}\"\n\n"
+            f"Player's character: \"{player.profileInfo()}\"")
+
+def story_messages(player: Character, story: Story, content: str):
+    """Build the messages of a story prompt: the session prefix as the system message, then the player's current state,
+    the earlier passages relevant to the player's latest action (see Story.get_recall) and the content
+    """
+    recall = story.get_recall(f"{story.get_latest_player_action()} {story.get_latest_event()}")
+    recalled = "".join(f"\n- {passage}" for passage in recall)
+    earlier = f"Earlier in the story (for continuity, only if it matters now):{recalled}\n" if recall else ""
+    return [{'role': 'system', 'content': session_prefix(player, story)},
+            {'role': 'user', 'content': f"Player's current state: \"{player.stateInfo()}\"\n{earlier}{content}"}]
+
+# Chapter summaries wait for the key events they summarize, so they are generated in worker threads
+keyevent_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="keyevent")
+
+def keyEventMessages(response: str):
+    return [{'role': 'system', 'content': KEYEVENT_INSTRUCTION},
+            {'role': 'user', 'content': f'Your latest generation: "{response}"'}]
+
 def generateKeyEvent(response: str):
-    keyevent = gpt([{'role': 'user','content':
-                                   f"""You're a Dungeon Master of a heroic saga. This is your latest generation: "{response}". Based on this, summarize this event in 1 or 2 sentences. You should only return and summarize it in 1 or 2 sentences.
-                                     Write in second person present tense (you are), avoiding letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=False)
+    keyevent = gpt(keyEventMessages(response), printChunk=False, site="keyevent")
     return keyevent
+
+def generateKeyEventAsync(response: str):
+    """Summarize the event in the background. Return a Future of the key event that can be passed to Story.add_key_event"""
+    return gpt_async(keyEventMessages(response), site="keyevent")
+
+# The key event trailer: a narration ends with a line "[KEY EVENT] summary", which is hidden from the player and stored as the key event.
+# The separate summary call (generateKeyEventAsync) is only made when the trailer is missing
+KEYEVENT_MARKER = "[KEY EVENT]"
+KEYEVENT_TRAILER = re.compile(re.escape(KEYEVENT_MARKER) + r":?[ \t]*([^\n]*)", re.IGNORECASE)
+
+def keyevent_instruction(story: Story):
+    """Return the instruction that asks for the key event trailer (empty when the trailer is off)"""
+    if not story.settings["keyevent_trailer"]:
+        return ""
+    return (f"\nRight after the story text (before the JSON block of the game data, if you write one), write one line that starts with {KEYEVENT_MARKER} "
+            "and summarizes this generation in 1 or 2 sentences, in second person present tense (you are). The player does not see this line.")
+
+def read_keyevent(response: str):
+    """Split the key event trailer off a response.
+    Return (the response without the trailer, the key event). The key event is a Future of a separate summary when there is no trailer
+    """
+    match = KEYEVENT_TRAILER.search(response)
+    if match is None:
+        return response, generateKeyEventAsync(strip_structured(response))
+    keyevent = match.group(1)
+    if JSON_MARKER in keyevent:
+        keyevent = keyevent[:keyevent.find(JSON_MARKER)]
+    response = response[:match.start()].rstrip() + "\n" + response[match.end():].lstrip("\n")
+    keyevent = keyevent.strip()
+    return response, keyevent if keyevent else generateKeyEventAsync(strip_structured(response))
+
+def generateChapter(events: list):
+    """Summarize a list of key events (or chapter summaries) into one chapter summary"""
+    # The events may still be generated in the background
+    events = [event.result() if isinstance(event, Future) else event for event in events]
+    chapter = gpt([{'role': 'system', 'content': CHAPTER_INSTRUCTION},
+                   {'role': 'user', 'content': f'Key events: "{events}"'}], printChunk=False, site="chapter")
+    return chapter
+
+def generateChapterAsync(events: list):
+    """Summarize the key events into a chapter in the background. Return a Future of the chapter summary"""
+    # Run it in the context of the game (so the call is counted into the game's telemetry)
+    return keyevent_executor.submit(contextvars.copy_context().run, generateChapter, events)
     
 
-def startDM(player: Character, story: Story):
-    player.story = story  # 添加故事引用
-    player.init_attributes()
-    response = gpt([{'role': 'user','content':
-                                   f"""You're a Dungeon Master of a heroic saga. Create a background for this Dungeon and Dragon game. Your background should describe the setting where the adventure takes place, including its geography, cultures, and history.
+# Structured output: the game data of a response (option, enemy, reward, damage) is written as a JSON block after the story text.
+# It is hidden from the player while streaming and read by one validated parser instead of searching the text.
+JSON_MARKER = "```"
+
+def structured_form(kind: str, story: Story):
+    """Return an example of the JSON data of a kind, and notes on its fields"""
+    attributes = story.gameruledict["attributes"]
+    skill = {"name": "Pursue and Empower", "attribute": attributes[0], "description": "A dynamic ability that enhances your capacity to chase down enemies.", "value": 6}
+    forms = {
+        "option": ({"option": "Intimidate the Wolves", "attribute": attributes[0], "requirement": 18},
+                   f"attribute is one of {attributes}. requirement is the dice total the player has to pass."),
+        "battle_option": ({"option": "Draws your longsword and charges at the wolves", "attribute": attributes[0]},
+                          f"attribute is one of {attributes}."),
+        "enemy": ({"name": "Grey Wolves", "classtype": "Pack Hunter", "race": "beasts", "alignment": "Neutral", "hp": 60,
+                   "attributes": {attr: 3 for attr in attributes}, "description": "A pack of hungry wolves."},
+                  f"attributes has a whole number from 1 to {story.gameruledict['max_attribute_point']} for each of {attributes}. hp is from 20 to 200."),
+        "character": ({"classtype": "Bard", "race": "Half-elf", "alignment": "Chaotic Good", "attributes": {attr: 3 for attr in attributes},
+                       "description": "A wandering singer who collects the old songs of the empire."},
+                      f"attributes has a whole number from 1 to {story.gameruledict['max_attribute_point']} for each of {attributes}."),
+        "changes": ({"golds": 50, "hp": -20, "new_skill": None},
+                    f"golds and hp are what the player gains (positive) or loses (negative), 0 if nothing changes. new_skill is null, or the skill the player learns, like {json.dumps(skill)} (attribute is one of {attributes}, value is the points added to the rolls)."),
+        "outcome": ({"action": "attack", "damage": 30, "hp": 0},
+                    'action is "attack", "heal" or "escape". damage is the damage given to the enemy and hp is the HP the player heals, 0 if none.'),
+        "damage": ({"damage": 15}, "damage is the damage given to the player.")
+    }
+    return forms[kind]
+
+def structured_instruction(kind: str, story: Story):
+    """Return the instruction that asks for the JSON block of a kind (empty when structured output is off)"""
+    if not story.settings["structured_output"]:
+        return ""
+    example, notes = structured_form(kind, story)
+    return (f"\nAfter everything else, write the game data of your generation as a JSON object between a line {JSON_MARKER}json and a line {JSON_MARKER}, in this form: {json.dumps(example)}\n"
+            f"{notes} The player does not see this block, so write all the information in the story text as well.")
+
+def strip_structured(response: str):
+    """Return the story text of a response without the JSON block"""
+    index = response.find(JSON_MARKER)
+    return response if index < 0 else response[:index].rstrip() + "\n"
+
+def find_json_block(response: str):
+    """Parse the JSON object at the end of a response (or the whole response)"""
+    index = response.find(JSON_MARKER)
+    if index >= 0:
+        response = response[index + len(JSON_MARKER):]
+        if response.lower().startswith("json"):
+            response = response[4:]
+        end = response.find(JSON_MARKER)
+        if end >= 0:
+            response = response[:end]
+    start, end = response.find("{"), response.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("there is no JSON object")
+    try:
+        return json.loads(response[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"it is not valid JSON ({e})")
+
+def validate_structured(data, kind: str, story: Story):
+    """Check the JSON data of a kind. Return it with the numbers as int and the attributes spelled as in the game rule.
+    Raise ValueError that says what is wrong
+    """
+    if not isinstance(data, dict):
+        raise ValueError("it is not a JSON object")
+    attributes = story.gameruledict["attributes"]
+
+    def number(source, key, low = None, high = None, default = None):
+        value = source.get(key, default)
+        if isinstance(value, str):
+            try:
+                value = int(value.strip().replace("+", ""))
+            except ValueError:
+                pass
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise ValueError(f'"{key}" must be a whole number')
+        if (low is not None and value < low) or (high is not None and value > high):
+            raise ValueError(f'"{key}" must be from {low} to {high}' if high is not None else f'"{key}" must be at least {low}')
+        return value
+
+    def attribute(source, key = "attribute"):
+        value = str(source.get(key, "")).strip().lower()
+        for attr in attributes:
+            if attr.lower() == value:
+                return attr
+        raise ValueError(f'"{key}" must be one of {attributes}')
+
+    def text(source, key, default = None):
+        value = source.get(key, default)
+        if not isinstance(value, str) or (default is None and not value.strip()):
+            raise ValueError(f'"{key}" must be a text')
+        return value.strip()
+
+    if kind == "option":
+        return {"option": text(data, "option"), "attribute": attribute(data), "requirement": number(data, "requirement", low=0)}
+    if kind == "battle_option":
+        return {"option": text(data, "option"), "attribute": attribute(data)}
+    if kind == "enemy":
+        if not isinstance(data.get("attributes"), dict):
+            raise ValueError(f'"attributes" must be an object with {attributes}')
+        enemy_attributes = {key.strip().lower(): value for key, value in data["attributes"].items()}
+        return {"name": text(data, "name"), "classtype": text(data, "classtype", ""), "race": text(data, "race", ""),
+                "alignment": text(data, "alignment", ""), "description": text(data, "description", ""), "hp": number(data, "hp", low=1),
+                "attributes": {attr: number(enemy_attributes, attr.lower(), low=1, high=story.gameruledict["max_attribute_point"]) for attr in attributes}}
+    if kind == "character":
+        if not isinstance(data.get("attributes"), dict):
+            raise ValueError(f'"attributes" must be an object with {attributes}')
+        character_attributes = {key.strip().lower(): value for key, value in data["attributes"].items()}
+        return {"classtype": text(data, "classtype"), "race": text(data, "race"), "alignment": text(data, "alignment", ""), "description": text(data, "description", ""),
+                "attributes": {attr: number(character_attributes, attr.lower(), low=1, high=story.gameruledict["max_attribute_point"]) for attr in attributes}}
+    if kind == "changes":
+        skill = data.get("new_skill")
+        if skill is not None:
+            if not isinstance(skill, dict):
+                raise ValueError('"new_skill" must be null or an object')
+            skill = {"name": text(skill, "name"), "attribute": attribute(skill), "description": text(skill, "description", ""), "value": number(skill, "value", low=0)}
+        return {"golds": number(data, "golds", default=0), "hp": number(data, "hp", default=0), "new_skill": skill}
+    if kind == "outcome":
+        action = str(data.get("action", "")).strip().lower()
+        if action not in ("attack", "heal", "escape"):
+            raise ValueError('"action" must be "attack", "heal" or "escape"')
+        return {"action": action, "damage": number(data, "damage", low=0, default=0), "hp": number(data, "hp", low=0, default=0)}
+    if kind == "damage":
+        return {"damage": number(data, "damage", low=0)}
+    raise ValueError(f"unknown kind: {kind}")
+
+def read_structured(story: Story, messages: list, response: str, kind: str):
+    """Read the JSON block of a response in one pass. If it is missing or invalid, the model is asked for only the corrected JSON
+    (with what was wrong), so the story is not generated again.
+    Return the data, or None when structured output is off or the data still can not be read (the caller then reads the text)
+    """
+    if not story.settings["structured_output"]:
+        return None
+    try:
+        return validate_structured(find_json_block(response), kind, story)
+    except ValueError as e:
+        error = str(e)
+    example, notes = structured_form(kind, story)
+    for i in range(story.settings["structured_retries"]):
+        fixed = gpt(messages + [{'role': 'assistant', 'content': response},
+                                {'role': 'user', 'content': f"The game data of your generation can not be read: {error}. Reply with only the corrected JSON object, in this form: {json.dumps(example)}\n{notes}"}],
+                    printChunk=False, model=story.settings["structured_model"], response_format={"type": "json_object"}, site=f"structured.{kind}")
+        try:
+            return validate_structured(find_json_block(fixed), kind, story)
+        except ValueError as e:
+            error = str(e)
+    return None
+
+class StreamFields:
+    """Incremental parser of a streamed response. Each finished line is read for the fields that are still missing,
+    so a field is known as soon as its line has been streamed.
+
+    Args:
+        fields (dict): Field name -> function(line) that returns the value of the field in the line, or None
+        on_field: Called as on_field(name, value) when a field is found
+        stop (bool): gpt() stops the generation (and cancels the request) as soon as every field is found
+    """
+    def __init__(self, fields: dict, on_field = None, stop = True):
+        self.fields = fields
+        self.on_field = on_field
+        self.stop = stop
+        self.values = {}
+        self.pending = ""
+
+    @property
+    def complete(self):
+        return len(self.values) == len(self.fields)
+
+    def feed(self, text: str):
+        self.pending += text
+        *lines, self.pending = self.pending.split("\n")
+        for line in lines:
+            self.read_line(line)
+
+    def finish(self):
+        """Read the last line (the response does not always end with a new line)"""
+        if self.pending:
+            self.read_line(self.pending)
+        self.pending = ""
+
+    def read_line(self, line: str):
+        for name, read in self.fields.items():
+            if name not in self.values:
+                value = read(line)
+                if value is not None:
+                    self.values[name] = value
+                    if self.on_field:
+                        self.on_field(name, value)
+
+OPTION_LINE = re.compile(r"Option\W*(.+?)\s*\(([^()]+)\)", re.IGNORECASE)
+ROLL_REQUIREMENT = re.compile(r"Roll\b.*>\s*\**\s*(\d+)", re.IGNORECASE)
+
+def option_fields(story: Story, roll = True):
+    """Return the StreamFields fields of an option: "option" is (name, attribute) from the line "Option: name (attribute)",
+    "requirement" is the number after ">" in the Roll line (or, when roll is False, "roll" is True at the Roll line)
+    """
+    attributes = story.gameruledict["attributes"]
+
+    def option(line):
+        match = OPTION_LINE.search(line)
+        if match is None:
+            return None
+        attribute = next((attr for attr in attributes if attr.lower() == match.group(2).strip().lower()), None)
+        return (match.group(1).strip(" :*\"'"), attribute) if attribute else None
+
+    def requirement(line):
+        match = ROLL_REQUIREMENT.search(line)
+        return int(match.group(1)) if match else None
+
+    def roll_line(line):
+        return True if line.strip(" *").lower().startswith("roll") else None
+
+    return {"option": option, "requirement": requirement} if roll else {"option": option, "roll": roll_line}
+
+def apply_changes(player: Character, story: Story, changes: dict):
+    """Apply the golds, HP and new skill of the "changes" data to the player"""
+    player.golds += changes["golds"]
+    player.hp += changes["hp"]
+    skill = changes["new_skill"]
+    if skill:
+        effect = story.gameruledict["skill_impact"]["format"].format(value=skill["value"], attribute=skill["attribute"])
+        player.add_skill(f'{skill["name"]} ({skill["attribute"]})', f'Skill Description: {skill["description"]}\nEffect: {effect}.')
+        print("\nYour skills are updated:")
+        player.printCharaInfo()
+
+
+def world_messages(story: Story):
+    """The messages that create the world background and the 4 characters to choose from. They do not depend on the player's name"""
+    return [{'role': 'system', 'content': f"{DM_PERSONA}\n{WRITING_STYLE}"}, {'role': 'user','content':
+                                   f"""Create a background for this Dungeon and Dragon game. Your background should describe the setting where the adventure takes place, including its geography, cultures, and history.
                                    At the end, randomly generate 4 characters to let the player choose their characters. The characters you generated should have reasonable properties and attributes, and the characters generated should be in this form:
                                    "
                                    Character 1
@@ -359,8 +1846,90 @@ def startDM(player: Character, story: Story):
                                    """Alignment: Lawful, Neutral, Chaotic, Good, Evil, etc.
                                    Description: A short description for this character
                                    "
-                                   Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type). Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type).
+                                   """},]
+
+CHARACTER_HEADER = re.compile(r"^\W*Character\s+(\d+)\W*$", re.MULTILINE | re.IGNORECASE)
+CHARACTER_FIELDS = ("Classtype", "Race", "Alignment", "Description")
+
+def parse_character(text: str, story: Story):
+    """Read a character block (Classtype, Race, Attributes, Alignment, Description) into a Character without a name.
+    The attributes have to be the ones of the game rule, from 1 to max_attribute_point. Raise ValueError if the block can not be read
+    """
+    fields = {}
+    for field in CHARACTER_FIELDS:
+        match = re.search(rf"^\W*{field}\W*:[ \t*]*(.+)$", text, re.MULTILINE | re.IGNORECASE)
+        if match is None or not match.group(1).strip(" *"):
+            raise ValueError(f"missing {field}")
+        fields[field.lower()] = match.group(1).strip(" *")
+    attributes = {}
+    for attr in story.gameruledict["attributes"]:
+        match = re.search(rf"\b{re.escape(attr)}\W*[=:][ \t*]*(\d+)", text, re.IGNORECASE)
+        if match is None:
+            raise ValueError(f"missing attribute {attr}")
+        attributes[attr] = int(match.group(1))
+        if not 1 <= attributes[attr] <= story.gameruledict["max_attribute_point"]:
+            raise ValueError(f"{attr} = {attributes[attr]} is not from 1 to {story.gameruledict['max_attribute_point']}")
+    return Character(attributes=attributes, **fields)
+
+def parse_world(response: str, story: Story):
+    """Split a generated world (see world_messages) into the background and its 4 characters.
+    Return (background, [Character, ...]). Raise ValueError if the world does not follow the form or the game rule
+    """
+    headers = list(CHARACTER_HEADER.finditer(response))
+    numbers = [int(header.group(1)) for header in headers]
+    if numbers != [1, 2, 3, 4]:
+        raise ValueError(f"expected Character 1 to 4, found {numbers}")
+    background = response[:headers[0].start()].strip()
+    if not background:
+        raise ValueError("missing background")
+    characters = []
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(response)
+        try:
+            characters.append(parse_character(response[header.end():end], story))
+        except ValueError as e:
+            raise ValueError(f"Character {i + 1}: {e}")
+    return background, characters
+
+# The pool of pre-generated worlds new games draw from (a WorldPool, see worldpool.py). None generates every world
+world_pool = None
+
+def prefetchWorld(story: Story):
+    """Get the world ready before the player has typed their name: start generating it in the background (if speculative_world is on),
+    unless the world pool has one (startDM draws it then). startDM replays it, so the world appears at once when the name is in
+    """
+    if "start.world" in story.prefetched:
+        return
+    story.telemetry.phase = "start"
+    if world_pool is not None and world_pool.available(story):
+        return
+    if not story.settings["speculative_world"]:
+        return
+    story.prefetched["start.world"] = SpeculativeCall(world_messages(story), site="start.world")
+
+def cancel_prefetched(story: Story):
+    """Cancel the calls started for a game that will not be played from the start (e.g. a saved game is loaded)"""
+    for call in story.prefetched.values():
+        call.cancel()
+    story.prefetched.clear()
+
+def startDM(player: Character, story: Story):
+    player.story = story  # 添加故事引用
+    story.telemetry.phase = "start"
+    player.init_attributes()
+    messages = world_messages(story)
+    prefetched = story.prefetched.pop("start.world", None)
+    if prefetched is not None and not prefetched.usable(messages):
+        # The game rule has changed since it was started (the characters would have the old attributes), or it has failed
+        prefetched.cancel()
+        prefetched = None
+    if prefetched is None and world_pool is not None:
+        # Drawn only now, so no world is used up by a game that is loaded instead, and it has the game rule the game is played with
+        text = world_pool.draw(story)
+        if text is not None:
+            prefetched = SpeculativeCall.ready(messages, text)
+    response = gpt(messages, printChunk=True, site="start.world", prefetched=prefetched)
     # print(response)
 
     # Record the generated story background
@@ -368,19 +1937,28 @@ def startDM(player: Character, story: Story):
     story.add_event(background)
     chara = response[(response.find("Character")) : ]
     story.add_event(chara)
-
-    # Let player choose character
-    print("\nInput a number from 1 to 4 to choose your character. Or input 0 to create a custom character.")
-    user_input = input("Your choice is: ")
+    try:
+        options = parse_world(response, story)[1]
+    except ValueError:
+        # Read the chosen character from the text
+        options = None
+
+    # Let player choose character (the characters are generated without the name, which is given to the chosen one)
+    print(f"\n{player.name}, input a number from 1 to 4 to choose your character. Or input 0 to create a custom character.")
+    user_input = (yield "Your choice is: ").strip()
+    while(user_input not in ["0", "1", "2", "3", "4"]):
+        print("Invalid input. Please input a number from 0 to 4.")
+        user_input = (yield "Your choice is: ").strip()
     story.add_event("You do: " + user_input)
+    data = None
     if(int(user_input)==0):
         # Custom character creation
         print("\nYou have chosen to create a custom character.")
         print("Please provide any detail for your character:")
-        custom_description = input("Description: ")
+        custom_description = yield "Description: "
         # Generate a character based on custom properties
         
-        response = gpt([{'role': 'user', 'content': 
+        messages = [{'role': 'system', 'content': f"{DM_PERSONA}\n{WRITING_STYLE}"}, {'role': 'user', 'content': 
                        f"""
                         Create a Dungeons and Dragons character based on the following properties provided by the player: "{custom_description}". The form of your generation should be based on the following:
                         "
@@ -392,155 +1970,165 @@ def startDM(player: Character, story: Story):
                         Description: A short description for this character
                         "
                         You should not continue or write any story after generating character information. All you need to do is to generate a character based on the properties provided by the player.
-                        Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type). Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                        """}], printChunk=True)
-        choice = response[:]
+                        Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type).
+                        """ + structured_instruction("character", story)}]
+        response = gpt(messages, printChunk=True, site="start.character")
+        # The JSON block is read (and corrected if needed) by the validated parser; the text is only read when it still can not be
+        data = read_structured(story, messages, response, "character")
+        choice = strip_structured(response)
+    elif(options is not None):
+        choice = None
+        chosen = options[int(user_input) - 1]
+        player.classtype, player.race, player.alignment, player.description = chosen.classtype, chosen.race, chosen.alignment, chosen.description
+        player.attributes = dict(chosen.attributes)
     elif(int(user_input)<4 and int(user_input)>0):
         choice = response[(response.find(f"Character {user_input}")) : response.find(f"Character {str(int(user_input)+1)}")]
     elif(int(user_input)==4):
         choice = response[(response.find(f"Character {user_input}")) : ]
-    else:
-        print("Invalid input. Please input a number from 1 to 4. Start over.")
-        return startDM(player, story)
 
     # Extract properties of player's character and save them into Character class
+    if(choice is not None):
+        read_character(player, story, choice, data)
+    story.add_npc(player)
+    print("You have created your character. There is your character properties: ")
+    player.printCharaInfo()
+    # story.add_event(player.charaInfo())
+    yield "Confirm your information. Press enter to start the story: "
+
+def read_character(player: Character, story: Story, choice: str, data = None):
+    """Read the properties of a character written by the LLM into player: from its checked JSON data (see read_structured) when there is one,
+    otherwise from the text, where an attribute that can not be read gets an average value
+    """
+    if data is not None:
+        player.classtype, player.race, player.alignment, player.description = data["classtype"], data["race"], data["alignment"], data["description"]
+        player.attributes = dict(data["attributes"])
+        return
     player.classtype = extract_response(choice, "Classtype")
     player.race = extract_response(choice, "Race")
-    # player.attributes = {
-    #     "Strength": int(extract_response(choice, "Strength")),
-    #     "Intelligence": int(extract_response(choice, "Intelligence")),
-    #     "Speed": int(extract_response(choice, "Speed")),
-    #     "Charisma": int(extract_response(choice, "Charisma"))
-    # }
     for attr in story.gameruledict["attributes"]:
-        player.attributes[attr] = int(extract_response(choice, attr))
+        try:
+            player.attributes[attr] = min(max(int(extract_response(choice, attr)), 1), story.gameruledict["max_attribute_point"])
+        except ValueError:
+            player.attributes[attr] = (story.gameruledict["max_attribute_point"] + 1) // 2
     player.alignment = extract_response(choice, "Alignment")
     player.description = extract_response(choice, "Description")
-    story.add_npc(player)
-    print("You have created your character. There is your character properties: ")
-    player.printCharaInfo()
-    # story.add_event(player.charaInfo())
-    input("Confirm your information. Press enter to start the story: ")
     
 def startStory(player: Character, story: Story):
     """Start the story with the player's character and the background information"""
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "start"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   You may now start creating story (D&D) as a Dungeon Master based on the background information: "{story.get_background()}", and player's character information: "{player.charaInfo()}". 
+                                   You may now start creating story (D&D) as a Dungeon Master based on the background information and the player's character. 
                                    Your generation should be rich, diverse, creative, and reasonable based on the background information provided. At the end of your generation, ask what the player would do next (you don't need to generate options for this). 
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """ + keyevent_instruction(story)), printChunk=True, site="start.story")
+    response, keyevent = read_keyevent(response)
     story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
-    user_input = command_input(player, story)
+    story.add_key_event(keyevent)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
 
 def loadStory(player: Character, story: Story):
     """Load the story from the saved files"""
-    response = response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "load"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   You may now start continue the story (D&D) as a Dungeon Master based on the background information: "{story.history[0:5]}", and player's character information: "{player.charaInfo()}", and the latest story:"{story.history[-5:]}". 
+                                   You may now start continue the story (D&D) as a Dungeon Master based on the beginning of the story: "{story.history[1:5]}", and the latest story:"{story.history[-5:]}". 
                                    Your generation should be rich, diverse, creative, and reasonable based on the background information provided. Also your generation should be consistant with the latest story provided. At the end of your generation, ask what the player would do next (you don't need to generate options for this). 
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """), printChunk=True, site="load.story")
     story.add_event(response)
     
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
 
+# Keywords of each event type for the local event classifier. Keywords in the player's action count more than the ones in the story context
+EVENT_KEYWORDS = {
+    "Battle": ["attack", "fight", "kill", "strike", "stab", "slash", "shoot", "punch", "charge at", "duel", "challenge", "ambush", "assault", "draw my sword", "draw my weapon", "cast a fireball", "steal from"],
+    "Trade": ["buy", "sell", "trade", "barter", "purchase", "merchant", "shop", "market", "price", "pay", "exchange", "haggle", "blacksmith", "wares"],
+    "Casual Event": ["talk", "ask", "greet", "chat", "speak", "thank", "help", "heal", "healer", "pray", "rest at", "elder", "villager", "quest", "advice", "listen"],
+    "Encounter": ["explore", "search", "investigate", "enter", "sneak", "climb", "cave", "ruins", "dungeon", "tomb", "crypt", "lair", "forest", "swamp", "bandits", "wolves", "monster", "creature"],
+    "None": ["walk", "continue", "keep going", "keep walking", "travel", "follow", "head to", "head towards", "wait", "sleep", "leave", "return", "move on"]
+}
+EVENT_TYPES = list(EVENT_KEYWORDS)
+
+def keyword_score(text: str, keywords: list):
+    """Count how many of the keywords (whole words or phrases) appear in the text"""
+    text = " " + " ".join(re.findall(r"[a-z']+", text.lower())) + " "
+    return sum(1 for keyword in keywords if f" {keyword} " in text or f" {keyword}s " in text or f" {keyword}ed " in text or f" {keyword}ing " in text)
+
+def classifyEventHeuristic(player: Character, story: Story):
+    """Decide the next event type locally with keywords over the player's latest action and the latest event
+    Return: (event type, confidence from 0 to 1)
+    """
+    action = story.get_latest_player_action()
+    context = story.get_latest_event()
+    scores = {event_type: 3 * keyword_score(action, keywords) + keyword_score(context[-500:], keywords) for event_type, keywords in EVENT_KEYWORDS.items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, second_score) = ranked[0], ranked[1]
+    if best_score == 0:
+        return "None", 0.0
+    # Confident when the best type wins clearly and is backed by more than one weak hint
+    confidence = (best_score - second_score) / best_score * min(1.0, best_score / 3)
+    return best, confidence
+
+def classifyEventLLM(player: Character, story: Story, model = None, max_tokens = None):
+    """Let the LLM decide the next event type
+    Return: (event type, confidence from 0 to 1)
+    """
+    response = gpt([{'role': 'system', 'content': CHECK_EVENT_RULES},
+                    {'role': 'user', 'content': f"""Latest Story Context: “{story.get_latest_event()}”
+Player's Latest Action: “{story.get_latest_player_action()}”"""}], printChunk=False, model=model, max_tokens=max_tokens, site="check_event")
+    # print(response)
+    for event_type in EVENT_TYPES:
+        if(event_type in response):
+            return event_type, 1.0
+    return "None", 0.0
+
+def classifyEventHybrid(player: Character, story: Story):
+    """Decide the next event type locally, and only ask a cheap model with a tight token cap when the heuristic is not confident
+    Return: (event type, confidence from 0 to 1)
+    """
+    event_type, confidence = classifyEventHeuristic(player, story)
+    if confidence >= story.settings["event_classifier_confidence"]:
+        return event_type, confidence
+    return classifyEventLLM(player, story, model=story.settings["event_classifier_model"])
+
+# The backends of checkEvent. A local model can be plugged in by adding a function (player, story) -> (event type, confidence)
+event_classifiers = {
+    "heuristic": classifyEventHeuristic,
+    "llm": classifyEventLLM,
+    "hybrid": classifyEventHybrid
+}
+
 def checkEvent(player: Character, story: Story):
     """Check the previous event and decide what should be the following event type based on the previous event
     Return: One of the following event types: Casual Event, Trade, Encounter, Battle, or None (just continue without any type).
     """
-    response = gpt([{'role': 'user','content':
-                                   f"""
-                                   You, As the Dungeon Master, analyze the following inputs to determine the next event type:
-
-                                    Latest Story Context: “{story.get_latest_event()}”
-                                    Player's Latest Action: “{story.get_latest_player_action()}”
-                                    Event Type Selection Rules:
-                                    Choose ONLY ONE of these 5 event types:
-
-                                    1. Casual Event
-
-                                    Trigger: Player interaction aligns with non-hostile NPC assistance/rewards.
-                                    Examples:
-                                    A traveling cleric offers free healing potions.
-                                    A village elder shares critical story information.
-                                    A friendly creature provides navigation help.
-
-                                    2. Trade
-
-                                    Trigger: Player demonstrates resource-seeking behavior.
-                                    Examples:
-                                    A merchant proposes item exchanges (e.g., “3 wolf pelts for a better sword”).
-                                    A blacksmith offers weapon upgrades for rare materials.
-                                    A mystic trades scrolls for completed quests.
-
-                                    3. Encounter
-
-                                    Trigger: Environmental/contextual hostility without direct player provocation.
-                                    Examples:
-                                    Bandits ambush the player on the road.
-                                    Territorial beasts block a mountain pass.
-                                    Cursed spirits manifest in ancient ruins.
-
-                                    4. Battle
-
-                                    Trigger: Player explicitly initiates combat.
-                                    Examples:
-                                    Player attacks a guarded enemy camp.
-                                    Player challenges a tavern bully.
-                                    Player attempts to steal from armed guards.
-
-                                    5. None
-
-                                    Trigger: No event insertion required for narrative continuity.
-                                    Conditions:
-                                    Story progression doesn't require interruption.
-                                    Player action is purely transitional (e.g., “I keep walking northwest”).
-                                    Existing plot threads need time to develop organically.
-
-                                    Validation Checklist:
-                                    Event type strictly matches one of the 5 defined categories
-                                    “None” is only used when all other types are contextually inappropriate
-                                    Player agency from “{story.get_latest_player_action()}” is preserved
-                                    Event severity escalates/de-escalates appropriately based on story progression
-
-                                    All you need to do is just generate the event type, do not generate any content of the future event.
-                                   """},], printChunk=False)
-    # print(response)
-    if("Casual Event" in response):
-        return "Casual Event"
-    elif("Trade" in response):
-        return "Trade"
-    elif("Encounter" in response):
-        return "Encounter"
-    elif("Battle" in response):
-        return "Battle"
-    elif("None" in response):
-        return "None"
+    story.telemetry.phase = "check_event"
+    classifier = event_classifiers.get(story.settings["event_classifier"], classifyEventHybrid)
+    event_type, confidence = classifier(player, story)
+    return event_type
 
         
 def encounter(player: Character, story: Story):
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "encounter"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   Continue creating story (D&D) based on the character: "{player.charaInfo()}", the background: "{story.get_background()}", the key events before: "{story.get_all_key_events()}", and the latest story: "{story.get_latest_event()}". 
+                                   Continue creating story (D&D) based on the character, the background, the key events before: "{story.get_key_event_memory()}", and the latest story: "{story.get_latest_event()}". 
                                    At the end of your generation, create an encounter for the player (you should write out the word "Encounter" in a new line so the player knows). Potentially, this encounter could lead to a battle.
                                    Let the encounter be rich, diverse, and creative. Here are some types of creature information you may use: beasts (Wolves, bears, giant spiders, etc), humanoids (Goblins, orcs, kobolds, gnolls, lizardfolk, bandits, etc), undead(Skeletons, zombies, wights, ghouls, vampires, liches, etc), aberrations, dragons, fiends, celestials, elementals, giants, golems, fey (pixies, dryads, hags), monstrosities, oozes, plants (treants), swarms, shapechangers, legendary creatures, or just other humans.
                                    You should not provide any options for the encounter. You should not roll and generate the outcome of this event/encounter by yourself. All you need is to generate an encounter and let the player decide what they do.
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """ + keyevent_instruction(story)), printChunk=True, site="encounter.narration")
     # Record the generated story background
+    response, keyevent = read_keyevent(response)
     story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
+    story.add_key_event(keyevent)
     # Input the encounter roll option
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
-    input_response = gpt([{'role': 'user','content':
+    messages = story_messages(player, story,
                                    f"""
-                                   Based on the key events before: "{story.get_all_key_events()}" and the latest story: " {story.get_latest_event()}", the player now choose to deal with the encounter by doing: "{user_input}". 
-                                   Create an option that if the player choose to do so. Game rule:"{story.get_gamerule()}".
+                                   Based on the key events before: "{story.get_key_event_memory()}" and the latest story: " {story.get_latest_event()}", the player now choose to deal with the encounter by doing: "{user_input}". 
+                                   Create an option that if the player choose to do so. Follow the game rule.
                                    The example of an option is like (assuming the player inputs that he/she wants to scare off the wolves. So the encounter tests on character's Strength (assuming the character has a value of 4)):
                                    "
                                    Option: Intimidate the Wolves (Strength)
@@ -548,19 +2136,45 @@ def encounter(player: Character, story: Story):
                                     Roll: To successfully intimidate the wolves through physical force, your dice total should be > 18.
                                    "
                                    You must let the attribute to be in brackets(). You must use ">" sign and do not use * signs around the number. You should not roll and generate the outcome of this event/encounter by yourself. All you need is to generate an option with a passing dice total.
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
-    # Feed the option to a local method
-    story.add_event(input_response)
-    story.add_key_event(generateKeyEvent(response))
-    choice = input_response
-    optionName = choice[(choice.find("Option")) : choice.find("\n")]
-    selectedAttribute = choice[(choice.find("(") + 1) : choice.find(")")]
-    requirement = int(choice[(choice.find(">") + 2) : choice.find(".", (choice.find(">") + 2))])
+                                   """ + structured_instruction("option", story) + keyevent_instruction(story))
+    parser = StreamFields(option_fields(story)) if story.settings["stream_early_stop"] else None
+    input_response = gpt(messages, printChunk=True, site="encounter.option", parser=parser)
+    if parser is not None and parser.complete:
+        # The option and the roll were read while streaming, and the rest (key event and game data) was not generated
+        (optionName, selectedAttribute), requirement = parser.values["option"], parser.values["requirement"]
+        story.add_event(input_response, "roll")
+        story.add_key_event(f"You try to deal with the encounter: {optionName} ({selectedAttribute}).")
+        option = {"option": optionName, "attribute": selectedAttribute, "requirement": requirement}
+    else:
+        # Feed the option to a local method
+        input_response, keyevent = read_keyevent(input_response)
+        story.add_event(strip_structured(input_response), "roll")
+        story.add_key_event(keyevent)
+        option = read_structured(story, messages, input_response, "option")
+    if option is not None:
+        optionName, selectedAttribute, requirement = option["option"], option["attribute"], option["requirement"]
+    else:
+        choice = strip_structured(input_response)
+        optionName = choice[(choice.find("Option")) : choice.find("\n")]
+        selectedAttribute = choice[(choice.find("(") + 1) : choice.find(")")]
+        if selectedAttribute not in player.attributes:
+            # Use the first attribute named in the option
+            selectedAttribute = next((attr for attr in story.gameruledict["attributes"] if attr.lower() in choice.lower()), story.gameruledict["attributes"][0])
+        try:
+            requirement = int(choice[(choice.find(">") + 2) : choice.find(".", (choice.find(">") + 2))])
+        except ValueError:
+            # About half the rolls pass
+            requirement = player.attributes[selectedAttribute] * (story.gameruledict["dice_sides"] + 1) // 2
+    # Keep the difficulty within the settings (checked locally with the exact dice distribution)
+    calibrated = calibrate_requirement(player, selectedAttribute, requirement, story)
+    if calibrated != requirement:
+        print(f"\nThe requirement is adjusted from {requirement} to {calibrated}.")
+        requirement = calibrated
+    print(f"\nYour chance to pass: {success_chance(player, selectedAttribute, requirement, story):.0%}")
     rollOutcome = rollDices(player, selectedAttribute, requirement, story)
     # If roll total > requirement, no need for battle. Get reward.
     if(rollOutcome==True):
-        response = gpt([{'role': 'user','content':
+        messages = story_messages(player, story,
                                    f"""
                                    The player has rolled a number greater than the requirement and passed the test. This means the outcome of {optionName} is successful. Continue the story with this successful outcome. At the end, give the player the reward for passing the encounter.
                                    The reward type can be one of these: adding golds, HP (health points), and giving the player a new skill. The probabilities of each type are: 60%, 25%, 15%.
@@ -582,35 +2196,45 @@ def encounter(player: Character, story: Story):
                                     Effect: Add 6 points to your strength rolls.
                                    "
                                    Make an empty new line at the end of your generation.
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """ + structured_instruction("changes", story) + keyevent_instruction(story))
+        response = gpt(messages, printChunk=True, site="encounter.reward")
         # Record the reward
-        story.add_event(response)
-        story.add_key_event(generateKeyEvent(response))
-        if("Golds" in response):
-            player.golds += int(response[(response.find("Golds") + 7) : response.find("\n", (response.find("Golds") + 7))])
-        elif("HP" in response):
-            player.hp += int(response[(response.find("HP") + 4) : response.find("\n", (response.find("HP") + 4))])
-        elif("New skill" in response):
-            skillName = response[(response.find("New skill:")+ 11)  : response.find("\n", (response.find("New skill:")+ 11))]
-            skillDescription = response[(response.find("Description")) : response.find("Effect")]
-            skillEffect = response[(response.find("Effect")) : response.find("rolls") + 6]
-            player.skills.update({skillName: (skillDescription+skillEffect)})
-            print("Your skills are updated:")
-            player.printCharaInfo()
+        response, keyevent = read_keyevent(response)
+        story.add_event(strip_structured(response), "reward")
+        story.add_key_event(keyevent)
+        changes = read_structured(story, messages, response, "changes")
+        if changes is not None:
+            apply_changes(player, story, changes)
+        else:
+            response = strip_structured(response)
+            try:
+                if("Golds" in response):
+                    player.golds += int(response[(response.find("Golds") + 7) : response.find("\n", (response.find("Golds") + 7))])
+                elif("HP" in response):
+                    player.hp += int(response[(response.find("HP") + 4) : response.find("\n", (response.find("HP") + 4))])
+                elif("New skill" in response):
+                    skillName = response[(response.find("New skill:")+ 11)  : response.find("\n", (response.find("New skill:")+ 11))]
+                    skillDescription = response[(response.find("Description")) : response.find("Effect")]
+                    skillEffect = response[(response.find("Effect")) : response.find("rolls") + 6]
+                    player.add_skill(skillName, skillDescription+skillEffect)
+                    print("Your skills are updated:")
+                    player.printCharaInfo()
+            except ValueError:
+                print("\n[Error] Could not read the reward.")
 
         print("\nYou have gone through the encounter successfully. What would you like to do next?")
-        user_input = command_input(player, story)
+        user_input = yield from command_input(player, story)
         story.add_event("You do: " + user_input)
     # If encounter roll fails, the encounter becomes a battle.
     else:
-        battle(player, story)
+        yield from battle(player, story)
     print("\n------------------------------")
 
 def battle(player: Character, story: Story):
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "battle"
+    messages = story_messages(player, story,
                                    f"""
-                                   The player has rolled a number less than the requirement and failed the test. You should now continue the  previous encounter story: "{story.get_latest_event()}". The key events before are: "{story.get_all_key_events()}". Now, this encounter leads to an actual battle (you should write out the word "Battle" in a new line so the player knows). 
+                                   The player has rolled a number less than the requirement and failed the test. You should now continue the  previous encounter story: "{story.get_latest_event()}". The key events before are: "{story.get_key_event_memory()}". Now, this encounter leads to an actual battle (you should write out the word "Battle" in a new line so the player knows). 
                                    Use the previous information. Generate character information for the enemy in the following example form (do not generate multiple enemies):
                                    "
                                    Enemy name: (Name that you may generate. If the enemy is just a or some creatures just write the creature or race names) 
@@ -623,33 +2247,57 @@ def battle(player: Character, story: Story):
                                    Description: A short description for this enemy
                                    "
                                    Do not generate any other signs or words other than the ones provided above.
-                                   After genearting enemy information, write a short description of the battle between the player (player's info: "{player.charaInfo()}") and the enemey. At the end, ask what player would do next.
-                                   Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type). Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   After genearting enemy information, write a short description of the battle between the player and the enemey. At the end, ask what player would do next.
+                                   Make sure you use the exact words examples provided above (such as when writing Classtype, do not change the word and write it to Class Type).
+                                   """ + structured_instruction("enemy", story))
+    response = gpt(messages, printChunk=True, site="battle.enemy")
     
-    story.add_event(response)
+    story.add_event(strip_structured(response), "battle")
     # Record the enemy
-    enemy = Character(
-        name = extract_response(response, "Enemy name"),
-        classtype = extract_response(response, "Classtype"),
-        race= extract_response(response, "Race"),
-        alignment= extract_response(response, "Alignment"),
-        hp = int(extract_response(response, "HP")),
-        description = extract_response(response, "Description")
-    )
-    for attr in story.gameruledict["attributes"]:
-        enemy.attributes[attr] = int(extract_response(response, attr))
+    enemy_data = read_structured(story, messages, response, "enemy")
+    if enemy_data is not None:
+        enemy = Character(
+            name = enemy_data["name"],
+            classtype = enemy_data["classtype"],
+            race = enemy_data["race"],
+            alignment = enemy_data["alignment"],
+            hp = enemy_data["hp"],
+            description = enemy_data["description"]
+        )
+        enemy.attributes.update(enemy_data["attributes"])
+    else:
+        response = strip_structured(response)
+        enemy = Character(
+            name = extract_response(response, "Enemy name"),
+            classtype = extract_response(response, "Classtype"),
+            race= extract_response(response, "Race"),
+            alignment= extract_response(response, "Alignment"),
+            description = extract_response(response, "Description")
+        )
+        # Numbers that can not be read get an average value
+        try:
+            enemy.hp = int(extract_response(response, "HP"))
+        except ValueError:
+            enemy.hp = 60
+        for attr in story.gameruledict["attributes"]:
+            try:
+                enemy.attributes[attr] = min(max(int(extract_response(response, attr)), 1), story.gameruledict["max_attribute_point"])
+            except ValueError:
+                enemy.attributes[attr] = (story.gameruledict["max_attribute_point"] + 1) // 2
     story.add_npc(enemy)
+    if story.settings["battle_engine"] == "local":
+        yield from localBattle(player, story, enemy)
+        return
     # Keep battling until the enemy's HP <= 0
     battling = True
     while(battling):
         # Input what player would do
-        user_input = command_input(player, story)
+        user_input = yield from command_input(player, story)
         story.add_event("You do: " + user_input)
-        input_response = gpt([{'role': 'user','content':
+        messages = story_messages(player, story,
                                        f"""
-                                       Based on the key events before: "{story.get_all_key_events()}", the latest battle:"{story.get_latest_event()}" and enemy info:"{enemy.charaInfo()}": , the player (info:"{player.charaInfo()}") now choose to deal with the battle by doing: "{user_input}". 
-                                       Create an option that if the player choose to do so. Game rule:"{story.get_gamerule()}".
+                                       Based on the key events before: "{story.get_key_event_memory()}", the latest battle:"{story.get_latest_event()}" and enemy info:"{enemy.charaInfo()}": , the player now choose to deal with the battle by doing: "{user_input}". 
+                                       Create an option that if the player choose to do so. Follow the game rule.
                                        The example of an option is like (assuming the player inputs that he/she wants to attack wolves using strength. So the encounter tests on character's Strength (assuming the character has a value of 4)):
                                        "
                                        Option: Draws your longsword and charges at the wolves (Strength)
@@ -657,20 +2305,35 @@ def battle(player: Character, story: Story):
                                         Roll: To successfully attack the wolves through physical force, your dice total should be greater than the roll of the wolves.
                                        "
                                        You must state the option in the form above and include the words "Option", "Description", and "Roll". You must let the attribute (one of Strength, Intelligence, Speed, Charisma) to be in brackets() at the Option line. Keep the option line short and let description of the option to have more details. You should not roll and generate the outcome of this event/encounter by yourself. All you need is to generate an option with a description of the attack.
-                                       Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                       """},], printChunk=True)
-
-        story.add_event(input_response)
-        story.add_key_event(generateKeyEvent(input_response))
-        # Feed the option to a local method
-        choice = input_response
-        optionName = choice[(choice.find("Option")) : choice.find("\n")]
-        selectedAttribute = choice[(choice.find("(") + 1) : choice.find(")")]
+                                       """ + structured_instruction("battle_option", story) + keyevent_instruction(story))
+        parser = StreamFields(option_fields(story, roll=False)) if story.settings["stream_early_stop"] else None
+        input_response = gpt(messages, printChunk=True, site="battle.option", parser=parser)
+        if parser is not None and parser.complete:
+            # The option, its description and the roll line were read while streaming, and the rest was not generated
+            optionName, selectedAttribute = parser.values["option"]
+            story.add_event(input_response, "roll")
+            story.add_key_event(f"In the battle against {enemy.name}, you try: {optionName} ({selectedAttribute}).")
+            option = {"option": optionName, "attribute": selectedAttribute}
+        else:
+            input_response, keyevent = read_keyevent(input_response)
+            story.add_event(strip_structured(input_response), "roll")
+            story.add_key_event(keyevent)
+            # Feed the option to a local method
+            option = read_structured(story, messages, input_response, "battle_option")
+        if option is not None:
+            optionName, selectedAttribute = option["option"], option["attribute"]
+        else:
+            choice = strip_structured(input_response)
+            optionName = choice[(choice.find("Option")) : choice.find("\n")]
+            selectedAttribute = choice[(choice.find("(") + 1) : choice.find(")")]
+            if selectedAttribute not in player.attributes:
+                selectedAttribute = next((attr for attr in story.gameruledict["attributes"] if attr.lower() in choice.lower()), story.gameruledict["attributes"][0])
         # Compare the roll between the player and the enemy
+        print(f"\nYour chance to beat the enemy's roll: {opposed_chance(player, enemy, selectedAttribute, story):.0%}")
         rollOutcome = rollDices(player, selectedAttribute, rollEnemyDices(enemy, selectedAttribute, story), story)
         # When player wins the roll
         if(rollOutcome==True):
-            response = gpt([{'role': 'user','content':
+            messages = story_messages(player, story,
                                        f"""
                                        The player has rolled a number greater than the enemy's and passed the previous battle: "{story.get_latest_event()}". This means the outcome of {optionName} is successful. Continue the story with this successful outcome. The infomation of the enemy is {enemy.charaInfo}. 
                                        If the player's option is to attack, you should give the enemy certain amount of damage. State the outcome of this attack and write the damage given to the enemy in a newline so that the player can see. You should write it in the following form:
@@ -683,27 +2346,36 @@ def battle(player: Character, story: Story):
                                        If the player's option is to heal,  you should write the description of the heal and you must write "You've successfully healed" and provide a number of HP healed at the end of your generated texts. 
                                        Example of healing: "You've successfully healed. HP +20". You must write "HP" and "+" and keep a space between them.
                                        Make an empty new line at the end of your generation.
-                                       Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                       """},], printChunk=True)
+                                       """ + structured_instruction("outcome", story) + keyevent_instruction(story))
+            response = gpt(messages, printChunk=True, site="battle.hit")
             # Record the damage
-            story.add_event(response)
-            story.add_key_event(generateKeyEvent(response))
-            if("You've escaped" in response):
+            response, keyevent = read_keyevent(response)
+            story.add_event(strip_structured(response), "battle")
+            story.add_key_event(keyevent)
+            outcome = read_structured(story, messages, response, "outcome")
+            if outcome is None:
+                response = strip_structured(response)
+                outcome = {"action": "escape" if "You've escaped" in response else "attack", "damage": 0, "hp": 0}
+                try:
+                    if("HP +" in response):
+                        outcome["hp"] = int(extract_response(response, "HP"))
+                    if("Damage:" in response):
+                        outcome["damage"] = int(extract_response(response, "Damage"))
+                except ValueError:
+                    print("\n[Error] Could not read the outcome of the attack.")
+            if(outcome["action"] == "escape"):
                 battling = False
-                user_input = command_input(player, story)
+                user_input = yield from command_input(player, story)
                 story.add_event("You do: " + user_input)
                 return
-            if("HP +" in response):
-                player.hp += int(extract_response(response, "HP"))
-            if("Damage:" in response):
-                damage = int(extract_response(response, "Damage"))
-                enemy.hp -= damage
+            player.hp += outcome["hp"]
+            enemy.hp -= outcome["damage"]
             # If enemy's HP <= 0: Player wins the Battle
             if(enemy.hp <= 0):
                 battling = False
-                response = gpt([{'role': 'user','content':
+                messages = story_messages(player, story,
                                        f"""
-                                       For previous key events:"{story.get_all_key_events()}" and the previous battle: "{story.get_latest_event()}", the enemy has been defeated. Continue the story with this successful outcome. The infomation of the enemy is {enemy.charaInfo()}. At the end, give the player the reward for winning the battle.
+                                       For previous key events:"{story.get_key_event_memory()}" and the previous battle: "{story.get_latest_event()}", the enemy has been defeated. Continue the story with this successful outcome. The infomation of the enemy is {enemy.charaInfo()}. At the end, give the player the reward for winning the battle.
                                        The reward type can be one of these: adding golds, HP (health points), and giving the player a new skill. The probabilities of each type are: 30%, 10%, 60%.
                                        You should write and indicate the word "Reward" so that the player can see. An exmaple of golds reward is like the following:
                                        "
@@ -723,33 +2395,42 @@ def battle(player: Character, story: Story):
                                          Effect: Add 6 points to your strength rolls.
                                         "
                                        Make an empty new line at the end of your generation.
-                                       Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                       """},], printChunk=True)
-                story.add_event(response)
-                story.add_key_event(generateKeyEvent(response))
-                response = response[response.find("Reward") : ]
-                if("Golds" in response):
-                    player.golds += int(extract_response(response, "Golds"))
-                if("HP" in response):
-                    player.hp += int(extract_response(response, "HP"))
-                if("New skill" in response):
-                    skillName = extract_response(response, "New skill")
-                    # skillDescription = response[(response.find("Description")) : response.find("Effect")]
-                    skillDescription = extract_response(response, "Description", end_str="Effect")
-                    # skillEffect = response[(response.find("Effect")) : response.find("rolls") + 6]
-                    skillEffect = extract_response(response, "Effect", end_str="rolls", end_shift=6)
-                    player.skills.update({skillName: (skillDescription+skillEffect)})
-                    print("Your skills are updated:")
-                    player.printCharaInfo()
+                                       """ + structured_instruction("changes", story) + keyevent_instruction(story))
+                response = gpt(messages, printChunk=True, site="battle.reward")
+                response, keyevent = read_keyevent(response)
+                story.add_event(strip_structured(response), "reward")
+                story.add_key_event(keyevent)
+                changes = read_structured(story, messages, response, "changes")
+                if changes is not None:
+                    apply_changes(player, story, changes)
+                else:
+                    response = strip_structured(response)
+                    response = response[response.find("Reward") : ]
+                    try:
+                        if("Golds" in response):
+                            player.golds += int(extract_response(response, "Golds"))
+                        if("HP" in response):
+                            player.hp += int(extract_response(response, "HP"))
+                        if("New skill" in response):
+                            skillName = extract_response(response, "New skill")
+                            # skillDescription = response[(response.find("Description")) : response.find("Effect")]
+                            skillDescription = extract_response(response, "Description", end_str="Effect")
+                            # skillEffect = response[(response.find("Effect")) : response.find("rolls") + 6]
+                            skillEffect = extract_response(response, "Effect", end_str="rolls", end_shift=6)
+                            player.add_skill(skillName, skillDescription+skillEffect)
+                            print("Your skills are updated:")
+                            player.printCharaInfo()
+                    except ValueError:
+                        print("\n[Error] Could not read the reward.")
                 print("\nYou have won the battle. What would you like to do next?")
-                user_input = command_input(player, story)
+                user_input = yield from command_input(player, story)
                 story.add_event("You do: " + user_input)
             # If enemy's HP still > 0. Battle continues
             else:
                 print(f"\nThe enemy's HP: {enemy.hp}. Battle continues")
         # When player loses the roll
         else:
-            response = gpt([{'role': 'user','content':
+            messages = story_messages(player, story,
                                        f"""
                                        The player has rolled a number less than the enemy's and failed the previous battle: "{story.get_latest_event()}". This means the outcome of {optionName} is not successful. Continue the story with this a failing outcome. The infomation of the enemy is {enemy.charaInfo()}. You should give the player certain amount of damage.
                                        State the outcome of this attack and write the damage given to the player in a newline so that the player can see. You should write it in the following form:
@@ -758,26 +2439,91 @@ def battle(player: Character, story: Story):
                                         Description: (How the player cause the damage)
                                        "
                                        You must keep it in the form above and use the word "Damage" (Do not add any sign around it). You don't need to calculate the damage to player's HP. Just give a number of damage.
-                                       Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                       """},], printChunk=True)
+                                       """ + structured_instruction("damage", story) + keyevent_instruction(story))
+            response = gpt(messages, printChunk=True, site="battle.damage")
             # Record the damage
-            story.add_event(response)
-            story.add_key_event(generateKeyEvent(response))
-            if("Damage:" in response):
-                damage = int(extract_response(response, "Damage"))
-                player.hp -= damage
+            response, keyevent = read_keyevent(response)
+            story.add_event(strip_structured(response), "battle")
+            story.add_key_event(keyevent)
+            damage = read_structured(story, messages, response, "damage")
+            if damage is not None:
+                player.hp -= damage["damage"]
+            elif("Damage:" in response):
+                try:
+                    player.hp -= int(extract_response(strip_structured(response), "Damage"))
+                except ValueError:
+                    print("\n[Error] Could not read the damage.")
             # If player's HP <= 0: Game over
             if(player.hp <= 0):
-                print("\nYour HP is 0. Game over")
-                exit()
+                # The game loop ends the game
+                return
             # If player's HP still > 0, the battle continues
             else:
                 print(f"\nYour HP: {player.hp}. The battle continues")
 
+def localBattle(player: Character, story: Story, enemy: Character):
+    """The rounds of a battle with the local battle engine. The action, damage, healing and escape of a round are decided by the dice
+    (see resolve_battle_round) and the LLM is called once per round, only to narrate the outcome
+    """
+    enemy_max_hp = enemy.hp
+    rounds = 0
+    while True:
+        user_input = yield from command_input(player, story)
+        story.add_event("You do: " + user_input)
+        rounds += 1
+        action, selectedAttribute = choose_battle_action(player, story, user_input)
+        outcome = resolve_battle_round(player, enemy, action, selectedAttribute, story)
+        reward = 0
+        if not outcome["success"]:
+            result = f"The player fails and {enemy.name} deals {outcome['taken']} damage to the player (the player's HP is now {max(player.hp, 0)})."
+        elif action == "escape":
+            result = f"The player escapes from {enemy.name}. The battle is over."
+        elif action == "heal":
+            result = f"The player heals {outcome['heal']} HP (the player's HP is now {player.hp})."
+        else:
+            result = f"The player hits {enemy.name} for {outcome['damage']} damage ({enemy.name} has {max(enemy.hp, 0)} of {enemy_max_hp} HP left)."
+        if player.hp <= 0:
+            ending = "The player has fallen. Describe the player's defeat and do not ask what the player would do next."
+        elif enemy.hp <= 0:
+            reward = enemy_max_hp // 2
+            player.golds += reward
+            result += f" {enemy.name} is defeated. The player's reward: Golds +{reward}."
+            ending = "Describe the victory and the reward, then ask what the player would do next."
+        elif outcome["success"] and action == "escape":
+            ending = "Describe the escape, then ask what the player would do next."
+        else:
+            ending = "The battle goes on. At the end, ask what the player would do next."
+        response = gpt(story_messages(player, story,
+                                       f"""
+                                       The player is in a battle against this enemy: {enemy.charaInfo()}. The latest battle: "{story.get_latest_event()}". The player chooses to: "{user_input}" (using {selectedAttribute}).
+                                       The dice have already decided the outcome of this round: {result}
+                                       Narrate this round as the Dungeon Master in one short paragraph. Keep to this outcome and its numbers exactly. Do not roll or decide anything else, and do not give any other damage, healing or reward.
+                                       {ending}
+                                       """), printChunk=True, site="battle.round")
+        story.add_event(response, "battle")
+        if player.hp <= 0:
+            story.add_key_event(f"You have fallen in the battle against {enemy.name} after {rounds} rounds.")
+            # The game loop ends the game
+            return
+        if enemy.hp <= 0:
+            story.add_key_event(f"You defeated {enemy.name} in {rounds} rounds and earned {reward} Golds.")
+            print(f"\nReward: Golds +{reward}")
+            print("\nYou have won the battle. What would you like to do next?")
+        elif outcome["success"] and action == "escape":
+            story.add_key_event(f"You escaped from {enemy.name} after {rounds} rounds.")
+            print("\nYou have escaped. What would you like to do next?")
+        else:
+            print(f"\nYour HP: {player.hp}. The enemy's HP: {enemy.hp}. The battle continues")
+            continue
+        user_input = yield from command_input(player, story)
+        story.add_event("You do: " + user_input)
+        return
+
 def event(player: Character, story: Story):
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "event"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   You can now continue creating story (D&D) as the Dungeon Master. Your generation should align to the previous key events: "{story.get_all_key_events()}," previous story: "{story.get_latest_event()}", the background world information: "{story.get_background()}", and the player's information: "{player.charaInfo()}".
+                                   You can now continue creating story (D&D) as the Dungeon Master. Your generation should align to the previous key events: "{story.get_key_event_memory()}," previous story: "{story.get_latest_event()}", the background world information and the player's information.
                                    At the end of your generation, create a casual event between the player and the NPC that allows NPCs to offer the player some help. You should indicate the word "Casual Event" so that the player knows.
                                    There are some types of NPCs you may consider: The Quest Giver, the Merchant, the Healer, the Informant, the Trainer, the Patron, the Keeper of Secrets, the Protector, the Wise Elder, etc.
                                    You should descibe the event. At the end, ask what the player wants to do. (You don't need to generate options for the player to choose. Just state the event and let the player input the action)
@@ -786,14 +2532,14 @@ def event(player: Character, story: Story):
                                    An example of the Healer: a wandering druid offering natural remedies. May reward players with HP.
                                    An example of the Wise Elder: a retired hero who once faced similar challenges. May reward players with a new skill.
                                    
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """ + keyevent_instruction(story)), printChunk=True, site="event.narration")
+    response, keyevent = read_keyevent(response)
     story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
+    story.add_key_event(keyevent)
     # Input what player would do
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
-    input_response = gpt([{'role': 'user','content':
+    messages = story_messages(player, story,
                                        f"""
                                        Based on the latest event: " {story.get_latest_event()}", the player now choose to deal with the event and NPC by doing: "{user_input}". 
                                        Create the outcome that if the player chooses to do so, and you may generate a reward or a penalty that player would gain or lose from the event. There are 3 types of reward (Golds, HP, New skill) and 2 types of penalty (Golds, HP) for the player. You should decide whether it should be a reward or a penalty, and what kind of reward or penalty it should be based on your reasoning. 
@@ -836,35 +2582,46 @@ def event(player: Character, story: Story):
                                        Description:()
                                        "
                                        You should always keep a space between the attribute (HP or Golds) and the sign (+ or -).
-                                       Let the event and NPC be rich, diverse, and creative. Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                       """},], printChunk=True)
-    story.add_event(input_response)
-    story.add_key_event(generateKeyEvent(response))
-    if("Golds" in input_response):
-        if("Golds +" in input_response):
-            player.golds += int(extract_response(input_response, "Golds"))
-        if("Golds -" in input_response):
-            player.golds -= int(extract_response(input_response, "Golds"))
-    if("HP" in input_response):
-        if("HP +" in input_response):
-            player.hp += int(extract_response(input_response, "HP"))
-        if("HP -" in input_response):
-            player.hp -= int(extract_response(input_response, "HP"))
-    if("New skill" in input_response):
-        skillName = extract_response(input_response, "New skill")
-        skillDescription = extract_response(input_response, "Skill Description", end_str="Effect")
-        skillEffect = extract_response(input_response, "Effect", end_str="rolls", end_shift=6)
-        player.skills.update({skillName: (skillDescription+skillEffect)})
-        print("\nYour skills are updated:")
-        player.printCharaInfo()
+                                       Let the event and NPC be rich, diverse, and creative.
+                                       """ + structured_instruction("changes", story) + keyevent_instruction(story))
+    input_response = gpt(messages, printChunk=True, site="event.outcome")
+    input_response, keyevent = read_keyevent(input_response)
+    story.add_event(strip_structured(input_response), "reward")
+    story.add_key_event(keyevent)
+    changes = read_structured(story, messages, input_response, "changes")
+    if changes is not None:
+        apply_changes(player, story, changes)
+    else:
+        input_response = strip_structured(input_response)
+        try:
+            if("Golds" in input_response):
+                if("Golds +" in input_response):
+                    player.golds += int(extract_response(input_response, "Golds"))
+                if("Golds -" in input_response):
+                    player.golds -= int(extract_response(input_response, "Golds"))
+            if("HP" in input_response):
+                if("HP +" in input_response):
+                    player.hp += int(extract_response(input_response, "HP"))
+                if("HP -" in input_response):
+                    player.hp -= int(extract_response(input_response, "HP"))
+            if("New skill" in input_response):
+                skillName = extract_response(input_response, "New skill")
+                skillDescription = extract_response(input_response, "Skill Description", end_str="Effect")
+                skillEffect = extract_response(input_response, "Effect", end_str="rolls", end_shift=6)
+                player.add_skill(skillName, skillDescription+skillEffect)
+                print("\nYour skills are updated:")
+                player.printCharaInfo()
+        except ValueError:
+            print("\n[Error] Could not read the reward or penalty.")
     print("You have gone through the casual event. What would you like to do next?")
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
 
 def trade(player: Character, story: Story):
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "trade"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   You can now continue creating story (D&D) as a Dungeon Master with the character information: "{player.charaInfo()}". The story background: "{story.get_background()}". Previous key events:"{story.get_all_key_events()}". Previous story: "{story.get_latest_event()}".
+                                   You can now continue creating story (D&D) as a Dungeon Master with the character information and the story background. Previous key events:"{story.get_key_event_memory()}". Previous story: "{story.get_latest_event()}".
                                    At the end of your generation, create an trade event. The trade event allows the player to give up HP or Golds, and gain Golds, HP, or learning a skill. The only 2 things that the player can give up for the trade are HP and Golds. The only 3 things that the player can gain from the trade are HP, Golds, and a new skill. You may provide multiple options for the player to choose.
                                    An example of a trade event is like:
                                    "
@@ -884,15 +2641,16 @@ def trade(player: Character, story: Story):
                                    "
                                    
                                    You should indicate the word "Trade" so that the player can see. If the player is gaining a new skill, you must have a effect description of "Add x points to your xxx rolls", where x is a proper reasonable value and xxx is one of the {len(story.gameruledict["attributes"])} character attributes ({story.gameruledict["attributes"]}). These are the only {len(story.gameruledict["attributes"])} attributes that you must use, do not add any other new attributes (Such as, do not make a skill and say "Add 5 points to your HP rolls")). You must use the exact words examples provided above (such as you must use "You lose" and "You gain", and when writing Effect, keep it as Effect and do not add signs around it). Do not generate any other options after stating the trade information above.
-                                   Let the event be rich, diverse, and creative. Let the skills provided align to the character's information (classtype) provided above. Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   Let the event be rich, diverse, and creative. Let the skills provided align to the character's information (classtype) provided above.
+                                   """ + keyevent_instruction(story)), printChunk=True, site="trade.narration")
     # Record the generated story background
+    response, keyevent = read_keyevent(response)
     story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
+    story.add_key_event(keyevent)
     # Choose the first encounter roll option
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
-    response = gpt([{'role': 'user','content':
+    messages = story_messages(player, story,
                                    f"""
                                    Based on the latest trade event: " {story.get_latest_event()}", the player now choose to trade with the NPC by doing (or choosing): "{user_input}".
                                    If the player gives up the trade, you should generate the story outcome based on that.
@@ -913,45 +2671,56 @@ def trade(player: Character, story: Story):
                                     Effect: Add 10 points to your strength rolls.
                                    "
                                    You must use the exact words examples provided above (such as when writing Effect, keep it as Effect and do not add signs around it). 
-                                   Let the event and the skills that can be traded to be rich, diverse, and creative. Let the skills provided align to the character's information (classtype) provided above. Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
-    story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
-    if("You lose" in response):
-        choice = response[(response.find("You lose")) : ]
-        if("Golds -" in choice):
-            player.golds -= int(extract_response(choice, "Golds"))
-        if("HP -" in choice):
-            player.hp -= int(extract_response(choice, "HP"))
-    if("You gain" in response):
-        choice = response[(response.find("You gain")) : ]
-        if("Golds +" in choice):
-            player.golds += int(extract_response(choice, "Golds"))
-        if("HP +" in choice):
-            player.hp += int(extract_response(choice, "HP"))
-        if("New skill" in choice):
-            skillName = extract_response(choice, "New skill")
-            skillDescription = extract_response(choice, "Description", end_str="Effect")
-            skillEffect = extract_response(choice, "Effect", end_str="rolls", end_shift=6)
-            player.skills.update({skillName: (skillDescription+skillEffect)})
-            print("Your skills are updated:")
-            player.printCharaInfo()
+                                   Let the event and the skills that can be traded to be rich, diverse, and creative. Let the skills provided align to the character's information (classtype) provided above.
+                                   """ + structured_instruction("changes", story) + keyevent_instruction(story))
+    response = gpt(messages, printChunk=True, site="trade.outcome")
+    response, keyevent = read_keyevent(response)
+    story.add_event(strip_structured(response), "reward")
+    story.add_key_event(keyevent)
+    changes = read_structured(story, messages, response, "changes")
+    if changes is not None:
+        apply_changes(player, story, changes)
+    else:
+        response = strip_structured(response)
+        try:
+            if("You lose" in response):
+                choice = response[(response.find("You lose")) : ]
+                if("Golds -" in choice):
+                    player.golds -= int(extract_response(choice, "Golds"))
+                if("HP -" in choice):
+                    player.hp -= int(extract_response(choice, "HP"))
+            if("You gain" in response):
+                choice = response[(response.find("You gain")) : ]
+                if("Golds +" in choice):
+                    player.golds += int(extract_response(choice, "Golds"))
+                if("HP +" in choice):
+                    player.hp += int(extract_response(choice, "HP"))
+                if("New skill" in choice):
+                    skillName = extract_response(choice, "New skill")
+                    skillDescription = extract_response(choice, "Description", end_str="Effect")
+                    skillEffect = extract_response(choice, "Effect", end_str="rolls", end_shift=6)
+                    player.add_skill(skillName, skillDescription+skillEffect)
+                    print("Your skills are updated:")
+                    player.printCharaInfo()
+        except ValueError:
+            print("\n[Error] Could not read the trade.")
 
     print("\nYou have gone through the trade event. What would you like to do next?")
-    user_input = command_input(player, story)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
 
 def continueStory(player: Character, story: Story):
-    response = gpt([{'role': 'user','content':
+    story.telemetry.phase = "continue"
+    response = gpt(story_messages(player, story,
                                    f"""
-                                   Continue creating story (D&D) based on the character: "{player.charaInfo()}", the background: "{story.get_background()}", the previoius key events:"{story.get_all_key_events()}", the latest story: "{story.get_latest_event()}, and the player's latest action:"{story.get_latest_player_action()}" ". 
+                                   Continue creating story (D&D) based on the character, the background, the previoius key events:"{story.get_key_event_memory()}", the latest story: "{story.get_latest_event()}, and the player's latest action:"{story.get_latest_player_action()}" ". 
                                    Your generation should be rich, diverse, creative, and reasonable based on the background information provided. Also your generation should be consistant with the latest story and player's action provided. 
                                    At the end of your generation, ask what the player would do next (you don't need to generate options for this).
-                                   Write in second person present tense (you are), avoiding summary and letting scenes play out in real time, without skipping. Allow all characters to take the lead and let bad things happen to good people.
-                                   """},], printChunk=True)
+                                   """ + keyevent_instruction(story)), printChunk=True, site="continue.narration")
+    response, keyevent = read_keyevent(response)
     story.add_event(response)
-    story.add_key_event(generateKeyEvent(response))
-    user_input = command_input(player, story)
+    story.add_key_event(keyevent)
+    user_input = yield from command_input(player, story)
     story.add_event("You do: " + user_input)
     
 # load_dotenv()
@@ -959,190 +2728,949 @@ def continueStory(player: Character, story: Story):
 # encryption_key = os.getenv("ENCRYPTION_KEY")
 # if encryption_key is None:
 #     raise ValueError("Missing encryption key in .env file!")
-with open('secret.key', 'rb') as key_file:
-    key = key_file.read()
-
-f = Fernet(key)
-
-url = "https://getapikey-1099304568737.europe-central2.run.app"
-
-token = requests.get(url)
-
-# Decrypt at runtime
-decrypted_api_key = f.decrypt(token.text).decode()
-
-# Now you can use the decrypted API key in OpenAI API calls
-
-print("API key successfully decrypted and loaded!")
-client = OpenAI(
-    # API key of ELM
-    api_key= decrypted_api_key
-)
-
-def gpt(messages:list, printChunk = True, model = 'gpt-4o'):
-    """Choose the gpt model used for generation
+# The API key is fetched (encrypted) from the key endpoint and decrypted with secret.key.
+# Nothing is loaded at import time: the key and the client are created on the first gpt() call.
+KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'secret.key')
+API_KEY_URL = "https://getapikey-1099304568737.europe-central2.run.app"
+API_KEY_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".aidm_api_key") # Stays encrypted on disk. Set to None to keep the key in memory only
+API_KEY_TTL = 12 * 60 * 60 # Seconds before the cached key is fetched again
+
+api_key_cache = {"key": None, "fetched": 0}
+api_key_lock = threading.Lock()
+llm = None
+llm_lock = threading.Lock()
+
+def get_api_key():
+    """Return the decrypted API key. It is cached in memory (and on disk, encrypted) and only fetched again after API_KEY_TTL"""
+    with api_key_lock:
+        if api_key_cache["key"] and time.time() - api_key_cache["fetched"] < API_KEY_TTL:
+            return api_key_cache["key"]
+        with open(KEY_FILE, 'rb') as key_file:
+            f = Fernet(key_file.read())
+        token, fetched = None, 0
+        # Try the encrypted copy on disk first
+        if API_KEY_CACHE_FILE and os.path.exists(API_KEY_CACHE_FILE):
+            try:
+                with open(API_KEY_CACHE_FILE, 'r', encoding='utf-8') as file:
+                    cached = json.load(file)
+                token, fetched = cached["token"], cached["fetched"]
+            except (OSError, ValueError, KeyError):
+                token = None
+        if token is None or time.time() - fetched >= API_KEY_TTL:
+            try:
+                response = requests.get(API_KEY_URL, timeout=10)
+                response.raise_for_status()
+                token, fetched = response.text, time.time()
+                if API_KEY_CACHE_FILE:
+                    with open(API_KEY_CACHE_FILE, 'w', encoding='utf-8') as file:
+                        json.dump({"token": token, "fetched": fetched}, file)
+                    os.chmod(API_KEY_CACHE_FILE, 0o600)
+            except requests.RequestException as e:
+                if token is None:
+                    raise
+                # Keep using the expired key rather than failing offline
+                print(f"\n[Error] Could not refresh the API key: {e}. Using the cached key.")
+        # Decrypt at runtime
+        api_key_cache["key"] = f.decrypt(token).decode()
+        api_key_cache["fetched"] = fetched
+        return api_key_cache["key"]
+
+def get_llm():
+    """Return the shared LLM client, creating it on the first call. Once API_KEY_TTL has passed, the client gets the refreshed key.
+    The environment variables AIDM_BASE_URL and AIDM_API_KEY override the API address and key (e.g. to play against fake_openai.py offline)
     """
-    if(model=='gpt-3.5-turbo'):
-        return gpt_35_api_stream(messages, printChunk)
-    elif(model=='gpt-4o'):
-        return gpt_4o_api_stream(messages, printChunk)
-    elif(model=='gpt-4o-mini'):
-        return gpt_4o_mini_api_stream(messages, printChunk)
-    elif(model=='gpt-o3-mini'):
-        return gpt_o3_mini_api_stream(messages, printChunk)
-
-def gpt_35_api_stream(messages: list, printChunk = True):
-    """Create response for provided chat message (stream) using gpt3.5-turbo
-
-    Args:
-        messages (list): Full chat message
+    global llm
+    api_key = os.environ.get("AIDM_API_KEY") or get_api_key()
+    if llm is None:
+        with llm_lock:
+            if llm is None:
+                llm = LLMClient(api_key, base_url=os.environ.get("AIDM_BASE_URL") or None)
+    if llm.client.api_key != api_key:
+        # The key has been fetched again: the requests made from now on use it
+        llm.client.api_key = api_key
+    return llm
+
+# Prompt caching statistics reported by the API (the cached tokens are the reused prompt prefix)
+prompt_cache_stats = {"requests": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0}
+prompt_cache_lock = threading.Lock()
+
+def record_prompt_cache(usage):
+    """Add the usage of a request to the prompt caching statistics"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+    with prompt_cache_lock:
+        prompt_cache_stats["requests"] += 1
+        prompt_cache_stats["prompt_tokens"] += usage.prompt_tokens or 0
+        prompt_cache_stats["cached_tokens"] += cached
+        if cached > 0:
+            prompt_cache_stats["cache_hits"] += 1
+
+def print_prompt_cache_stats():
+    """Print the cache hit rate of the prompts"""
+    with prompt_cache_lock:
+        stats = dict(prompt_cache_stats)
+    if stats["requests"] == 0:
+        print("No requests have been made yet.")
+        return
+    print(f"Requests: {stats['requests']}, with cached prompt prefix: {stats['cache_hits']} ({stats['cache_hits'] / stats['requests']:.0%})")
+    if stats["prompt_tokens"] > 0:
+        print(f"Prompt tokens: {stats['prompt_tokens']}, cached: {stats['cached_tokens']} ({stats['cached_tokens'] / stats['prompt_tokens']:.0%})")
+
+# Prices in USD per million tokens: (input, cached input, output). Update them when the prices change. Models not listed have no cost
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "o3-mini": (1.10, 0.55, 4.40)
+}
+
+def prometheus_label(value):
+    """Escape a label value for the Prometheus text format (backslash, double quote and new line)"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Telemetry:
+    """Statistics of the LLM calls of a game session, by call site (the site= of gpt()), game phase and model.
+    The totals are exact. The latest MAX_CALLS calls are also kept one by one (for the percentiles and the JSON lines export)
     """
-    stream = client.chat.completions.create(
-        model='gpt-3.5-turbo',
-        messages=messages,
-        stream=True,
-    )
-    response = []
-    for chunk in stream:
-        if chunk.choices[0].delta.content is not None:
-            if(printChunk):
-                print(chunk.choices[0].delta.content, end="", flush=True)
-            response.append(chunk.choices[0].delta.content)
+    MAX_CALLS = 2000
 
-    return "".join(str(element) for element in response)
+    def __init__(self):
+        self.phase = None # The part of the game being played (set by the game flows)
+        self.calls = collections.deque(maxlen=self.MAX_CALLS)
+        self.totals = {} # (site, phase, model) -> totals, see add()
+        self.lock = threading.Lock()
+
+    def add(self, call: dict):
+        key = (call["site"], call["phase"], call["model"])
+        with self.lock:
+            self.calls.append(call)
+            total = self.totals.setdefault(key, {"calls": 0, "background": 0, "errors": 0, "retries": 0, "fallbacks": 0, "truncated": 0, "cache_hits": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                 "cached_tokens": 0, "cost": 0.0, "duration": 0.0, "ttft": 0.0, "ttft_count": 0})
+            total["calls"] += 1
+            total["background"] += call["background"]
+            total["errors"] += call["error"] is not None
+            total["truncated"] += call["truncated"]
+            total["fallbacks"] += call["attempt"] > 0
+            total["cache_hits"] += call["cached"]
+            total["retries"] += call["retries"]
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens", "duration"):
+                total[field] += call[field]
+            total["cost"] += call["cost"] or 0.0
+            if call["ttft"] is not None:
+                total["ttft"] += call["ttft"]
+                total["ttft_count"] += 1
+
+    def summary(self):
+        """Return the totals by call site (all phases and models), the slowest in total first"""
+        with self.lock:
+            sites = {}
+            for (site, phase, model), total in self.totals.items():
+                merged = sites.setdefault(site, dict.fromkeys(total, 0))
+                for field, value in total.items():
+                    merged[field] += value
+            durations = {}
+            for call in self.calls:
+                durations.setdefault(call["site"], []).append(call["duration"])
+        rows = []
+        for site, total in sites.items():
+            recent = sorted(durations.get(site, [0.0]))
+            rows.append({"site": site, **total, "max_tokens": call_profile(site).get("max_tokens"),
+                         "mean_ttft": total["ttft"] / total["ttft_count"] if total["ttft_count"] else None,
+                         "mean_duration": total["duration"] / total["calls"],
+                         "p95_duration": recent[min(len(recent) - 1, int(0.95 * len(recent)))],
+                         "tokens_per_sec": total["completion_tokens"] / total["duration"] if total["duration"] > 0 else None})
+        return sorted(rows, key=lambda row: row["duration"], reverse=True)
+
+    def by_model(self, site = None):
+        """Return the totals by (call site, model), to compare the models a site has been routed to"""
+        with self.lock:
+            models = {}
+            for (call_site, phase, model), total in self.totals.items():
+                if site is not None and call_site != site:
+                    continue
+                merged = models.setdefault((call_site, model), dict.fromkeys(total, 0))
+                for field, value in total.items():
+                    merged[field] += value
+        return [{"site": call_site, "model": model, **total,
+                 "mean_ttft": total["ttft"] / total["ttft_count"] if total["ttft_count"] else None,
+                 "mean_duration": total["duration"] / total["calls"]}
+                for (call_site, model), total in sorted(models.items())]
+
+    def print_stats(self):
+        rows = self.summary()
+        if not rows:
+            print("No LLM calls have been made yet.")
+            return
+        print(f"{'Call site':<22}{'Calls':>6}{'TTFT':>8}{'Mean':>8}{'p95':>8}{'Tok/s':>7}{'In':>8}{'Out':>7}{'Limit':>6}{'Cut':>5}{'Retry':>6}{'Cost $':>9}")
+        for row in rows:
+            ttft = f"{row['mean_ttft']:.2f}s" if row["mean_ttft"] is not None else "-"
+            speed = f"{row['tokens_per_sec']:.0f}" if row["tokens_per_sec"] is not None else "-"
+            limit = row["max_tokens"] or "-"
+            print(f"{row['site']:<22}{row['calls']:>6}{ttft:>8}{row['mean_duration']:>7.2f}s{row['p95_duration']:>7.2f}s{speed:>7}"
+                  f"{row['prompt_tokens']:>8}{row['completion_tokens']:>7}{limit:>6}{row['truncated']:>5}{row['retries']:>6}{row['cost']:>9.4f}")
+        calls = sum(row["calls"] for row in rows)
+        print(f"Total: {calls} calls ({sum(row['background'] for row in rows)} in the background, {sum(row['errors'] for row in rows)} failed, {sum(row['cache_hits'] for row in rows)} from the response cache), "
+              f"{sum(row['duration'] for row in rows):.1f}s, {sum(row['prompt_tokens'] for row in rows)} prompt and {sum(row['completion_tokens'] for row in rows)} completion tokens, "
+              f"${sum(row['cost'] for row in rows):.4f}")
+
+    def export_jsonl(self, path: str):
+        """Write the kept calls to a JSON lines file (one call per line). Return the number of calls written"""
+        with self.lock:
+            calls = list(self.calls)
+        with open(path, 'w', encoding='utf-8') as file:
+            for call in calls:
+                file.write(json.dumps(call) + "\n")
+        return len(calls)
+
+    def prometheus(self, prefix = "aidm_llm"):
+        """Return the totals in the Prometheus text format"""
+        metrics = [
+            ("calls_total", "counter", "LLM calls", lambda total: total["calls"]),
+            ("background_calls_total", "counter", "LLM calls made in the background", lambda total: total["background"]),
+            ("errors_total", "counter", "LLM calls that failed", lambda total: total["errors"]),
+            ("retries_total", "counter", "Retries of LLM calls", lambda total: total["retries"]),
+            ("fallback_calls_total", "counter", "LLM calls made to a fallback model after the models before it in the route failed", lambda total: total["fallbacks"]),
+            ("cache_hits_total", "counter", "LLM calls answered by the response cache", lambda total: total["cache_hits"]),
+            ("truncated_total", "counter", "LLM calls cut off by their max_tokens", lambda total: total["truncated"]),
+            ("prompt_tokens_total", "counter", "Prompt tokens", lambda total: total["prompt_tokens"]),
+            ("cached_tokens_total", "counter", "Prompt tokens read from the prompt cache", lambda total: total["cached_tokens"]),
+            ("completion_tokens_total", "counter", "Completion tokens", lambda total: total["completion_tokens"]),
+            ("cost_usd_total", "counter", "Estimated cost in USD", lambda total: total["cost"]),
+            ("duration_seconds_sum", "counter", "Total duration of the LLM calls", lambda total: total["duration"]),
+            ("ttft_seconds_sum", "counter", "Total time to first token", lambda total: total["ttft"]),
+            ("ttft_seconds_count", "counter", "LLM calls with a first token", lambda total: total["ttft_count"])
+        ]
+        with self.lock:
+            totals = {key: dict(total) for key, total in self.totals.items()}
+        lines = []
+        for name, kind, description, value in metrics:
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for (site, phase, model), total in sorted(totals.items(), key=lambda item: tuple(str(part) for part in item[0])):
+                lines.append(f'{prefix}_{name}{{site="{prometheus_label(site)}",phase="{prometheus_label(phase or "")}",model="{prometheus_label(model)}"}} {value(total)}')
+        return "\n".join(lines) + "\n"
+
+# The Telemetry of the game session running in this thread (see telemetry_scope). Calls outside a session are only in telemetry_totals
+active_telemetry = contextvars.ContextVar("active_telemetry", default=None)
+telemetry_totals = Telemetry() # All the calls of this process
+
+@contextlib.contextmanager
+def telemetry_scope(telemetry: Telemetry):
+    """Count the LLM calls made in this block (including the ones started in the background) into telemetry"""
+    token = active_telemetry.set(telemetry)
+    try:
+        yield telemetry
+    finally:
+        active_telemetry.reset(token)
 
-def gpt_4o_api_stream(messages: list, printChunk = True):
-    """Create response for provided chat message (stream) using gpt4o
+# The game (Story) running in this thread (see game_scope). Its model routes replace the ones of MODEL_ROUTES
+active_story = contextvars.ContextVar("active_story", default=None)
 
-    Args:
-        messages (list): Full chat message
-        printChunk (int): Decide whether print the output of gpt. 1 means yes and 0 means no.
+@contextlib.contextmanager
+def game_scope(story: Story):
+    """Run a block as part of a game: its LLM calls are counted into the game's telemetry and follow the game's model routes"""
+    token = active_story.set(story)
+    try:
+        with telemetry_scope(story.telemetry if story else None):
+            yield story
+    finally:
+        active_story.reset(token)
+
+def start_call(site: str, model: str, background: bool, profile = None, attempt = 0):
+    """Return the record of a call that is starting. The client fills in the model, usage, time to first token, retries and finish reason.
+    profile is what the call was sent with (see call_profile). attempt is the place of the model in the route (0 is the first choice)
     """
-    stream = client.chat.completions.create(
-        model='gpt-4o',
-        messages=messages,
-        stream=True,
-    )
-    response = []
-    for chunk in stream:
-        if chunk.choices[0].delta.content is not None:
-            if(printChunk):
-                print(chunk.choices[0].delta.content, end="", flush=True)
-            response.append(chunk.choices[0].delta.content)
-
-    return "".join(str(element) for element in response)
-
-def gpt_4o_mini_api_stream(messages: list, printChunk=True):
-    """Create response for provided chat message (stream) using gpt-4omini.
+    telemetry = active_telemetry.get()
+    return {"site": site or "other", "phase": telemetry.phase if telemetry else None, "model": model, "background": background, "profile": profile or {},
+            "attempt": attempt, "telemetry": telemetry, "time": time.time(), "start": time.perf_counter(), "ttft": None, "retries": 0, "usage": None, "finish_reason": None}
+
+def fallback_call(record: dict, model: str):
+    """Return the record of the call that falls back from a failed call to the next model of the route"""
+    return {**record, "model": model, "attempt": record["attempt"] + 1, "time": time.time(), "start": time.perf_counter(),
+            "ttft": None, "retries": 0, "usage": None, "finish_reason": None}
+
+def finish_call(record: dict, response = None, error = None):
+    """Add a finished call to the telemetry of its session and to telemetry_totals"""
+    duration = time.perf_counter() - record["start"]
+    usage = record["usage"] or {}
+    # Without the usage (the call failed or was cancelled) the tokens are estimated
+    prompt_tokens = usage.get("prompt_tokens", 0)
+    completion_tokens = usage.get("completion_tokens", estimate_tokens(response) if response else 0)
+    cached_tokens = usage.get("cached_tokens", 0)
+    price = MODEL_PRICES.get(record["model"])
+    call = {
+        "time": record["time"], "site": record["site"], "phase": record["phase"], "model": record["model"], "background": record["background"],
+        "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "cached_tokens": cached_tokens,
+        "ttft": record["ttft"], "duration": duration,
+        "tokens_per_sec": completion_tokens / (duration - record["ttft"]) if record["ttft"] is not None and duration > record["ttft"] else None,
+        "retries": record["retries"],
+        "stopped": record.get("stopped", False),
+        "cached": record.get("cached", False),
+        "attempt": record["attempt"],
+        "finish_reason": record["finish_reason"],
+        "truncated": record["finish_reason"] == "length",
+        **{field: record["profile"].get(field) for field in PROFILE_FIELDS},
+        "cost": 0.0 if record.get("cached") else ((prompt_tokens - cached_tokens) * price[0] + cached_tokens * price[1] + completion_tokens * price[2]) / 1e6 if price else None,
+        "error": None if error is None else type(error).__name__
+    }
+    if call["truncated"]:
+        # The end of the response (the key event trailer, the JSON block) is missing, so its fallback calls are made
+        logger.warning("The %s call (%s) was cut off by its limit of %s tokens", call["site"], call["model"], call["max_tokens"])
+    if record["telemetry"] is not None:
+        record["telemetry"].add(call)
+    telemetry_totals.add(call)
+
+class LLMClient:
+    """Asynchronous streaming client used by every gpt() call.
+    It runs an event loop in a background thread and reuses one pooled httpx connection, so several requests can be in flight at the same time.
+    The timeout and the retries can be set per call (gpt() retries less when it can fall back to another model, see MODEL_ROUTES).
+    """
+    # Errors that are worth retrying (only when nothing has been streamed yet)
+    RETRY_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError)
+    # Model names used in this file that differ from the API names
+    MODEL_ALIASES = {'gpt-o3-mini': 'o3-mini'}
+
+    def __init__(self, api_key: str, timeout = 60, max_retries = 3, max_connections = 50, base_url = None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="llm-client", daemon=True)
+        self.thread.start()
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60),
+            timeout=httpx.Timeout(timeout, connect=10)
+        )
+        # Retries are done here so that a request is never retried after part of it has been shown to the player
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self.http_client, max_retries=0)
+
+    async def astream(self, messages: list, model = 'gpt-4o', max_tokens = None, record = None, **options):
+        """Stream the response. Yield the text chunks as they arrive. The options (e.g. response_format) are passed to the API.
+        record (see start_call) gets the model, the time to first token, the retries, the finish reason and the usage of the call.
+        The timeout (seconds) and max_retries options replace the client's for this call
+        """
+        model = self.MODEL_ALIASES.get(model, model)
+        if record is None:
+            record = start_call(None, model, False)
+        record["model"] = model
+        params = dict(options)
+        timeout = params.pop("timeout", None) or self.timeout
+        max_retries = params.pop("max_retries", self.max_retries)
+        if max_tokens:
+            # The reasoning models (o1, o3, ...) only accept max_completion_tokens
+            params["max_completion_tokens" if model.startswith("o") else "max_tokens"] = max_tokens
+        if model.startswith("o"):
+            # and no temperature
+            params.pop("temperature", None)
+        retry_count = 0
+        while True:
+            streamed = False
+            try:
+                stream = await self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=timeout,
+                    **params
+                )
+                async with stream:
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if not streamed:
+                                record["ttft"] = time.perf_counter() - record["start"]
+                            streamed = True
+                            yield chunk.choices[0].delta.content
+                        if chunk.choices and chunk.choices[0].finish_reason:
+                            record["finish_reason"] = chunk.choices[0].finish_reason
+                        if chunk.usage is not None:
+                            record_prompt_cache(chunk.usage)
+                            details = getattr(chunk.usage, "prompt_tokens_details", None)
+                            record["usage"] = {"prompt_tokens": chunk.usage.prompt_tokens or 0, "completion_tokens": chunk.usage.completion_tokens or 0,
+                                               "cached_tokens": (getattr(details, "cached_tokens", 0) or 0) if details else 0}
+                return
+            except self.RETRY_ERRORS as e:
+                if streamed or retry_count >= max_retries:
+                    raise
+                retry_count += 1
+                record["retries"] = retry_count
+                print(f"\n[Error] API error occurred: {e}. Retrying... ({retry_count}/{max_retries})")
+                await asyncio.sleep(2 ** retry_count)  # Exponential backoff
+
+    async def acomplete(self, messages: list, model = 'gpt-4o', max_tokens = None, record = None, **options):
+        """Return the full response"""
+        return "".join([text async for text in self.astream(messages, model, max_tokens, record, **options)])
+
+    def submit(self, messages: list, model = 'gpt-4o', max_tokens = None, record = None, **options):
+        """Start the request on the event loop. Return a concurrent.futures.Future of the full response"""
+        return asyncio.run_coroutine_threadsafe(self.acomplete(messages, model, max_tokens, record, **options), self.loop)
+
+    def stream(self, messages: list, model = 'gpt-4o', max_tokens = None, record = None, **options):
+        """Stream the response to the calling thread (so the chunks are printed by the caller). Stopping the iteration early cancels the request"""
+        chunks = queue.Queue()
+        end = object()
+
+        async def pump():
+            try:
+                async for text in self.astream(messages, model, max_tokens, record, **options):
+                    chunks.put(text)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(end)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item = chunks.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+# The generation profile of each call site: max_tokens, stop sequences, temperature and timeout (seconds) sent with the call,
+# and whether its responses are kept in the response cache (when the cache is on, see ResponseCache).
+# A site without its own profile uses the one of its prefix ("structured.enemy" -> "structured"), then "default". A field that is None is not sent.
+# The arguments of a gpt() call replace its profile. The narrations end with the key event trailer and the JSON block,
+# so they have no stop sequences and only a cap against runaway generations
+CALL_PROFILES = {
+    "default": {"max_tokens": None, "stop": None, "temperature": None, "timeout": 60, "cache": False},
+    "check_event": {"max_tokens": 8, "stop": ["\n\n"], "temperature": 0, "timeout": 15, "cache": True},
+    "keyevent": {"max_tokens": 80, "stop": ["\n\n"], "temperature": 0.3, "timeout": 20, "cache": True},
+    "chapter": {"max_tokens": 160, "stop": ["\n\n"], "temperature": 0.3, "timeout": 30, "cache": True},
+    "structured": {"max_tokens": 400, "stop": None, "temperature": 0, "timeout": 20, "cache": True},
+    "start.world": {"max_tokens": 1200},
+    "pool.world": {"max_tokens": 1200},
+    "start.character": {"max_tokens": 700},
+    # The narrations end with the key event trailer and often a JSON block, so their budget leaves room for both
+    "start.story": {"max_tokens": 1500},
+    "load.story": {"max_tokens": 1500},
+    "encounter.narration": {"max_tokens": 1500},
+    "event.narration": {"max_tokens": 1500},
+    "trade.narration": {"max_tokens": 1500},
+    "continue.narration": {"max_tokens": 1500},
+    "battle.round": {"max_tokens": 600}
+}
+PROFILE_FIELDS = ("max_tokens", "stop", "temperature", "timeout", "cache")
+
+def call_profile(site: str):
+    """Return the generation profile of a call site (see CALL_PROFILES)"""
+    profile = dict(CALL_PROFILES["default"])
+    parts = (site or "").split(".")
+    for i in range(1, len(parts) + 1):
+        profile.update(CALL_PROFILES.get(".".join(parts[:i]), {}))
+    return profile
+
+def apply_profile(site: str, max_tokens, options: dict):
+    """Return (max_tokens, options) of a call with the profile of its site filled in where the caller has not set them, and the profile used"""
+    profile = call_profile(site)
+    if max_tokens is not None:
+        profile["max_tokens"] = max_tokens
+    for field in ("stop", "temperature", "timeout"):
+        if field in options:
+            profile[field] = options[field]
+    options = {**options, **{field: profile[field] for field in ("stop", "temperature", "timeout") if profile[field] is not None}}
+    return profile["max_tokens"], options, profile
+
+# The models of each call site, in the order they are tried: when a model times out or fails before streaming anything,
+# the call falls back to the next one. A site without its own route uses the one of its prefix, then "default".
+# The routes can be replaced by the routes file ({call site: [model, ...]}) and in a game with /route.
+# A model passed to gpt() is tried first, then the rest of the route
+MODEL_ROUTES = {
+    "default": ["gpt-4o", "gpt-4o-mini"],
+    "keyevent": ["gpt-4o-mini", "gpt-4o"],
+    "chapter": ["gpt-4o-mini", "gpt-4o"],
+    "structured": ["gpt-4o-mini", "gpt-4o"]
+}
+ROUTES_FILE = os.environ.get("AIDM_ROUTES_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "routes.json")
+# Errors that make a call fall back to the next model of its route
+FALLBACK_ERRORS = (openai.APIError,)
+FALLBACK_RETRIES = 0 # The retries of a model that has a fallback (the last model of a route keeps the client's retries)
+
+def load_routes(path = ROUTES_FILE):
+    """Read the routes file into MODEL_ROUTES. A missing file is skipped"""
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            routes = json.load(file)
+        if not isinstance(routes, dict) or not all(isinstance(models, list) and models and all(isinstance(model, str) for model in models) for models in routes.values()):
+            raise ValueError("the routes have to be {call site: [model, ...]}")
+    except (OSError, ValueError) as e:
+        print(f"[Warning] The routes file {path} can not be read: {e}")
+        return
+    MODEL_ROUTES.update(routes)
+
+def site_route(site: str, routes = None):
+    """Return (the key in routes that decides the route of a call site, the models of the route)"""
+    routes = routes if routes is not None else MODEL_ROUTES
+    parts = (site or "").split(".")
+    for i in range(len(parts), 0, -1):
+        key = ".".join(parts[:i])
+        if key in routes:
+            return key, list(routes[key])
+    return "default", list(routes.get("default", MODEL_ROUTES["default"]))
+
+def route_models(site: str, model = None):
+    """Return the models a call tries in turn: the chosen model (if any), then the route of the call site in the running game (see game_scope)"""
+    story = active_story.get()
+    routes = {**MODEL_ROUTES, **story.settings["model_routes"]} if story is not None else MODEL_ROUTES
+    models = site_route(site, routes)[1]
+    if model:
+        models = [model] + [m for m in models if m != model]
+    return models
+
+def known_models():
+    """Return the models a game may route its calls to with /route: the ones of MODEL_PRICES and of the routes"""
+    return set(MODEL_PRICES) | {model for models in MODEL_ROUTES.values() for model in models}
+
+def fallback_options(options: dict, last: bool):
+    """Return the options of a call to a model of a route. A model that has a fallback is retried less, the fallback is its retry"""
+    if last or "max_retries" in options:
+        return options
+    return {**options, "max_retries": FALLBACK_RETRIES}
+
+load_routes()
+
+class ResponseCache:
+    """Opt-in cache of whole responses in a SQLite file, keyed by a hash of the model, the messages and the generation parameters.
+    A call whose response is in the cache returns it at once without a request (and without cost).
+    Only the call sites whose profile has "cache" are cached, unless sites is given. The least recently used responses are evicted
+    past max_bytes, and the responses older than max_age are dropped.
 
     Args:
-        messages (list): Full chat message
-        printChunk (bool): Decide whether to print the output of GPT. True means yes.
+        path (str): The SQLite file
+        max_bytes (int): The maximum total size of the cached responses
+        max_age (float): Seconds a response is kept after it has been stored
+        sites (set): The call sites (or prefixes such as "structured") to cache instead of the profiles' choice. {"*"} caches every call site
     """
-    max_retries = 3
-    retry_count = 0
-
-    while retry_count < max_retries:
+    EVICT_EVERY = 64 # Stores between two checks of the age
+
+    def __init__(self, path: str, max_bytes = 50 * 1024 * 1024, max_age = 7 * 24 * 60 * 60, sites = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sites = set(sites) if sites is not None else None
+        self.lock = threading.Lock()
+        self.counters = {} # site -> {"hits", "misses", "stores"}
+        self.evictions = 0
+        self.stores = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, site TEXT, model TEXT, response TEXT, size INTEGER, created REAL, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.db.commit()
+        with self.lock:
+            self.evict()
+
+    def enabled(self, site: str, profile: dict):
+        """Return True if the responses of a call site are cached"""
+        if self.sites is None:
+            return bool(profile.get("cache"))
+        parts = (site or "").split(".")
+        return "*" in self.sites or any(".".join(parts[:i]) in self.sites for i in range(1, len(parts) + 1))
+
+    @staticmethod
+    def key(model: str, messages: list, max_tokens, options: dict):
+        """Return the hash of a request. The options that do not change the response (timeout, retries) are left out"""
+        params = {name: value for name, value in options.items() if name not in ("timeout", "max_retries")}
+        request = json.dumps({"model": model, "messages": messages, "max_tokens": max_tokens, "options": params}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def count(self, site: str, counter: str):
+        counters = self.counters.setdefault(site or "other", {"hits": 0, "misses": 0, "stores": 0})
+        counters[counter] += 1
+
+    def get(self, key: str, site: str):
+        """Return the cached response of a request, or None"""
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] > self.max_age:
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.db.commit()
+                row = None
+            if row is None:
+                self.count(site, "misses")
+                return None
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.count(site, "hits")
+            return row[0]
+
+    def put(self, key: str, site: str, model: str, response: str):
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, site, model, response, len(response.encode('utf-8')), now, now))
+            self.stores += 1
+            self.count(site, "stores")
+            if self.stores % self.EVICT_EVERY == 0 or self.total_bytes() > self.max_bytes:
+                self.evict()
+            self.db.commit()
+
+    def total_bytes(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def evict(self):
+        """Drop the responses past max_age, then the least recently used ones until the cache is back under 90% of max_bytes (the lock is held)"""
+        evicted = self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)).rowcount
+        total = self.total_bytes()
+        if total > self.max_bytes:
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                if total <= 0.9 * self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        self.evictions += evicted
+        self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.db.execute("DELETE FROM responses")
+            self.db.commit()
+
+    def print_stats(self):
+        with self.lock:
+            counters = {site: dict(counts) for site, counts in self.counters.items()}
+            entries, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        print(f"Response cache: {self.path}, {entries} responses, {total / 1024:.0f} KB, {self.evictions} evicted")
+        for site, counts in sorted(counters.items()):
+            lookups = counts["hits"] + counts["misses"]
+            rate = f"{counts['hits'] / lookups:.0%}" if lookups else "-"
+            print(f"  {site:<22} {counts['hits']:>5} hits {counts['misses']:>5} misses ({rate} hit rate), {counts['stores']} stored")
+
+# The response cache (None when it is off). Turn it on with AIDM_RESPONSE_CACHE=file (and AIDM_RESPONSE_CACHE_SITES=site,site or * to choose the call sites)
+response_cache = None
+if os.environ.get("AIDM_RESPONSE_CACHE"):
+    cache_sites = os.environ.get("AIDM_RESPONSE_CACHE_SITES")
+    response_cache = ResponseCache(os.environ["AIDM_RESPONSE_CACHE"], sites=[site.strip() for site in cache_sites.split(",") if site.strip()] if cache_sites else None)
+
+def cache_lookup(site: str, profile: dict, model: str, messages: list, max_tokens, options: dict):
+    """Return (the cache key of a call, the cached response or None). The key is None when the call is not cached"""
+    if response_cache is None or not response_cache.enabled(site, profile):
+        return None, None
+    key = response_cache.key(model, messages, max_tokens, options)
+    return key, response_cache.get(key, site)
+
+def record_cache_hit(site: str, model: str, profile: dict, response: str, background = False):
+    """Count a call answered by the response cache in the telemetry (no tokens, no cost)"""
+    record = start_call(site, model, background, profile)
+    record["cached"] = True
+    record["usage"] = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    record["finish_reason"] = "cache"
+    finish_call(record, response)
+
+class StreamPrinter:
+    """Print a streamed response, hiding everything from the first marker on (the key event trailer and the JSON block of the game data).
+    The markers are matched ignoring case. The end of the printed text that could be the start of a marker is held back until the next chunk.
+    The text is written a whole word or line at a time (not once per token)
+    """
+    MAX_HELD = 80 # Characters without a space that are written anyway
+    def __init__(self, marker = None):
+        # One marker or a tuple of markers
+        self.markers = [m.lower() for m in ((marker,) if isinstance(marker, str) else (marker or ())) if m]
+        self.pending = ""
+        self.hidden = False
+
+    def feed(self, text: str):
+        if self.hidden:
+            return
+        self.pending += text
+        if not self.markers:
+            self.flush_words(len(self.pending))
+            return
+        pending = self.pending.lower()
+        indexes = [index for index in (pending.find(marker) for marker in self.markers) if index >= 0]
+        if indexes:
+            self.flush(min(indexes))
+            self.hidden = True
+            return
+        keep = 0
+        for marker in self.markers:
+            for size in range(min(len(marker) - 1, len(pending)), keep, -1):
+                if marker.startswith(pending[-size:]):
+                    keep = size
+                    break
+        self.flush_words(len(self.pending) - keep)
+
+    def flush_words(self, end: int):
+        """Write the text before end up to its last space or new line"""
+        boundary = max(self.pending.rfind(" ", 0, end), self.pending.rfind("\n", 0, end)) + 1
+        self.flush(boundary if boundary > 0 or end < self.MAX_HELD else end)
+
+    def flush(self, end: int):
+        if end > 0:
+            print(self.pending[:end], end="", flush=True)
+        self.pending = self.pending[end:]
+
+    def finish(self):
+        if not self.hidden:
+            self.flush(len(self.pending))
+        self.pending = ""
+
+class SpeculativeCall:
+    """A call started in the background before the game needs it (e.g. the world, while the player types their name).
+    The chunks are kept as they arrive, so gpt(prefetched=...) can replay them later: what has arrived is printed at once, then the rest as it streams.
+    It falls back down the route of the call site like gpt(), and is counted in the telemetry as a background call
+    """
+    def __init__(self, messages: list, model = None, max_tokens = None, site = None, **options):
+        self.messages = messages
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.site = site
+        max_tokens, options, profile = apply_profile(site, max_tokens, options)
+        models = route_models(site, model)
+        self.cache_key, cached = cache_lookup(site, profile, models[0], messages, max_tokens, options)
+        if cached is not None:
+            record_cache_hit(site, models[0], profile, cached, background=True)
+            self.chunks, self.finished, self.record, self.future = [cached], True, None, None
+            return
+        llm = get_llm()
+        self.record = start_call(site, models[0], True, profile)
+        self.future = asyncio.run_coroutine_threadsafe(self.run(llm, models, max_tokens, options), llm.loop)
+
+    async def run(self, llm: "LLMClient", models: list, max_tokens, options: dict):
         try:
-            stream = client.chat.completions.create(
-                model='gpt-4o-mini',
-                messages=messages,
-                stream=True,
-                timeout=60
-            )
-            response = []
-
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
-                    if(printChunk):
-                        print(chunk.choices[0].delta.content, end="", flush=True)
-                    response.append(chunk.choices[0].delta.content)
-
-            return "".join(str(element) for element in response)
-    
-            return full_response
-
-        except (openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError) as e:
-            retry_count += 1
-            print(f"\n[Error] API error occurred: {e}. Retrying... ({retry_count}/{max_retries})")
-            time.sleep(2 ** retry_count)  # Exponential backoff
-
-        except Exception as e:
-            print(f"\n[Error] Unexpected error: {e}")
-            break
+            for i, model in enumerate(models):
+                last = i == len(models) - 1
+                try:
+                    async for text in llm.astream(self.messages, model, max_tokens, self.record, **fallback_options(options, last)):
+                        with self.condition:
+                            self.chunks.append(text)
+                            self.condition.notify_all()
+                    break
+                except FALLBACK_ERRORS as e:
+                    if last or self.chunks:
+                        raise
+                    finish_call(self.record, error=e)
+                    print(f"\n[Error] {model} failed: {e}. Falling back to {models[i + 1]}...")
+                    self.record = fallback_call(self.record, models[i + 1])
+        except BaseException as e:
+            finish_call(self.record, "".join(self.chunks), e)
+            with self.condition:
+                self.error = e
+            raise
+        else:
+            finish_call(self.record, "".join(self.chunks))
+            if self.cache_key is not None:
+                response_cache.put(self.cache_key, self.site, self.record["model"], "".join(self.chunks))
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    @classmethod
+    def ready(cls, messages: list, text: str):
+        """Return a finished call whose response has been made elsewhere (e.g. a world of the world pool). It makes no request"""
+        call = cls.__new__(cls)
+        call.messages, call.chunks, call.finished, call.error = messages, [text], True, None
+        call.condition = threading.Condition()
+        call.record, call.future = None, None
+        return call
+
+    def usable(self, messages: list):
+        """Return True if the call was made with these messages and has not failed"""
+        with self.condition:
+            return self.error is None and self.messages == messages
+
+    def replay(self):
+        """Yield the chunks from the first one, waiting for the ones that have not arrived yet. Raise the error of the call if it fails"""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.chunks) and not self.finished:
+                    self.condition.wait()
+                chunks, finished, error = self.chunks[index:], self.finished, self.error
+            index += len(chunks)
+            yield from chunks
+            if finished:
+                if error is not None:
+                    raise error
+                return
 
-    return "[Error] Failed to complete the request after multiple attempts."
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
 
-def gpt_o3_mini_api_stream(messages: list, printChunk=True):
-    """Create response for provided chat message (stream) using gpt-o3mini.
+def gpt(messages:list, printChunk = True, model = None, max_tokens = None, hide_from = (JSON_MARKER, KEYEVENT_MARKER), site = None, parser = None, prefetched = None, **options):
+    """Create response for provided chat message (stream) using the chosen gpt model
 
     Args:
         messages (list): Full chat message
         printChunk (bool): Decide whether to print the output of GPT. True means yes.
+        model (str): The model tried first. None uses the route of the call site (see MODEL_ROUTES). If it fails, the call falls back to the next model of the route
+        max_tokens (int): The maximum tokens to generate. None uses the profile of the call site (see CALL_PROFILES)
+        hide_from (str or tuple): The printed output stops at the first of these markers (the JSON block of the game data and the key event trailer). None prints everything
+        site (str): The call site (e.g. "battle.option"). It chooses the generation profile, and the call is counted under it in the telemetry (see /stats)
+        parser (StreamFields): Reads fields out of the response while it is streamed. If it stops, the generation ends once every field is found
+        prefetched (SpeculativeCall): The same call started earlier. Its response is replayed instead of making the call again
+        options: Other parameters of the API (e.g. response_format). stop, temperature and timeout replace the profile's
+    Return:
+        The full response (up to where it was stopped)
     """
-    max_retries = 3
-    retry_count = 0
-
-    while retry_count < max_retries:
+    response = []
+    printer = StreamPrinter(hide_from)
+    if prefetched is not None:
+        # The call is counted in the telemetry by the SpeculativeCall
+        for text in prefetched.replay():
+            if(printChunk):
+                printer.feed(text)
+            response.append(text)
+        if(printChunk):
+            printer.finish()
+        return "".join(response)
+    max_tokens, options, profile = apply_profile(site, max_tokens, options)
+    models = route_models(site, model)
+    cache_key, cached = cache_lookup(site, profile, models[0], messages, max_tokens, options)
+    if cached is not None:
+        record_cache_hit(site, models[0], profile, cached)
+        if(printChunk):
+            printer.feed(cached)
+            printer.finish()
+        if parser is not None:
+            parser.feed(cached)
+            parser.finish()
+        return cached
+    record = start_call(site, models[0], False, profile)
+    for i, model in enumerate(models):
+        last = i == len(models) - 1
         try:
-            stream = client.chat.completions.create(
-                model='gpt-o3-mini',
-                messages=messages,
-                stream=True,
-                timeout=60
-            )
-            response = []
-
-            for chunk in stream:
-                if chunk.choices[0].delta.content is not None:
+            # Closing the stream cancels the request
+            with contextlib.closing(get_llm().stream(messages, model, max_tokens, record, **fallback_options(options, last))) as stream:
+                for text in stream:
                     if(printChunk):
-                        print(chunk.choices[0].delta.content, end="", flush=True)
-                    response.append(chunk.choices[0].delta.content)
-
-            return "".join(str(element) for element in response)
-    
-            return full_response
-
-        except (openai.error.APIError, openai.error.Timeout, openai.error.APIConnectionError) as e:
-            retry_count += 1
-            print(f"\n[Error] API error occurred: {e}. Retrying... ({retry_count}/{max_retries})")
-            time.sleep(2 ** retry_count)  # Exponential backoff
+                        printer.feed(text)
+                    response.append(text)
+                    if parser is not None:
+                        parser.feed(text)
+                        if parser.stop and parser.complete:
+                            record["stopped"] = True
+                            break
+            if parser is not None:
+                parser.finish()
+        except FALLBACK_ERRORS as e:
+            finish_call(record, "".join(response), e)
+            # A response that has been partly streamed can not be generated again by another model
+            if last or response:
+                raise
+            print(f"\n[Error] {model} failed: {e}. Falling back to {models[i + 1]}...")
+            record = fallback_call(record, models[i + 1])
+            continue
+        except BaseException as e:
+            finish_call(record, "".join(response), e)
+            raise
+        break
+    finish_call(record, "".join(response))
+    if cache_key is not None:
+        # A response stopped early by its parser is cached as it is: it has every field the call site reads
+        response_cache.put(cache_key, site, record["model"], "".join(response))
+    if(printChunk):
+        printer.finish()
+    return "".join(response)
+
+def gpt_async(messages:list, model = None, max_tokens = None, site = None, **options):
+    """Start the generation in the background without printing it. Return a Future of the full response.
+    Use it to overlap independent calls (summaries, classification, prefetches). It falls back down the route of the call site like gpt()
+    """
+    max_tokens, options, profile = apply_profile(site, max_tokens, options)
+    models = route_models(site, model)
+    cache_key, cached = cache_lookup(site, profile, models[0], messages, max_tokens, options)
+    if cached is not None:
+        record_cache_hit(site, models[0], profile, cached, background=True)
+        future = Future()
+        future.set_result(cached)
+        return future
+    llm = get_llm()
+    current = [start_call(site, models[0], True, profile)] # The record of the model being tried
+
+    async def complete():
+        for i, model in enumerate(models):
+            last = i == len(models) - 1
+            try:
+                return await llm.acomplete(messages, model, max_tokens, current[0], **fallback_options(options, last))
+            except FALLBACK_ERRORS as e:
+                if last:
+                    raise
+                finish_call(current[0], error=e)
+                print(f"\n[Error] {model} failed: {e}. Falling back to {models[i + 1]}...")
+                current[0] = fallback_call(current[0], models[i + 1])
+
+    future = asyncio.run_coroutine_threadsafe(complete(), llm.loop)
+
+    def finished(future):
+        record = current[0]
+        if future.cancelled():
+            finish_call(record, error=asyncio.CancelledError())
+        elif future.exception() is not None:
+            finish_call(record, error=future.exception())
+        else:
+            finish_call(record, future.result())
+            if cache_key is not None:
+                response_cache.put(cache_key, site, record["model"], future.result())
 
-        except Exception as e:
-            print(f"\n[Error] Unexpected error: {e}")
-            break
+    future.add_done_callback(finished)
+    return future
 
-    return "[Error] Failed to complete the request after multiple attempts."
+async def agpt(messages:list, model = None, max_tokens = None, site = None, **options):
+    """Asynchronous version of gpt() (without printing) that can be awaited from any event loop"""
+    return await asyncio.wrap_future(gpt_async(messages, model, max_tokens, site, **options))
 
 
-if __name__ == '__main__':
+def play(player: Character, story: Story):
+    """The whole game as a resumable generator. It yields a prompt whenever it needs the player's input, and gets the input back from send().
+    The CLI (run_cli) and the HTTP server (server.py) both drive the game through this generator, so no thread waits for the player.
+    """
+    # The world does not depend on the name, so it is generated while the player types it
+    prefetchWorld(story)
     print("Welcome to the AI Dungeon! You may use /help to check some commands useful for the game. Now please input your character name:")
-    player = Character()
-    story = Story()
-    user_input = input()
+    user_input = yield ""
     if(user_input.startswith("/read")):
-        user_input = command_input(player, story, uinput=user_input)
-        loadStory(player, story)
+        cancel_prefetched(story)
+        user_input = yield from command_input(player, story, uinput=user_input)
+        if story.journal is None:
+            # A loaded game starts its own autosave. This one is for a game that could not be loaded
+            start_autosave(player, story)
+        yield from loadStory(player, story)
     else:
         player.name = user_input
-        startDM(player, story)
+        yield from startDM(player, story)
+        start_autosave(player, story)
         # startFirstTrade(player, story)
-        startStory(player, story)
+        yield from startStory(player, story)
     while True:
         if(player.hp <= 0):
             print("Your HP is 0. Game over.")
             break
         event_type = checkEvent(player, story)
         if("encounter" in event_type.lower()):
-            encounter(player, story)
+            yield from encounter(player, story)
         elif("battle" in event_type.lower()):
-            battle(player, story)
+            yield from battle(player, story)
         elif("event" in event_type.lower()):
-            event(player, story)
+            yield from event(player, story)
         elif("trade" in event_type.lower()):
-            trade(player, story)
+            yield from trade(player, story)
         elif("none" in event_type.lower()):
-            continueStory(player, story)
-    
-            
-            
+            yield from continueStory(player, story)
+
+def run_cli(game, story = None):
+    """Play the game in the terminal: answer each prompt of the game generator with input().
+    The LLM calls are counted into the telemetry of story (if given) and follow its model routes
+    """
+    with game_scope(story):
+        prompt = next(game)
+        while True:
+            try:
+                prompt = game.send(input(prompt))
+            except StopIteration:
+                break
+
+
+if __name__ == '__main__':
+    player, story = Character(), Story()
+    run_cli(play(player, story), story)
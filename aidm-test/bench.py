@@ -0,0 +1,248 @@
+"""Offline latency benchmark of the game.
+
+It plays scripted games against the fake OpenAI server (fake_openai.py) with the dice seeded, so two runs make the same
+calls and roll the same numbers. For every turn (from the player's input to the next prompt) it reports the wall time, the
+time the game waited for the model (network), the rest (local overhead), and the calls made by the turn.
+
+    python bench.py                                  # every scenario
+    python bench.py --scenario battle --ttft 0.8 --tps 30 --seed 7
+    python bench.py --json bench.json --max-local-ms 50 --max-calls 4
+    python bench.py --scenario encounter --think 2   # the player takes 2 seconds to type every input
+    python bench.py --cache replay.sqlite            # cache every response: a second run replays the game from the cache
+With --max-local-ms or --max-calls it exits with 1 when a scenario is over the budget, so it can run in CI.
+"""
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from fake_openai import RECORDINGS_FILE, FakeOpenAI, load_recordings
+
+# Scenarios: the flows played after the character is created and the story has started.
+# "auto" lets checkEvent choose the flow, as in play()
+SCENARIOS = {
+    "encounter": ["encounter", "encounter"],
+    "battle": ["battle", "battle"],
+    "event": ["event", "event"],
+    "trade": ["trade", "trade"],
+    "continue": ["continue", "continue"],
+    "tour": ["encounter", "event", "trade", "battle", "continue", "auto", "auto"]
+}
+# What the player types, in turn
+ACTIONS = [
+    "I take the map and follow the hill road north",
+    "I raise my sword and roar to scare them off",
+    "I swing my sword at the nearest enemy",
+    "I help the old man and ask what happened",
+    "I buy the healing draught",
+    "I search the ruins for anything useful",
+    "I keep walking towards the towers"
+]
+
+
+class Meter:
+    """Measures the time the game thread waits for the model: in gpt() and on the key event summaries running in the background"""
+    def __init__(self):
+        self.wait = 0.0
+        self.calls = 0
+        self.cached = 0 # Calls of the game thread answered by the response cache (they make no request)
+        self.depth = 0 # Only the outermost measured call is timed (the memory may wait for a chapter summary made with gpt())
+
+    def wrap(self, function, count = False):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            self.depth += 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.wait += time.perf_counter() - start
+                # A replayed call (started earlier in the background) makes no request of its own
+                if count and kwargs.get("prefetched") is None:
+                    self.calls += 1
+        return timed
+
+    def count_cached(self, function):
+        @functools.wraps(function)
+        def counted(*args, **kwargs):
+            if not kwargs.get("background"):
+                self.cached += 1
+            return function(*args, **kwargs)
+        return counted
+
+
+def next_flow(aidm, player, story):
+    """Choose the flow the way play() does"""
+    event_type = aidm.checkEvent(player, story).lower()
+    for name in ("encounter", "battle", "event", "trade"):
+        if name in event_type:
+            return name
+    return "continue"
+
+
+def scripted_game(aidm, player, story, flows, stage, save_dir):
+    """The game of a scenario, as a generator like play(). stage[0] is the flow being played"""
+    flow_functions = {"encounter": aidm.encounter, "battle": aidm.battle, "event": aidm.event, "trade": aidm.trade, "continue": aidm.continueStory}
+    stage[0] = "start"
+    # As play(): the world is generated while the player types the name
+    aidm.prefetchWorld(story)
+    yield "Now please input your character name: "
+    player.name = "Bench"
+    yield from aidm.startDM(player, story)
+    if save_dir:
+        # Autosave as play() does, into a temporary folder
+        journal = aidm.Journal("bench", folder=save_dir)
+        journal.open()
+        aidm.attach_journal(player, story, journal)
+        aidm.snapshot_game(player, story)
+    yield from aidm.startStory(player, story)
+    for flow in flows:
+        if player.hp <= 0:
+            return
+        if flow == "auto":
+            flow = next_flow(aidm, player, story)
+        stage[0] = flow
+        yield from flow_functions[flow](player, story)
+
+
+def run_scenario(aidm, fake, name, seed, autosave = True, show = False, think = 0.0, max_turns = 100):
+    """Play a scenario. Return the list of turns: {"turn", "flow", "wall", "network", "local", "calls", "cached", "background"} (times in seconds).
+    calls are the requests of the game thread, cached its calls answered by the response cache.
+    think is the time (seconds) the player takes to type each input. It is not counted in the turns, but the calls in the background go on during it
+    """
+    random.seed(seed)
+    fake.reset()
+    meter = Meter()
+    gpt = getattr(aidm.gpt, "__wrapped__", aidm.gpt)
+    get_key_event_memory = getattr(aidm.Story.get_key_event_memory, "__wrapped__", aidm.Story.get_key_event_memory)
+    aidm.gpt = meter.wrap(gpt, count=True)
+    aidm.Story.get_key_event_memory = meter.wrap(get_key_event_memory)
+    aidm.record_cache_hit = meter.count_cached(getattr(aidm.record_cache_hit, "__wrapped__", aidm.record_cache_hit))
+    player, story = aidm.Character(), aidm.Story()
+    stage = [None]
+    turns = []
+    with tempfile.TemporaryDirectory() as save_dir:
+        game = scripted_game(aidm, player, story, SCENARIOS[name], stage, save_dir if autosave else None)
+        output = sys.stdout if show else io.StringIO()
+        user_input = None
+        requests = fake.request_count()
+        for turn in range(max_turns):
+            wait, calls, cached = meter.wait, meter.calls, meter.cached
+            start = time.perf_counter()
+            finished = False
+            with contextlib.redirect_stdout(output):
+                try:
+                    prompt = next(game) if user_input is None else game.send(user_input)
+                except StopIteration:
+                    finished = True
+            if finished:
+                break
+            wall = time.perf_counter() - start
+            network = meter.wait - wait
+            cached = meter.cached - cached
+            calls = meter.calls - calls - cached
+            turns.append({"turn": turn, "flow": stage[0], "wall": wall, "network": network, "local": wall - network,
+                          "calls": calls, "cached": cached, "background": fake.request_count() - requests - calls})
+            # The requests that arrive while the player types are counted in the next turn
+            requests = fake.request_count()
+            if show:
+                print(prompt, end="")
+            user_input = "" if "Confirm" in prompt else "1" if "choice" in prompt else ACTIONS[turn % len(ACTIONS)]
+            time.sleep(think)
+            if show:
+                print(user_input)
+        game.close()
+        # Let the summaries still running in the background finish, so they are not counted in the next scenario
+        story.collect_key_events()
+        if story.journal is not None:
+            story.history.close()
+            story.journal.close()
+    return turns
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def summarize(turns):
+    """Return the totals of a list of turns (times in milliseconds)"""
+    return {
+        "turns": len(turns),
+        "wall_ms": 1000 * statistics.mean(turn["wall"] for turn in turns),
+        "network_ms": 1000 * statistics.mean(turn["network"] for turn in turns),
+        "local_ms": 1000 * statistics.mean(turn["local"] for turn in turns),
+        "local_p95_ms": 1000 * percentile([turn["local"] for turn in turns], 0.95),
+        "calls_per_turn": statistics.mean(turn["calls"] for turn in turns),
+        "max_calls": max(turn["calls"] for turn in turns),
+        "cached_per_turn": statistics.mean(turn["cached"] for turn in turns),
+        "background_per_turn": statistics.mean(turn["background"] for turn in turns)
+    }
+
+
+def print_report(name, turns):
+    print(f"\nScenario: {name}")
+    print(f"{'Turn':>4}  {'Flow':<10} {'Wall ms':>9} {'Network ms':>11} {'Local ms':>9} {'Calls':>6} {'Cached':>7} {'Background':>11}")
+    for turn in turns:
+        print(f"{turn['turn']:>4}  {turn['flow']:<10} {1000 * turn['wall']:>9.1f} {1000 * turn['network']:>11.1f} {1000 * turn['local']:>9.1f} {turn['calls']:>6} {turn['cached']:>7} {turn['background']:>11}")
+    for flow in dict.fromkeys(turn["flow"] for turn in turns):
+        total = summarize([turn for turn in turns if turn["flow"] == flow])
+        print(f"  {flow:<10} {total['turns']:>3} turns, wall {total['wall_ms']:.1f} ms, network {total['network_ms']:.1f} ms, "
+              f"local {total['local_ms']:.1f} ms (p95 {total['local_p95_ms']:.1f}), calls {total['calls_per_turn']:.2f}/turn, cached {total['cached_per_turn']:.2f}/turn, background {total['background_per_turn']:.2f}/turn")
+    total = summarize(turns)
+    print(f"  {'all':<10} {total['turns']:>3} turns, wall {total['wall_ms']:.1f} ms, network {total['network_ms']:.1f} ms, "
+          f"local {total['local_ms']:.1f} ms (p95 {total['local_p95_ms']:.1f}), calls {total['calls_per_turn']:.2f}/turn, cached {total['cached_per_turn']:.2f}/turn, background {total['background_per_turn']:.2f}/turn")
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the latency of scripted games against a local fake OpenAI server")
+    parser.add_argument("--scenario", choices=list(SCENARIOS) + ["all"], default="all")
+    parser.add_argument("--seed", type=int, default=1, help="The seed of the dice. Default is 1")
+    parser.add_argument("--ttft", type=float, default=0.3, help="Seconds before the first token. Default is 0.3")
+    parser.add_argument("--tps", type=float, default=200, help="Tokens per second. Default is 200")
+    parser.add_argument("--recordings", default=RECORDINGS_FILE, help="The recorded responses. Default is bench_recordings.json")
+    parser.add_argument("--cache", help="Cache the responses of every call site in this SQLite file (see ResponseCache)")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds the player takes to type each input. Default is 0")
+    parser.add_argument("--no-autosave", action="store_true", help="Do not autosave (the journal is written to a temporary folder)")
+    parser.add_argument("--show", action="store_true", help="Show the game output")
+    parser.add_argument("--json", help="Write the turns and the totals to this file")
+    parser.add_argument("--max-local-ms", type=float, help="Fail if the mean local overhead of a turn is over this")
+    parser.add_argument("--max-calls", type=int, help="Fail if a turn makes more calls than this (not counting the background calls)")
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(load_recordings(args.recordings), ttft=args.ttft, tps=args.tps).start()
+    # The game gets its client from these instead of the key endpoint
+    os.environ["AIDM_BASE_URL"] = fake.base_url
+    os.environ["AIDM_API_KEY"] = "fake"
+    if args.cache:
+        os.environ["AIDM_RESPONSE_CACHE"] = args.cache
+        os.environ["AIDM_RESPONSE_CACHE_SITES"] = "*"
+    import aidm
+
+    results = {}
+    failures = []
+    for name in (SCENARIOS if args.scenario == "all" else [args.scenario]):
+        turns = run_scenario(aidm, fake, name, args.seed, autosave=not args.no_autosave, show=args.show, think=args.think)
+        total = print_report(name, turns)
+        results[name] = {"turns": turns, "total": total}
+        if args.max_local_ms is not None and total["local_ms"] > args.max_local_ms:
+            failures.append(f"{name}: local overhead {total['local_ms']:.1f} ms per turn is over {args.max_local_ms} ms")
+        if args.max_calls is not None and total["max_calls"] > args.max_calls:
+            failures.append(f"{name}: a turn makes {total['max_calls']} calls, more than {args.max_calls}")
+    fake.stop()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({"seed": args.seed, "ttft": args.ttft, "tps": args.tps, "think": args.think, "scenarios": results}, file, indent=2)
+    for failure in failures:
+        print(f"[Over budget] {failure}")
+    sys.exit(1 if failures else 0)
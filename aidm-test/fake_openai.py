@@ -0,0 +1,215 @@
+"""A local fake of the OpenAI chat completions API, for benchmarks and offline play.
+
+It replays recorded responses (see bench_recordings.json) as a real streamed response: the first chunk comes after the
+time-to-first-token, then the words come at the given tokens per second. Nothing is sent to the network.
+
+Run it on its own and point the game at it:
+    python fake_openai.py --port 8001 --ttft 0.5 --tps 40
+    AIDM_BASE_URL=http://127.0.0.1:8001/v1 AIDM_API_KEY=fake python aidm.py
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RECORDINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_recordings.json")
+
+
+def load_recordings(path = RECORDINGS_FILE):
+    """Read a recordings file: {"responses": [rule, ...], "default": text}.
+    A rule has the text to reply ("text", or a list of texts that are replayed in turn) and what the request has to contain to get it:
+    "match" (in the last message), "system" (in the first message) and "json" (true if the request asks for a JSON object).
+    A rule may also have its own "ttft" and "tps".
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def split_tokens(text: str):
+    """Split a text into the chunks that are streamed (about one token each)"""
+    return re.findall(r"\S+\s*|\s+", text)
+
+
+class FakeOpenAI:
+    """The fake server. It runs in a background thread until stop() is called.
+
+    Args:
+        recordings (dict): The recordings, see load_recordings
+        ttft (float): Seconds before the first chunk of a response
+        tps (float): Chunks (tokens) per second after the first one. 0 sends them all at once
+        host, port: Where the server listens. Port 0 picks a free port
+        fail_models: Models that are "down": their requests fail with 503 after the ttft (to try the model fallbacks)
+    """
+    def __init__(self, recordings: dict, ttft = 0.3, tps = 60, host = "127.0.0.1", port = 0, fail_models = ()):
+        self.recordings = recordings
+        self.ttft = ttft
+        self.tps = tps
+        self.fail_models = set(fail_models)
+        self.replayed = {} # Rule index -> how many times its texts have been replayed
+        self.requests = [] # {"start", "end", "model", "rule"} of every request, in the order they arrived. "end" is None while it is running
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request_count(self):
+        """Return the number of requests received so far (including the running ones)"""
+        with self.lock:
+            return len(self.requests)
+
+    def reset(self):
+        """Forget the requests and replay every recording from its first text again"""
+        with self.lock:
+            self.requests = []
+            self.replayed = {}
+
+    def find_rule(self, body: dict):
+        """Return (rule index, rule) of the first rule that matches the request, or (None, None)"""
+        messages = body.get("messages") or [{"content": ""}]
+        first, last = str(messages[0].get("content", "")), str(messages[-1].get("content", ""))
+        wants_json = (body.get("response_format") or {}).get("type") == "json_object"
+        for index, rule in enumerate(self.recordings.get("responses", [])):
+            if "match" in rule and rule["match"] not in last:
+                continue
+            if "system" in rule and rule["system"] not in first:
+                continue
+            if "json" in rule and rule["json"] != wants_json:
+                continue
+            return index, rule
+        return None, None
+
+    def reply(self, body: dict):
+        """Return (rule index, text, ttft, tps) for a request"""
+        index, rule = self.find_rule(body)
+        if rule is None:
+            return None, self.recordings.get("default", ""), self.ttft, self.tps
+        text = rule["text"]
+        if isinstance(text, list):
+            with self.lock:
+                count = self.replayed.get(index, 0)
+                self.replayed[index] = count + 1
+            text = text[count % len(text)]
+        return index, text, rule.get("ttft", self.ttft), rule.get("tps", self.tps)
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                start = time.perf_counter()
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                failed = body.get("model") in fake.fail_models
+                index, text, ttft, tps = (None, "", fake.ttft, fake.tps) if failed else fake.reply(body)
+                entry = {"start": start, "end": None, "model": body.get("model", ""), "rule": index}
+                with fake.lock:
+                    fake.requests.append(entry)
+                if failed:
+                    time.sleep(ttft)
+                    self.send_json(503, {"error": {"message": f"The model {body.get('model')} is overloaded", "type": "server_error"}})
+                    entry["end"] = time.perf_counter()
+                    return
+                tokens, finish_reason = fake.limit(text, body)
+                prompt_tokens = sum(len(str(message.get("content", ""))) for message in body.get("messages", [])) // 4
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens),
+                         "prompt_tokens_details": {"cached_tokens": 0}}
+                try:
+                    if body.get("stream"):
+                        self.stream(body, tokens, finish_reason, usage, start, ttft, tps)
+                    else:
+                        time.sleep(ttft + (len(tokens) / tps if tps else 0))
+                        self.send_json(200, {"id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()), "model": body.get("model", ""),
+                                             "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": finish_reason}],
+                                             "usage": usage})
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client cancelled the request
+                    pass
+                entry["end"] = time.perf_counter()
+
+            def send_json(self, status, data):
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def send_event(self, data):
+                payload = f"data: {data}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(payload), payload))
+                self.wfile.flush()
+
+            def stream(self, body, tokens, finish_reason, usage, start, ttft, tps):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": body.get("model", "")}
+                for i, token in enumerate(tokens):
+                    # Keep to the schedule (rather than sleeping after every chunk) so the rate does not drift
+                    delay = start + ttft + (i / tps if tps else 0) - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.send_event(json.dumps({**chunk, "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}))
+                self.send_event(json.dumps({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}))
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self.send_event(json.dumps({**chunk, "choices": [], "usage": usage}))
+                self.send_event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+        return Handler
+
+    @staticmethod
+    def limit(text: str, body: dict):
+        """Apply the stop sequences and the token limit of the request. Return (tokens, finish reason)"""
+        stop = body.get("stop") or []
+        for sequence in [stop] if isinstance(stop, str) else stop:
+            if sequence and sequence in text:
+                text = text[:text.find(sequence)]
+        tokens = split_tokens(text)
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        if max_tokens and len(tokens) > max_tokens:
+            return tokens[:max_tokens], "length"
+        return tokens, "stop"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded responses as a fake OpenAI chat completions API")
+    parser.add_argument("--recordings", default=RECORDINGS_FILE, help="The recordings file. Default is bench_recordings.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.5, help="Seconds before the first token. Default is 0.5")
+    parser.add_argument("--tps", type=float, default=40, help="Tokens per second. Default is 40")
+    parser.add_argument("--fail-model", action="append", default=[], help="A model whose requests fail (can be given more than once)")
+    args = parser.parse_args()
+    fake = FakeOpenAI(load_recordings(args.recordings), ttft=args.ttft, tps=args.tps, host=args.host, port=args.port, fail_models=args.fail_model)
+    print(f"Replaying {args.recordings} at {fake.base_url} (Ctrl+C to stop)")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.server.server_close()
@@ -0,0 +1,259 @@
+"""HTTP server mode of the AI Dungeon Master.
+
+Every game is a resumable session (the play() generator of aidm.py) kept in memory. A request runs the game
+until it needs the player's input again and returns what was printed, so no thread waits for a player.
+
+Run it from the aidm-test folder with (one worker, since the sessions live in the worker's memory):
+    gunicorn -w 1 -k gthread --threads 64 -b 0.0.0.0:8000 server:app
+"""
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+from flask import Flask, jsonify, request
+
+import aidm
+import worldpool
+
+SESSION_TTL = 2 * 60 * 60 # Seconds before an idle session is removed
+# Every session saves into its own folder: /save, /read and the autosaves only see the files of that session
+SESSION_SAVE_DIR = os.path.join(aidm.SAVE_DIR, "sessions")
+
+# New games draw their world from the world pool when there is a pool file (fill it with: python worldpool.py --count 20)
+if os.path.exists(worldpool.POOL_FILE):
+    aidm.world_pool = worldpool.WorldPool(worldpool.POOL_FILE)
+
+
+class SessionOutput(io.TextIOBase):
+    """Stand-in for sys.stdout that sends print() of a thread running a session step into that session's buffer (see install_output)"""
+    def __init__(self, stdout = None):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "buffer", None) or self.stdout
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def release(self):
+        self.local.buffer = None
+
+
+output = SessionOutput()
+
+
+def install_output():
+    """Put the SessionOutput in place of sys.stdout. It is done when the server handles its first request, not on import"""
+    if sys.stdout is not output:
+        output.stdout = sys.stdout
+        sys.stdout = output
+
+
+class GameSession:
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.player = aidm.Character()
+        self.story = aidm.Story()
+        self.story.save_dir = os.path.join(SESSION_SAVE_DIR, self.id)
+        self.game = aidm.play(self.player, self.story)
+        self.prompt = None
+        self.finished = False
+        self.lock = threading.Lock()
+        self.last_active = time.time()
+
+    def step(self, user_input = None):
+        """Run the game until it needs the next input. Return what has been printed"""
+        buffer = io.StringIO()
+        output.capture(buffer)
+        try:
+            # The LLM calls of the step are counted into this session's telemetry and follow its model routes
+            with aidm.game_scope(self.story):
+                if user_input is None:
+                    self.prompt = next(self.game)
+                else:
+                    self.prompt = self.game.send(user_input)
+        except StopIteration:
+            self.finished = True
+            self.prompt = None
+        except Exception:
+            self.finished = True
+            self.prompt = None
+            traceback.print_exc(file=output.stdout)
+            buffer.write("\n[Error] The game has stopped because of an unexpected error.")
+        finally:
+            output.release()
+            self.last_active = time.time()
+        return buffer.getvalue()
+
+    def command(self, text):
+        """Run a command (e.g. /me) without advancing the game. Return what has been printed"""
+        buffer = io.StringIO()
+        output.capture(buffer)
+        try:
+            with aidm.game_scope(self.story):
+                aidm.run_command(self.player, self.story, text)
+        except Exception:
+            traceback.print_exc(file=output.stdout)
+            buffer.write("\n[Error] The command has failed.")
+        finally:
+            output.release()
+            self.last_active = time.time()
+        return buffer.getvalue()
+
+    def to_dict(self, text = ""):
+        return {
+            "session_id": self.id,
+            "output": text,
+            "prompt": self.prompt,
+            "finished": self.finished
+        }
+
+
+app = Flask(__name__)
+app.before_request(install_output)
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def remove_idle_sessions():
+    now = time.time()
+    with sessions_lock:
+        for session_id in [key for key, session in sessions.items() if now - session.last_active > SESSION_TTL]:
+            close_game(sessions.pop(session_id))
+
+
+def close_game(session):
+    try:
+        session.game.close()
+    except ValueError:
+        # The session is still running a step; the generator is dropped with the session, and its saves are removed once the step is over
+        threading.Thread(target=remove_saves_after_step, args=(session,), name="remove-saves", daemon=True).start()
+        return
+    # No other session can read the saves of this one
+    shutil.rmtree(session.story.save_dir, ignore_errors=True)
+
+
+def remove_saves_after_step(session):
+    """Remove the save folder of a closed session once its running step is over (it may still be writing its journal)"""
+    with session.lock:
+        shutil.rmtree(session.story.save_dir, ignore_errors=True)
+
+
+def get_session(session_id):
+    with sessions_lock:
+        return sessions.get(session_id)
+
+
+@app.post("/sessions")
+def create_session():
+    """Start a new game. The output has the welcome message and the prompt asks for the character name"""
+    remove_idle_sessions()
+    session = GameSession()
+    with sessions_lock:
+        sessions[session.id] = session
+    with session.lock:
+        text = session.step()
+    return jsonify(session.to_dict(text)), 201
+
+
+@app.post("/sessions/<session_id>/input")
+def send_input(session_id):
+    """Send the player's input (JSON: {"input": "..."}) and run the game until it needs the next input"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    data = request.get_json(silent=True) or {}
+    user_input = data.get("input")
+    if not isinstance(user_input, str):
+        return jsonify({"error": "Missing input"}), 400
+    if session.finished:
+        return jsonify({"error": "The game has finished"}), 409
+    # Only one step of a session can run at a time
+    if not session.lock.acquire(blocking=False):
+        return jsonify({"error": "The previous input is still being processed"}), 409
+    try:
+        text = session.step(user_input)
+    finally:
+        session.lock.release()
+    return jsonify(session.to_dict(text))
+
+
+@app.post("/sessions/<session_id>/command")
+def send_command(session_id):
+    """Run a command (JSON: {"command": "/me"}) while the game waits for the player's input. The game does not advance"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    data = request.get_json(silent=True) or {}
+    text = data.get("command")
+    if not isinstance(text, str) or not text.startswith("/"):
+        return jsonify({"error": "Missing command"}), 400
+    if not session.lock.acquire(blocking=False):
+        return jsonify({"error": "The previous input is still being processed"}), 409
+    try:
+        text = session.command(text)
+    finally:
+        session.lock.release()
+    return jsonify(session.to_dict(text))
+
+
+@app.get("/sessions/<session_id>")
+def show_session(session_id):
+    """Show the current prompt and the player's character"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    state = session.to_dict()
+    state["character"] = session.player.to_dict()
+    return jsonify(state)
+
+
+@app.get("/sessions/<session_id>/stats")
+def show_stats(session_id):
+    """Show the time, tokens and cost of the session's LLM calls by call site"""
+    session = get_session(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"session_id": session.id, "sites": session.story.telemetry.summary()})
+
+
+@app.get("/metrics")
+def metrics():
+    """The LLM call statistics of all sessions in the Prometheus text format"""
+    with sessions_lock:
+        active = len(sessions)
+    text = aidm.telemetry_totals.prometheus()
+    text += f"# HELP aidm_sessions Game sessions kept in memory\n# TYPE aidm_sessions gauge\naidm_sessions {active}\n"
+    if aidm.world_pool is not None:
+        text += "# HELP aidm_world_pool_worlds Worlds in the world pool\n# TYPE aidm_world_pool_worlds gauge\n"
+        for rule, count in aidm.world_pool.stats().items():
+            attributes = aidm.prometheus_label(",".join(json.loads(rule)["attributes"]))
+            text += f'aidm_world_pool_worlds{{attributes="{attributes}"}} {count}\n'
+    return text, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.delete("/sessions/<session_id>")
+def delete_session(session_id):
+    with sessions_lock:
+        session = sessions.pop(session_id, None)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    close_game(session)
+    return "", 204
+
+
+if __name__ == '__main__':
+    app.run(threaded=True)
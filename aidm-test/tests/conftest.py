@@ -0,0 +1,40 @@
+"""Shared fixtures of the tests. They run offline: every LLM call goes to a local fake_openai.FakeOpenAI."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_openai import FakeOpenAI
+
+# The game creates its client on the first call, from these (no key is fetched)
+FAKE = FakeOpenAI({"responses": [], "default": ""}, ttft=0, tps=0).start()
+os.environ["AIDM_BASE_URL"] = FAKE.base_url
+os.environ["AIDM_API_KEY"] = "fake"
+os.environ.pop("AIDM_RESPONSE_CACHE", None)
+
+import aidm
+
+
+@pytest.fixture
+def fake():
+    """The fake server, with no recordings and no requests. Set fake.recordings in the test"""
+    FAKE.recordings = {"responses": [], "default": ""}
+    FAKE.reset()
+    return FAKE
+
+
+@pytest.fixture
+def story(tmp_path):
+    """A story whose saves go into a temporary folder"""
+    story = aidm.Story()
+    story.save_dir = str(tmp_path)
+    return story
+
+
+@pytest.fixture
+def player(story):
+    player = aidm.Character(name="Tester", story=story)
+    player.init_attributes()
+    return player
@@ -0,0 +1,44 @@
+import pytest
+
+import aidm
+
+
+@pytest.mark.parametrize("condition, total, requirement, expected", [
+    ("total > requirement", 10, 9, True),
+    ("total > requirement", 9, 9, False),
+    ("total >= requirement and not total == 12", 12, 10, False),
+    ("total * 2 - 1 >= requirement or total % 6 == 0", 6, 100, True),
+    ("total / requirement > 1", 5, 0, False),  # division by zero fails the roll
+])
+def test_allowed_conditions(condition, total, requirement, expected):
+    assert aidm.compile_condition(condition)(total, requirement) is expected
+
+
+@pytest.mark.parametrize("condition", [
+    "__import__('os').system('true')",
+    "total.__class__",
+    "open('x')",
+    "[total][0] > 1",
+    "lambda: 1",
+    "'a' < 'b'",
+    "total if requirement else 0",
+    "player > requirement",
+    "total > requirement; 1",
+    "total ** 999999 > requirement",
+])
+def test_rejected_conditions(condition):
+    with pytest.raises(ValueError):
+        aidm.compile_condition(condition)
+
+
+def test_rejected_rule_keeps_the_old_one(story):
+    with pytest.raises(ValueError):
+        story.update_gamerule("success_condition", "__import__('os')")
+    assert story.gameruledict["success_condition"] == "total > requirement"
+    assert story.success_check(5, 4)
+
+
+@pytest.mark.parametrize("key, value", [("dice_sides", 0), ("dice_sides", 101), ("max_attribute_point", 21), ("dice_sides", "6")])
+def test_number_rules_are_bounded(story, key, value):
+    with pytest.raises(ValueError):
+        story.update_gamerule(key, value)
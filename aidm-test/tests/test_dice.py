@@ -0,0 +1,30 @@
+import itertools
+from collections import Counter
+
+import pytest
+
+import aidm
+
+
+@pytest.mark.parametrize("count, sides", [(0, 6), (1, 6), (3, 6), (4, 4), (2, 10)])
+def test_exact_distribution(count, sides):
+    outcomes = Counter(sum(roll) for roll in itertools.product(range(1, sides + 1), repeat=count))
+    distribution = dict(aidm.dice_distribution(count, sides))
+    assert set(distribution) == set(outcomes)
+    for total, ways in outcomes.items():
+        assert distribution[total] == pytest.approx(ways / sides ** count)
+
+
+def test_large_dice_are_approximated():
+    distribution = aidm.dice_distribution(20, 100)
+    assert len(distribution) <= aidm.DICE_APPROXIMATE_POINTS
+    assert sum(chance for _, chance in distribution) == pytest.approx(1)
+    mean = sum(total * chance for total, chance in distribution)
+    assert mean == pytest.approx(20 * 101 / 2, rel=0.01)
+
+
+def test_chances(story, player):
+    player.attributes["Strength"] = 3
+    assert aidm.success_chance(player, "Strength", 10, story) == pytest.approx(0.5)
+    enemy = aidm.Character(attributes={"Strength": 3})
+    assert 0.4 < aidm.opposed_chance(player, enemy, "Strength", story) < 0.5
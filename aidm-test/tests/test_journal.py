@@ -0,0 +1,81 @@
+import os
+
+import aidm
+
+
+def start_game(story, player):
+    story.add_event("The background of the world")
+    aidm.start_autosave(player, story)
+    return story.journal.name
+
+
+def test_replay_after_the_snapshot(story, player):
+    name = start_game(story, player)
+    story.add_event("You do: open the door")
+    story.add_event("A dragon wakes up.")
+    player.hp = 70
+    player.golds = 5
+    story.add_key_event("You wake a dragon.")
+    aidm.autosave(player, story)
+
+    other, loaded = aidm.Story(), aidm.Character()
+    other.save_dir = story.save_dir
+    assert aidm.load_autosave(loaded, other, name)
+    assert list(other.history) == list(story.history)
+    assert (loaded.hp, loaded.golds, loaded.name) == (70, 5, "Tester")
+    assert other.keyevents == ["You wake a dragon."]
+
+
+def test_record_cut_mid_line_is_dropped(story, player):
+    name = start_game(story, player)
+    story.add_event("Kept narration.")
+    aidm.autosave(player, story)
+    journal_path = story.journal.journal_path
+    story.journal.close()
+    with open(journal_path, "a", encoding="utf-8") as file:
+        file.write('{"type": "event", "text": "Lost in the cra')
+    size = os.path.getsize(journal_path)
+
+    other, loaded = aidm.Story(), aidm.Character()
+    other.save_dir = story.save_dir
+    assert aidm.load_autosave(loaded, other, name)
+    assert other.history[-1] == "Kept narration."
+    # The torn record is cut off the journal, so the next records follow a whole line
+    assert os.path.getsize(journal_path) < size
+
+
+def test_records_in_the_snapshot_are_skipped(tmp_path):
+    journal = aidm.Journal("game", folder=str(tmp_path))
+    journal.open()
+    journal.append({"type": "hp", "value": 10})
+    journal.sync()
+    player, story = aidm.Character(hp=10), aidm.Story()
+    journal.snapshot(aidm.save_state(player, story))
+    # A crash between the snapshot and the new journal leaves the old records: their seq is not above the snapshot's
+    with open(journal.journal_path, "w", encoding="utf-8") as file:
+        file.write('{"type": "hp", "value": 99, "seq": 1}\n')
+    journal.close()
+    save, records = aidm.Journal("game", folder=str(tmp_path)).load()
+    assert save.header["seq"] == 1
+    assert records == []
+    save.close()
+
+
+def test_loading_another_game_detaches_the_journal(story, player):
+    first = start_game(story, player)
+    other_story, other_player = aidm.Story(), aidm.Character(name="Other", hp=20)
+    other_story.save_dir = story.save_dir
+    other_story.add_event("Another world")
+    aidm.start_autosave(other_player, other_story)
+    second = other_story.journal.name
+    aidm.detach_journal(other_player, other_story)
+
+    assert aidm.load_saved_game(player, story, second)
+    assert story.journal.name == second and player.journal is story.journal
+    player.hp = 3
+    aidm.autosave(player, story)
+    # The first game's autosave is untouched
+    check_story, check_player = aidm.Story(), aidm.Character()
+    check_story.save_dir = story.save_dir
+    assert aidm.load_autosave(check_player, check_story, first)
+    assert (check_player.name, check_player.hp) == ("Tester", 100)
@@ -0,0 +1,29 @@
+from concurrent.futures import Future
+
+import aidm
+
+
+def test_trailer_is_split_off():
+    response, keyevent = aidm.read_keyevent("You open the gate.\n[KEY EVENT] You open the old gate.\n```json\n{}\n```")
+    assert keyevent == "You open the old gate."
+    assert response == "You open the gate.\n```json\n{}\n```"
+
+
+def test_trailer_on_the_json_line():
+    response, keyevent = aidm.read_keyevent("You rest.\n[key event]: You rest by the fire.```json\n{}\n```")
+    assert keyevent == "You rest by the fire."
+
+
+def test_missing_trailer_is_summarized(fake):
+    fake.recordings = {"responses": [], "default": "You walk into the forest."}
+    response, keyevent = aidm.read_keyevent("You walk on.")
+    assert response == "You walk on."
+    assert isinstance(keyevent, Future)
+    assert keyevent.result(timeout=10) == "You walk into the forest."
+
+
+def test_empty_trailer_is_summarized(fake):
+    fake.recordings = {"responses": [], "default": "A summary."}
+    response, keyevent = aidm.read_keyevent("You walk on.\n[KEY EVENT]\n")
+    assert isinstance(keyevent, Future)
+    assert keyevent.result(timeout=10) == "A summary."
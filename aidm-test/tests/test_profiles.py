@@ -0,0 +1,35 @@
+import logging
+
+import aidm
+
+
+def test_narration_budgets():
+    assert aidm.call_profile("some.new.site")["max_tokens"] is None
+    for site in ("start.story", "encounter.narration", "event.narration", "trade.narration", "continue.narration"):
+        assert aidm.call_profile(site)["max_tokens"] >= 1500
+    assert aidm.call_profile("structured.enemy")["max_tokens"] == aidm.CALL_PROFILES["structured"]["max_tokens"]
+
+
+def test_cut_off_call_is_counted_and_logged(fake, caplog):
+    fake.recordings = {"responses": [], "default": " ".join(["word"] * 200)}
+    telemetry = aidm.Telemetry()
+    with caplog.at_level(logging.WARNING, logger="aidm"), aidm.telemetry_scope(telemetry):
+        aidm.gpt([{"role": "user", "content": "Summarize"}], printChunk=False, site="keyevent")
+    call = telemetry.calls[-1]
+    assert call["finish_reason"] == "length" and call["truncated"]
+    assert sum(total["truncated"] for total in telemetry.totals.values()) == 1
+    assert "keyevent" in caplog.text and "cut off" in caplog.text
+
+
+def test_route_only_takes_known_models(story, player, capsys):
+    aidm.run_command(player, story, "/route keyevent o1-pro,gpt-4o")
+    assert "Unknown models: o1-pro" in capsys.readouterr().out
+    assert "keyevent" not in story.settings["model_routes"]
+    aidm.run_command(player, story, "/route keyevent gpt-4o")
+    assert story.settings["model_routes"]["keyevent"] == ["gpt-4o"]
+
+
+def test_llm_classifier_keeps_the_large_model(story):
+    with aidm.game_scope(story):
+        assert aidm.route_models("check_event")[0] == "gpt-4o"
+        assert aidm.route_models("check_event", story.settings["event_classifier_model"])[0] == "gpt-4o-mini"
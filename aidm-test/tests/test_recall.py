@@ -0,0 +1,60 @@
+import aidm
+
+
+def long_story(story):
+    story.add_event("The background of the world")
+    story.add_event("An old smith named Brannoc gives you the silver key of the northern tower.")
+    for i in range(30):
+        story.add_event(f"You walk along the river and count the stones, day {i}.")
+
+
+def test_finds_an_old_passage(story):
+    long_story(story)
+    passages = story.get_recall("I use the silver key from Brannoc")
+    assert passages and "Brannoc" in passages[0]
+
+
+def test_recent_and_irrelevant_are_left_out(story):
+    long_story(story)
+    assert story.get_recall("I sing to the moon") == []
+    story.add_event("A merchant sells you a copper lamp.")
+    # The latest entries are in the prompt already
+    assert not any("copper" in passage for passage in story.get_recall("copper lamp merchant"))
+
+
+def test_index_is_incremental(story):
+    long_story(story)
+    story.get_recall("silver key")
+    indexed = len(story.recall.passages)
+    story.add_event("You meet Brannoc again at the gate.")
+    story.get_recall("silver key")
+    assert len(story.recall.passages) == indexed + 1
+
+
+def test_index_is_kept_across_a_snapshot(story, player):
+    long_story(story)
+    aidm.start_autosave(player, story)
+    index = story.recall
+    indexed = len(index.passages)
+    aidm.snapshot_game(player, story)
+    story.add_event("You meet Brannoc again at the gate.")
+    assert story.recall is index and index.history is story.history
+    assert len(index.passages) == indexed + 1
+    assert "Brannoc" in story.get_recall("silver key from Brannoc")[0]
+
+
+def test_loaded_game_is_indexed_again(story, player):
+    long_story(story)
+    aidm.start_autosave(player, story)
+    other, loaded = aidm.Story(), aidm.Character()
+    other.save_dir = story.save_dir
+    assert aidm.load_autosave(loaded, other, story.journal.name)
+    assert "Brannoc" in other.get_recall("silver key from Brannoc")[0]
+
+
+def test_long_narration_is_split_into_passages():
+    history = aidm.EventLog(["background", " ".join(f"Sentence {i} is here." for i in range(60))])
+    index = aidm.RecallIndex(history, [])
+    index.sync()
+    assert len(index.passages) > 1
+    assert all(end - start < len(history[1]) for source, i, start, end in index.passages)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+import aidm
+
+
+def saved_game(story, player, events = 150):
+    story.add_event("The background of the world")
+    for i in range(events):
+        story.add_event(f"You do: step {i}" if i % 2 else f"Narration number {i} with ünicode")
+    story.add_key_event("You find the map.")
+    player.hp = 42
+    return aidm.save_state(player, story)
+
+
+def test_round_trip(tmp_path, story, player):
+    state = saved_game(story, player)
+    path = str(tmp_path / "game.aidm")
+    save = aidm.write_save_file(path, state)
+    loaded = save.state()
+    assert list(loaded["history"]) == list(story.history)
+    assert loaded["history"].latest_text("action") == "You do: step 149"
+    assert loaded["history"].latest_text("narration") == "Narration number 148 with ünicode"
+    assert loaded["character"]["hp"] == 42
+    assert loaded["keyevents"] == ["You find the map."]
+    # A history read from a save file is copied into another save file without decoding it
+    copy = aidm.write_save_file(str(tmp_path / "copy.aidm"), loaded)
+    assert list(copy.state()["history"]) == list(story.history)
+    save.close()
+    copy.close()
+
+
+def test_write_is_atomic_over_a_mapped_history(tmp_path, story, player):
+    path = str(tmp_path / "game.aidm")
+    aidm.write_save_file(path, saved_game(story, player, events=200)).close()
+    other = aidm.Story()
+    other.history = aidm.SaveFile(path).state()["history"]
+    other.add_event("One more")
+    aidm.command_save(player, other, str(tmp_path / "game"))
+    assert not os.path.exists(path + ".tmp")
+    assert other.history[-1] == "One more"
+    assert len(aidm.SaveFile(path).state()["history"]) == 202
+
+
+@pytest.mark.parametrize("damage", ["magic", "truncated", "empty", "text"])
+def test_corrupt_files_are_rejected(tmp_path, story, player, damage):
+    path = str(tmp_path / "game.aidm")
+    aidm.write_save_file(path, saved_game(story, player)).close()
+    with open(path, "rb") as file:
+        data = file.read()
+    if damage == "magic":
+        data = b"NOTASAVE" + data[8:]
+    elif damage == "truncated":
+        data = data[:len(data) // 2]
+    elif damage == "empty":
+        data = b""
+    else:
+        data = b"Name: Tester\nHP: 100\n" * 10
+    with open(path, "wb") as file:
+        file.write(data)
+    with pytest.raises(ValueError):
+        aidm.SaveFile(path)
+
+
+def test_loading_a_corrupt_file_keeps_the_game(tmp_path, story, player, capsys):
+    path = tmp_path / "broken.aidm"
+    path.write_bytes(b"AIDMSAVE" + b"\0" * 40)
+    story.save_dir = None  # as in the CLI, the path is taken as it is
+    story.add_event("The background of the world")
+    assert not aidm.load_saved_game(player, story, str(tmp_path / "broken"))
+    assert "Error loading game" in capsys.readouterr().out
+    assert list(story.history) == ["The background of the world"]
@@ -0,0 +1,25 @@
+import re
+import sys
+
+import pytest
+
+import aidm
+
+flask = pytest.importorskip("flask")
+import server
+import worldpool
+
+
+def test_import_keeps_stdout():
+    assert sys.stdout is not server.output
+
+
+def test_metrics_escape_label_values(tmp_path, monkeypatch):
+    pool = worldpool.WorldPool(str(tmp_path / "worlds.jsonl"))
+    pool.worlds["1"] = {"id": "1", "rule": {"attributes": ['Str"}\nfake_metric 1', "Wis\\"], "max_attribute_point": 6}, "text": "", "created": 0}
+    monkeypatch.setattr(aidm, "world_pool", pool)
+    text = server.app.test_client().get("/metrics").get_data(as_text=True)
+    sample = re.compile(r'^[a-z_]+(\{([a-z_]+="([^"\\]|\\.)*",?)*\})? \S+$')
+    for line in text.splitlines():
+        assert line.startswith("#") or sample.match(line), line
+    assert not any(line.startswith("fake_metric") for line in text.splitlines())
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import aidm
+
+
+def test_json_block_after_the_text(story):
+    response = 'You meet a bard.\n```json\n{"option": "Sing", "attribute": "charisma", "requirement": "12"}\n```'
+    data = aidm.validate_structured(aidm.find_json_block(response), "option", story)
+    assert data == {"option": "Sing", "attribute": "Charisma", "requirement": 12}
+    assert aidm.strip_structured(response) == "You meet a bard.\n"
+
+
+@pytest.mark.parametrize("response", [
+    "No block at all",
+    "```json\n{\"option\": \"Sing\",\n```",
+    "```json\n[1, 2]\n```",
+])
+def test_malformed_blocks(story, response):
+    with pytest.raises(ValueError):
+        aidm.validate_structured(aidm.find_json_block(response), "option", story)
+
+
+@pytest.mark.parametrize("data", [
+    {"option": "Sing", "attribute": "Luck", "requirement": 12},
+    {"option": "Sing", "attribute": "Charisma", "requirement": "a lot"},
+    {"option": "", "attribute": "Charisma", "requirement": 3},
+])
+def test_invalid_fields(story, data):
+    with pytest.raises(ValueError):
+        aidm.validate_structured(data, "option", story)
+
+
+def test_invalid_block_is_corrected_by_a_re_ask(fake, story):
+    fake.recordings = {"responses": [{"json": True, "text": json.dumps({"damage": 7})}], "default": ""}
+    messages = [{"role": "user", "content": "Hit me"}]
+    assert aidm.read_structured(story, messages, 'It hurts.\n```json\n{"damage": "much"}\n```', "damage") == {"damage": 7}
+    assert len(fake.requests) == 1
+    # The correction asks for the JSON only, with what was wrong
+    assert fake.requests[0]["model"] == story.settings["structured_model"]
+
+
+def test_still_invalid_after_the_retries(fake, story):
+    fake.recordings = {"responses": [{"json": True, "text": "not json"}], "default": ""}
+    assert aidm.read_structured(story, [{"role": "user", "content": "Hit me"}], "It hurts.", "damage") is None
+    assert len(fake.requests) == story.settings["structured_retries"]
+
+
+def test_custom_character_out_of_range_is_corrected(fake, story, player):
+    fake.recordings = {"responses": [
+        {"match": "Create a Dungeons and Dragons character", "text": 'Classtype: Ranger\nRace: Elf\nStrength = lots\n```json\n{"classtype": "Ranger", "race": "Elf", "attributes": {"Strength": 99}}\n```'},
+        {"json": True, "text": json.dumps({"classtype": "Ranger", "race": "Elf", "alignment": "Good", "description": "Quiet",
+                                           "attributes": {"Strength": 5, "Intelligence": 2, "Speed": 3, "Charisma": 4}})}],
+        "default": "A world."}
+    story.settings["speculative_world"] = False
+    game = aidm.startDM(player, story)
+    next(game)
+    game.send("0")
+    game.send("an elf ranger")
+    assert player.classtype == "Ranger"
+    assert player.attributes == {"Strength": 5, "Intelligence": 2, "Speed": 3, "Charisma": 4}
+
+
+def test_character_text_fallback_never_crashes(story, player):
+    aidm.read_character(player, story, "Classtype: Rogue\nRace: Elf\nStrength = three\nIntelligence = 99\nSpeed: 2\nAlignment: CN\nDescription: d\n")
+    assert player.attributes == {"Strength": 3, "Intelligence": 6, "Speed": 2, "Charisma": 3}
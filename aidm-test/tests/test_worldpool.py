@@ -0,0 +1,64 @@
+import json
+import os
+import time
+
+import aidm
+import worldpool
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench_recordings.json")
+with open(RECORDINGS, "r", encoding="utf-8") as file:
+    WORLD = next(response["text"] for response in json.load(file)["responses"] if response.get("match") == "Create a background")
+
+
+def filled_pool(tmp_path, story, count, **options):
+    pool = worldpool.WorldPool(str(tmp_path / "worlds.jsonl"), **options)
+    for i in range(count):
+        assert pool.add(worldpool.rule_key(story), WORLD)
+    return pool
+
+
+def test_each_world_is_served_once(tmp_path, story):
+    pool = filled_pool(tmp_path, story, 2, low=0)
+    assert pool.draw(story) == WORLD
+    assert pool.draw(story) == WORLD
+    assert pool.draw(story) is None
+    # Not even after a restart
+    assert worldpool.WorldPool(pool.path).draw(story) is None
+
+
+def test_a_draw_only_appends(tmp_path, story):
+    pool = filled_pool(tmp_path, story, 30, low=0, refill=5)
+    size = os.path.getsize(pool.path)
+    pool.draw(story)
+    assert size < os.path.getsize(pool.path) < size + 100
+    for i in range(20):
+        pool.draw(story)
+    # Rewritten once most lines were drawn worlds
+    assert pool.lines < 30
+    assert worldpool.WorldPool(pool.path).count(worldpool.rule_key(story)) == 9
+
+
+def test_failed_refill_waits(tmp_path, story, fake):
+    pool = worldpool.WorldPool(str(tmp_path / "worlds.jsonl"), refill=2, backoff=60)
+    key = worldpool.rule_key(story)
+    pool.refill_async(key)
+    while pool.refilling:
+        time.sleep(0.01)
+    # The fake's empty answers are no worlds
+    assert pool.count(key) == 0 and pool.failures[json.dumps(key)][0] == 1
+    requests = fake.request_count()
+    assert pool.draw(story) is None
+    assert not pool.refilling and fake.request_count() == requests
+
+
+def test_world_is_drawn_when_the_game_starts(tmp_path, story, player, fake, monkeypatch):
+    pool = filled_pool(tmp_path, story, 1, low=0)
+    monkeypatch.setattr(aidm, "world_pool", pool)
+    aidm.prefetchWorld(story)
+    # e.g. the player loads a game instead
+    assert pool.count(worldpool.rule_key(story)) == 1
+    game = aidm.startDM(player, story)
+    next(game)
+    assert pool.count(worldpool.rule_key(story)) == 0
+    assert fake.request_count() == 0
+    assert story.history[0].startswith(WORLD[:40])
@@ -0,0 +1,220 @@
+"""A pool of pre-generated worlds, so a new game starts without waiting for the world to be generated.
+
+The batch job fills the pool file with worlds (the background and the 4 characters to choose from) that have been checked
+with parse_world against the game rule. The server draws the world of a new game from the pool when the game starts, and
+refills it in the background when few worlds are left. Every world is served once: when a game rule has none left, the
+game generates its world itself. After a refill that could not bring the pool back up, the next one waits a while.
+
+The pool file has a JSON object per line, {"add": world} when a world is added and {"draw": id} when it is drawn, so a
+draw only appends a line. The file is rewritten with the worlds left once most of its lines are drawn worlds.
+
+    python worldpool.py --count 20                       # fill the pool with 20 worlds of the default game rule
+    python worldpool.py --count 50 --concurrency 8 --file worlds.jsonl
+    python worldpool.py --stats
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+
+import aidm
+
+POOL_FILE = os.environ.get("AIDM_WORLD_POOL") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "worlds.jsonl")
+
+
+def rule_key(story: aidm.Story):
+    """The part of the game rule a world depends on (the attributes of its characters)"""
+    return {"attributes": list(story.gameruledict["attributes"]), "max_attribute_point": story.gameruledict["max_attribute_point"]}
+
+
+def rule_story(key: dict):
+    """Return a Story with the game rule of a rule key (to build the world messages and check the worlds)"""
+    story = aidm.Story()
+    story.gameruledict["attributes"] = list(key["attributes"])
+    story.gameruledict["max_attribute_point"] = key["max_attribute_point"]
+    story.compile_gamerule()
+    return story
+
+
+class WorldPool:
+    """The worlds of the pool file that have not been drawn yet. Every world is {"id", "rule", "text", "created"}, where
+    rule is the rule key and text the whole generated world (as startDM prints it).
+
+    Args:
+        path (str): The pool file. It is created when the first world is added
+        low (int): When fewer worlds of a game rule are left after a draw, the pool is refilled in the background
+        refill (int): The number of worlds a refill brings the game rule back to
+        backoff (float): The seconds to wait before refilling a game rule again after a refill that could not bring it back up.
+            It doubles with every such refill in a row, up to max_backoff
+        max_backoff (float): The longest wait between two refills of a game rule
+    """
+    def __init__(self, path = POOL_FILE, low = 5, refill = 20, backoff = 60, max_backoff = 3600):
+        self.path = path
+        self.low = low
+        self.refill_to = refill
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock() # Held while the file is written too, so its lines are in the order of the changes
+        self.refilling = set() # Rule keys (as JSON) being refilled
+        self.failures = {} # Rule key (as JSON) -> (failed refills in a row, the time before which no refill starts)
+        self.worlds = {} # World id -> world, the oldest first
+        self.lines = 0 # The lines of the pool file
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as file:
+                for line in file:
+                    if not line.strip():
+                        continue
+                    self.lines += 1
+                    try:
+                        record = json.loads(line)
+                        if "add" in record:
+                            self.worlds[record["add"]["id"]] = record["add"]
+                        else:
+                            self.worlds.pop(record["draw"], None)
+                    except (ValueError, KeyError, TypeError) as e:
+                        # e.g. the last line of a crash
+                        print(f"[Warning] A line of the world pool {self.path} is skipped: {e}")
+        except OSError as e:
+            print(f"[Warning] The world pool {self.path} can not be read: {e}")
+
+    def append(self, record: dict):
+        """Append a line to the pool file (the lock is held)"""
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.lines += 1
+
+    def compact(self):
+        """Rewrite the pool file with only the worlds left (the lock is held), into a temporary file first so a crash never leaves half a pool"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            for world in self.worlds.values():
+                file.write(json.dumps({"add": world}, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+        self.lines = len(self.worlds)
+
+    def count(self, key: dict):
+        with self.lock:
+            return sum(1 for world in self.worlds.values() if world["rule"] == key)
+
+    def stats(self):
+        """Return {rule key (as JSON): the number of worlds left}"""
+        counts = {}
+        with self.lock:
+            for world in self.worlds.values():
+                name = json.dumps(world["rule"])
+                counts[name] = counts.get(name, 0) + 1
+        return counts
+
+    def available(self, story: aidm.Story):
+        """Whether the pool has a world for the game rule of story"""
+        return self.count(rule_key(story)) > 0
+
+    def draw(self, story: aidm.Story):
+        """Return the text of a world for a new game with the game rule of story, or None if the pool has none left.
+        The oldest world is drawn, and never served again. The pool is refilled in the background when it runs low
+        """
+        key = rule_key(story)
+        with self.lock:
+            matching = [world for world in self.worlds.values() if world["rule"] == key]
+            world = matching[0] if matching else None
+            if world is not None:
+                del self.worlds[world["id"]]
+                try:
+                    self.append({"draw": world["id"]})
+                    if self.lines > 2 * len(self.worlds) + self.refill_to:
+                        self.compact()
+                except OSError as e:
+                    print(f"[Warning] The draw could not be written to the world pool {self.path}: {e}")
+            left = len(matching) - (1 if world is not None else 0)
+        if left < self.low:
+            self.refill_async(key)
+        return world["text"] if world is not None else None
+
+    def add(self, key: dict, text: str):
+        """Check a generated world against the game rule and add it. Return True if it was added"""
+        try:
+            aidm.parse_world(text, rule_story(key))
+        except ValueError as e:
+            print(f"[Warning] A generated world is left out of the pool: {e}")
+            return False
+        world = {"id": uuid.uuid4().hex, "rule": key, "text": text, "created": time.time()}
+        with self.lock:
+            self.append({"add": world})
+            self.worlds[world["id"]] = world
+        return True
+
+    def fill(self, key: dict, count: int, concurrency = 4, max_attempts = None):
+        """Generate worlds of a game rule until it has count worlds (a few calls at a time). Return the number added"""
+        messages = aidm.world_messages(rule_story(key))
+        attempts = max_attempts if max_attempts is not None else 2 * count
+        added = 0
+        while attempts > 0:
+            missing = count - self.count(key)
+            if missing <= 0:
+                break
+            batch = min(missing, concurrency, attempts)
+            attempts -= batch
+            futures = [aidm.gpt_async(messages, site="pool.world") for i in range(batch)]
+            for future in futures:
+                try:
+                    added += self.add(key, future.result())
+                except Exception as e:
+                    print(f"[Warning] A world could not be generated: {e}")
+        return added
+
+    def refill_async(self, key: dict):
+        """Refill a game rule in a background thread (one refill per game rule at a time, none while it waits after failed refills)"""
+        name = json.dumps(key)
+        with self.lock:
+            if name in self.refilling or time.time() < self.failures.get(name, (0, 0))[1]:
+                return
+            self.refilling.add(name)
+
+        def refill():
+            full = False
+            try:
+                before = self.count(key)
+                # The worlds drawn meanwhile do not count against the refill
+                full = before + self.fill(key, self.refill_to) >= self.refill_to
+            finally:
+                with self.lock:
+                    self.refilling.discard(name)
+                    if full:
+                        self.failures.pop(name, None)
+                    else:
+                        failures = self.failures.get(name, (0, 0))[0] + 1
+                        self.failures[name] = (failures, time.time() + min(self.backoff * 2 ** (failures - 1), self.max_backoff))
+
+        threading.Thread(target=refill, name="world-pool-refill", daemon=True).start()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pre-generate worlds for the world pool")
+    parser.add_argument("--file", default=POOL_FILE, help="The pool file. Default is worlds.jsonl")
+    parser.add_argument("--count", type=int, default=20, help="The number of worlds the pool should have. Default is 20")
+    parser.add_argument("--concurrency", type=int, default=4, help="The worlds generated at the same time. Default is 4")
+    parser.add_argument("--attributes", help="The attributes of the game rule, separated by commas. Default is the game's default rule")
+    parser.add_argument("--max-attribute-point", type=int, help="The maximum attribute point of the game rule. Default is the game's default rule")
+    parser.add_argument("--stats", action="store_true", help="Only show how many worlds the pool has")
+    args = parser.parse_args()
+
+    pool = WorldPool(args.file)
+    if not args.stats:
+        story = aidm.Story()
+        if args.attributes:
+            story.gameruledict["attributes"] = [attr.strip() for attr in args.attributes.split(",") if attr.strip()]
+        if args.max_attribute_point:
+            story.gameruledict["max_attribute_point"] = args.max_attribute_point
+        key = rule_key(story)
+        start = time.perf_counter()
+        added = pool.fill(key, args.count, args.concurrency)
+        print(f"{added} worlds added in {time.perf_counter() - start:.1f}s")
+    for name, count in pool.stats().items():
+        print(f"{name}: {count} worlds")